@@ -0,0 +1,203 @@
+# chat/archive.py
+"""
+Cold storage for old messages.
+
+``archive_messages`` moves messages older than CHAT_ARCHIVE_AFTER_DAYS out of
+the Message table into append-only files under CHAT_ARCHIVE_ROOT, one per
+room per month:
+
+    <CHAT_ARCHIVE_ROOT>/<room id>/<YYYY-MM>.ndjson.gz
+
+Every run appends one gzip member (a complete gzip stream; concatenated
+members are still one valid .gz file) holding a batch of messages as NDJSON,
+and records it as an ``ArchiveSegment`` row: byte offset and length in the
+file plus the id range it covers. A page read therefore seeks straight to the
+members it needs and never decompresses a whole month.
+
+The member is written and fsynced before the transaction that adds its
+segment row and deletes the hot rows, so a crash leaves at worst an
+unreferenced member at the end of the file. Records keep ``content`` as the
+encrypted token: old keys must stay in CHAT_ENCRYPTION_KEYS while archives
+written with them exist. Archived messages keep their attachment references
+and drop out of full-text search.
+
+The files are then the only copy of those messages, so CHAT_ARCHIVE_ROOT has
+no default: it must name a persistent disk that every process serving
+history mounts (not the app directory of an ephemeral container), and
+``archive_messages`` refuses to run without it.
+
+``history.fetch_page`` continues into the archive when a keyset page runs past
+the oldest hot message (``read_before``).
+"""
+import gzip
+import json
+import logging
+import os
+from datetime import timezone as dt_timezone
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.db import connection, transaction
+from django.db.models.signals import post_delete
+from django.dispatch import receiver
+
+from .attachments import release
+from .models import ArchiveSegment, Message
+
+logger = logging.getLogger(__name__)
+
+BATCH_SIZE = 1000
+
+
+def archive_configured():
+    return bool(getattr(settings, "CHAT_ARCHIVE_ROOT", None))
+
+
+def archive_root():
+    if not archive_configured():
+        raise ImproperlyConfigured("CHAT_ARCHIVE_ROOT must point at a persistent disk to archive messages")
+    return str(settings.CHAT_ARCHIVE_ROOT)
+
+
+def _path(name):
+    return os.path.join(archive_root(), name)
+
+
+def _record(m):
+    return {
+        "id": m.pk,
+        "seq": m.seq,
+        "user_id": m.user_id,
+        "username": m.user.username if m.user else "Anonymous",
+        "content": m.content,  # encrypted token, as stored
+        "timestamp": m.timestamp.isoformat(),
+        "image": m.image.name or None,
+        "thumbnails": m.thumbnails or {},
+        "file": m.file.name or None,
+        "filename": m.filename or None,
+        "attachment_id": m.attachment_id,
+    }
+
+
+# ---------------- write -----------------
+def _append(name, records):
+    """Append one gzip member to ``name``; returns ``(offset, length)``."""
+    body = gzip.compress("".join(json.dumps(r) + "\n" for r in records).encode("utf-8"))
+    path = _path(name)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "ab") as fh:
+        offset = fh.seek(0, os.SEEK_END)
+        fh.write(body)
+        fh.flush()
+        os.fsync(fh.fileno())
+    return offset, len(body)
+
+
+def _delete_hot(ids):
+    # the attachment references move to the archived records, nothing to release
+    placeholders = ", ".join(["%s"] * len(ids))
+    with connection.cursor() as cursor:
+        cursor.execute(f"DELETE FROM {Message._meta.db_table} WHERE id IN ({placeholders})", ids)
+        if connection.vendor == "sqlite":
+            cursor.execute(f"DELETE FROM chat_message_fts WHERE rowid IN ({placeholders})", ids)
+
+
+def archive_room(room_id, cutoff, batch_size=BATCH_SIZE):
+    """Archive the messages of one room older than ``cutoff`` (sync). Returns how many moved."""
+    moved = 0
+    while True:
+        rows = list(
+            Message.objects.filter(room_id=room_id, timestamp__lt=cutoff)
+            .select_related("user").order_by("pk")[:batch_size]
+        )
+        if not rows:
+            return moved
+
+        months = {}
+        for m in rows:
+            months.setdefault(m.timestamp.astimezone(dt_timezone.utc).strftime("%Y-%m"), []).append(m)
+
+        segments = []
+        for month, messages in months.items():
+            name = f"{room_id}/{month}.ndjson.gz"
+            offset, length = _append(name, [_record(m) for m in messages])
+            segments.append(ArchiveSegment(
+                room_id=room_id, month=month, name=name, offset=offset, length=length,
+                first_id=messages[0].pk, last_id=messages[-1].pk, count=len(messages),
+                first_at=messages[0].timestamp, last_at=messages[-1].timestamp,
+            ))
+
+        with transaction.atomic():
+            ArchiveSegment.objects.bulk_create(segments)
+            _delete_hot([m.pk for m in rows])
+        moved += len(rows)
+
+
+def archive_older_than(cutoff, batch_size=BATCH_SIZE, room_ids=None):
+    """Archive every room's messages older than ``cutoff``; yields ``(room_id, moved)``."""
+    if room_ids is None:
+        room_ids = (
+            Message.objects.filter(timestamp__lt=cutoff)
+            .order_by().values_list("room_id", flat=True).distinct()
+        )
+    for room_id in list(room_ids):
+        yield room_id, archive_room(room_id, cutoff, batch_size)
+
+
+# ---------------- read -----------------
+def read_segment(segment):
+    """The records of one segment, oldest first."""
+    with open(_path(segment.name), "rb") as fh:
+        fh.seek(segment.offset)
+        body = fh.read(segment.length)
+    return [json.loads(line) for line in gzip.decompress(body).decode("utf-8").splitlines() if line]
+
+
+def read_before(room_name, before=None, limit=50):
+    """
+    ``(records, has_more)``: the newest ``limit`` archived records of
+    ``room_name`` with id below ``before`` (all when None), oldest first.
+    """
+    segments = ArchiveSegment.objects.filter(room__name=room_name)
+    if before is not None:
+        segments = segments.filter(first_id__lt=before)
+    if limit <= 0:
+        return [], segments.exists()
+
+    collected = []
+    for segment in segments.order_by("-last_id").iterator():
+        # segments may overlap when a batch spans months, so stop only once
+        # nothing in this (or any older) segment can make the page
+        if len(collected) > limit and segment.last_id < collected[limit]["id"]:
+            break
+        collected.extend(r for r in read_segment(segment) if before is None or r["id"] < before)
+        collected.sort(key=lambda r: r["id"], reverse=True)
+    return collected[:limit][::-1], len(collected) > limit
+
+
+# ---------------- cleanup -----------------
+@receiver(post_delete, sender=ArchiveSegment)
+def segment_deleted(sender, instance, **kwargs):
+    """A deleted room takes its archive along: release attachments, then drop the file."""
+    try:
+        records = read_segment(instance)
+    except (OSError, ImproperlyConfigured):
+        logger.exception("Archive segment %s is unreadable", instance.pk)
+        records = []
+    counts = {}
+    for r in records:
+        if r.get("attachment_id"):
+            counts[r["attachment_id"]] = counts.get(r["attachment_id"], 0) + 1
+    release(counts)
+
+    name = instance.name
+    transaction.on_commit(lambda: _remove_file(name))
+
+
+def _remove_file(name):
+    if ArchiveSegment.objects.filter(name=name).exists():
+        return
+    try:
+        os.remove(_path(name))
+    except (OSError, ImproperlyConfigured):
+        pass
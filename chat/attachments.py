@@ -0,0 +1,215 @@
+# chat/attachments.py
+"""
+Content-addressed attachment storage.
+
+Uploads are keyed by the SHA-256 of the bytes the client sent. The first
+upload of some content is written to ``blobs/<aa>/<sha256>.<ext>`` (images
+after the pipeline in chat/images.py, plus their thumbnails); every later
+upload of the same content, in any room, only points its Message at the
+existing ``Attachment`` and bumps ``refcount``, so it skips both the write
+and, for images, the re-encode.
+
+Blob names never change meaning, so chat/media.py serves them with
+far-future immutable cache headers. When the last message using a blob
+is deleted, the row goes in one transaction and its files after that
+commits. Messages are only deleted with their room or author, which release
+their references with one aggregated query, so the ORM can still delete the
+messages themselves in bulk. A new row never takes over an existing file: the files may belong
+to a row that is being collected, so the storage picks a free name instead.
+"""
+import base64
+import hashlib
+import os
+import re
+
+from django.core.files import File
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.db import IntegrityError, transaction
+from django.conf import settings
+from django.db.models import Count, F
+from django.db.models.signals import pre_delete
+from django.dispatch import receiver
+
+from .models import Attachment, Message, Room
+
+PREFIX = "blobs"
+CACHE_CONTROL = "public, max-age=31536000, immutable"
+CHUNK_SIZE = 1024 * 1024
+
+
+class AttachmentMissing(Exception):
+    """The blob a caller looked up earlier was collected before it was used."""
+
+
+def digest_bytes(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+def digest_base64(b64data):
+    return digest_bytes(base64.b64decode(b64data))
+
+
+def digest_file(path):
+    h = hashlib.sha256()
+    with open(path, "rb") as fh:
+        for chunk in iter(lambda: fh.read(CHUNK_SIZE), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def blob_name(sha256, ext, suffix=""):
+    return f"{PREFIX}/{sha256[:2]}/{sha256}{suffix}.{ext}" if ext else f"{PREFIX}/{sha256[:2]}/{sha256}{suffix}"
+
+
+def extension(filename):
+    """Lower-cased extension of an uploaded file name, or "" when it looks odd."""
+    ext = os.path.splitext(filename or "")[1][1:].lower()
+    return ext if re.fullmatch(r"[a-z0-9]{1,10}", ext) else ""
+
+
+def exists(sha256):
+    return Attachment.objects.filter(sha256=sha256).exists()
+
+
+# ---------------- references -----------------
+def _acquire(sha256):
+    """Take a reference on an existing attachment, or return None."""
+    if not Attachment.objects.filter(sha256=sha256).update(refcount=F("refcount") + 1):
+        return None
+    return Attachment.objects.get(sha256=sha256)
+
+
+def _write(name, content):
+    # never reuse an existing file, _collect may be about to delete it; a taken
+    # name gets a suffix from the storage
+    return default_storage.save(name, content)
+
+
+def _delete_files(names):
+    for name in names:
+        default_storage.delete(name)
+
+
+def _create(sha256, kind, write):
+    """Write the blob(s) with ``write() -> (name, thumbnails, size)`` and insert the row with one reference."""
+    name, thumbnails, size = write()
+    try:
+        with transaction.atomic():
+            return Attachment.objects.create(
+                sha256=sha256, kind=kind, name=name, thumbnails=thumbnails, size=size, refcount=1,
+            )
+    except IntegrityError:
+        # a concurrent upload of the same content won, share its row
+        _delete_files([name, *thumbnails.values()])
+        attachment = _acquire(sha256)
+        if attachment is None:
+            raise
+        return attachment
+
+
+def _bind(create, attachment, filename=""):
+    fields = {"attachment": attachment, "filename": filename or ""}
+    if attachment.kind == "image":
+        fields.update(image=attachment.name, thumbnails=dict(attachment.thumbnails))
+    else:
+        fields["file"] = attachment.name
+    return create(**fields)
+
+
+def attach_image(create, sha256, processed=None):
+    """
+    Create the message for the image with content hash ``sha256`` (sync, DB
+    thread) through ``create(**fields)``, which inserts and returns it.
+    ``processed`` is the chat/images.py result used when the blob is new; its
+    temporary files are always removed. Raises AttachmentMissing when the
+    blob is new and there is nothing to write.
+    """
+    def write():
+        if processed is None:
+            raise AttachmentMissing(sha256)
+        with open(processed["path"], "rb") as fh:
+            name = _write(blob_name(sha256, "webp"), File(fh))
+        thumbnails = {}
+        for size, path in processed["thumbnails"].items():
+            with open(path, "rb") as fh:
+                thumbnails[size] = _write(blob_name(sha256, "webp", f"_{size}"), File(fh))
+        return name, thumbnails, os.path.getsize(processed["path"])
+
+    try:
+        with transaction.atomic():
+            attachment = _acquire(sha256) or _create(sha256, "image", write)
+            return _bind(create, attachment)
+    finally:
+        if processed is not None:
+            for path in [processed["path"], *processed["thumbnails"].values()]:
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+
+
+def attach_file(create, sha256, content, filename):
+    """
+    Create the message for the file with content hash ``sha256`` (sync, DB
+    thread) through ``create(**fields)``. ``content`` is bytes or a django
+    File, only read when the blob is new.
+    """
+    def write():
+        body = ContentFile(content) if isinstance(content, bytes) else content
+        return _write(blob_name(sha256, extension(filename)), body), {}, body.size
+
+    with transaction.atomic():
+        attachment = _acquire(sha256) or _create(sha256, "file", write)
+        return _bind(create, attachment, filename)
+
+
+# ---------------- release -----------------
+def _collect(pk):
+    with transaction.atomic():
+        attachment = Attachment.objects.select_for_update().filter(pk=pk, refcount=0).first()
+        if attachment is None:  # referenced again meanwhile
+            return
+        names = [attachment.name, *attachment.thumbnails.values()]
+        attachment.delete()
+        # only once the delete has committed; no other row uses these names (_write)
+        transaction.on_commit(lambda: _delete_files(names))
+
+
+def release(counts):
+    """Drop ``{attachment id: references}``; unreferenced blobs go after the commit."""
+    for pk, n in counts.items():
+        Attachment.objects.filter(pk=pk, refcount__gte=n).update(refcount=F("refcount") - n)
+        transaction.on_commit(lambda pk=pk: _collect(pk))
+
+
+def _release_messages(messages, origin):
+    """
+    Release the references of ``messages``, which are about to be deleted.
+    Counted per (room, author) share: a room and its creator, or two authors
+    of one room, can go in the same delete, and each share is released once
+    per ``origin`` (the instance or queryset the delete started from).
+    """
+    released = set() if origin is None else origin.__dict__.setdefault("_released_attachments", set())
+    counts, shares = {}, set()
+    rows = (
+        messages.exclude(attachment=None)
+        .values_list("room_id", "user_id", "attachment_id")
+        .annotate(n=Count("id")).order_by()
+    )
+    for room_id, user_id, pk, n in rows:
+        if (room_id, user_id) not in released:
+            shares.add((room_id, user_id))
+            counts[pk] = counts.get(pk, 0) + n
+    released.update(shares)
+    release(counts)
+
+
+@receiver(pre_delete, sender=Room)
+def room_deleting(sender, instance, origin=None, **kwargs):
+    _release_messages(Message.objects.filter(room=instance), origin)
+
+
+@receiver(pre_delete, sender=settings.AUTH_USER_MODEL)
+def user_deleting(sender, instance, origin=None, **kwargs):
+    _release_messages(Message.objects.filter(user=instance), origin)
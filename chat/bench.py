@@ -0,0 +1,246 @@
+# chat/bench.py
+"""
+In-process WebSocket load test for ChatConsumer.
+
+Drives ``chat_project.asgi.application`` (the full stack, including the auth
+middleware) with N rooms x M simulated clients through connect + history,
+chat, typing and image upload flows, and reports throughput, end-to-end
+delivery latency and memory per connection. Used by ``manage.py bench_ws``.
+"""
+import asyncio
+import json
+import os
+import statistics
+import subprocess
+import time
+import tracemalloc
+from io import BytesIO
+
+from asgiref.sync import sync_to_async
+from channels.testing import WebsocketCommunicator
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.test import Client
+from PIL import Image
+
+from . import uploads
+
+
+def percentile(values, pct):
+    if not values:
+        return None
+    values = sorted(values)
+    index = min(len(values) - 1, max(0, int(round(pct / 100 * (len(values) - 1)))))
+    return values[index]
+
+
+def summarize(latencies):
+    return {
+        "count": len(latencies),
+        "p50_ms": round(percentile(latencies, 50) * 1000, 3) if latencies else None,
+        "p99_ms": round(percentile(latencies, 99) * 1000, 3) if latencies else None,
+        "mean_ms": round(statistics.fmean(latencies) * 1000, 3) if latencies else None,
+    }
+
+
+class BenchClient:
+    def __init__(self, application, room, username, cookie, upload_started):
+        self.room = room
+        self.username = username
+        self.communicator = WebsocketCommunicator(
+            application, f"/ws/chat/{room}/", headers=[(b"cookie", cookie.encode())],
+        )
+        self.frames = {}
+        self.latencies = {}
+        # username -> perf_counter() when that user's upload began (shared)
+        self.upload_started = upload_started
+        self._reader = None
+
+    async def connect(self):
+        start = time.perf_counter()
+        connected, _ = await self.communicator.connect(timeout=30)
+        if not connected:
+            raise RuntimeError(f"{self.username} could not connect to {self.room}")
+        history = json.loads((await self.communicator.output_queue.get())["text"])
+        assert history["type"] == "history"
+        elapsed = time.perf_counter() - start
+        self._reader = asyncio.create_task(self._read())
+        return elapsed
+
+    async def _read(self):
+        # read the queue directly: receive_output() kills the app on timeout
+        while True:
+            message = await self.communicator.output_queue.get()
+            if message["type"] != "websocket.send" or message.get("text") is None:
+                continue
+            data = json.loads(message["text"])
+            kind = data.get("type")
+            self.frames[kind] = self.frames.get(kind, 0) + 1
+
+            sent_at = None
+            if kind == "chat":
+                sent_at = float(data["message"].split()[1])
+            elif kind == "image" and data.get("username") in self.upload_started:
+                sent_at = self.upload_started[data["username"]]
+            if sent_at is not None:
+                self.latencies.setdefault(kind, []).append(time.perf_counter() - sent_at)
+
+    async def send_json(self, payload):
+        await self.communicator.send_to(text_data=json.dumps(payload))
+
+    async def close(self):
+        if self._reader:
+            self._reader.cancel()
+        await self.communicator.disconnect(timeout=10)
+
+
+def _png(size=256):
+    buf = BytesIO()
+    Image.new("RGB", (size, size), (30, 120, 200)).save(buf, "PNG")
+    return buf.getvalue()
+
+
+@sync_to_async
+def _make_users(count):
+    users = []
+    for i in range(count):
+        user, _ = User.objects.get_or_create(username=f"bench{i}")
+        # one client per user: logging a different user in flushes the old session
+        client = Client()
+        client.force_login(user)
+        cookie = client.cookies[settings.SESSION_COOKIE_NAME].value
+        users.append((user.username, f"{settings.SESSION_COOKIE_NAME}={cookie}"))
+    return users
+
+
+async def _wait_for(clients, kind, expected, timeout):
+    deadline = time.perf_counter() + timeout
+    while time.perf_counter() < deadline:
+        if all(c.frames.get(kind, 0) >= expected for c in clients):
+            return True
+        await asyncio.sleep(0.005)
+    return False
+
+
+async def run_benchmark(application, rooms=4, clients_per_room=25, messages=5, senders=5,
+                        typing_rounds=3, images=1, timeout=60.0, log=print):
+    total = rooms * clients_per_room
+    users = await _make_users(total)
+    results = {
+        "params": {
+            "rooms": rooms, "clients_per_room": clients_per_room, "messages": messages,
+            "senders": senders, "typing_rounds": typing_rounds, "images": images,
+            "layer": settings.CHANNEL_LAYERS["default"]["BACKEND"].rsplit(".", 1)[-1],
+        },
+    }
+
+    # ---- connect + history ----
+    tracemalloc.start()
+    before, _ = tracemalloc.get_traced_memory()
+    upload_started = {}
+    clients = [
+        BenchClient(application, f"bench-room-{i // clients_per_room}", *users[i], upload_started)
+        for i in range(total)
+    ]
+    started = time.perf_counter()
+    connect_times = await asyncio.gather(*(c.connect() for c in clients))
+    elapsed = time.perf_counter() - started
+    after, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    results["connect"] = dict(summarize(connect_times), per_sec=round(total / elapsed, 1))
+    results["memory_per_connection_kb"] = round((after - before) / total / 1024, 2)
+    log(f"connect: {results['connect']}  memory/conn: {results['memory_per_connection_kb']} KiB")
+
+    by_room = {}
+    for c in clients:
+        by_room.setdefault(c.room, []).append(c)
+
+    # ---- chat fan-out ----
+    per_room_sent = messages * min(senders, clients_per_room)
+    started = time.perf_counter()
+    for _ in range(messages):
+        sends = []
+        for members in by_room.values():
+            for sender in members[:senders]:
+                sends.append(sender.send_json({"type": "chat", "message": f"bench {time.perf_counter():.9f}"}))
+        await asyncio.gather(*sends)
+    ok = await _wait_for(clients, "chat", per_room_sent, timeout)
+    elapsed = time.perf_counter() - started
+    latencies = [lat for c in clients for lat in c.latencies.get("chat", [])]
+    results["chat"] = dict(
+        summarize(latencies),
+        complete=ok,
+        sent=per_room_sent * rooms,
+        delivered_per_sec=round(len(latencies) / elapsed, 1),
+        sent_per_sec=round(per_room_sent * rooms / elapsed, 1),
+    )
+    log(f"chat: {results['chat']}")
+
+    # ---- typing ----
+    started = time.perf_counter()
+    for _ in range(typing_rounds):
+        await asyncio.gather(*(c.send_json({"type": "typing"}) for c in clients))
+        await asyncio.sleep(0.05)
+    await asyncio.sleep(getattr(settings, "CHAT_TYPING_INTERVAL", 0.5) * 2)
+    frames = sum(c.frames.get("typing_state", 0) for c in clients)
+    results["typing"] = {
+        "keystrokes": typing_rounds * total,
+        "typing_state_frames": frames,
+        "elapsed_s": round(time.perf_counter() - started, 3),
+    }
+    log(f"typing: {results['typing']}")
+
+    # ---- image upload ----
+    if images:
+        body = _png()
+        started = time.perf_counter()
+        for n in range(images):
+            jobs = []
+            for members in by_room.values():
+                sender = members[0]
+                upload_started[sender.username] = time.perf_counter()
+                jobs.append(_upload(sender, body))
+            await asyncio.gather(*jobs)
+            ok = await _wait_for(clients, "image", n + 1, timeout)
+        elapsed = time.perf_counter() - started
+        latencies = [lat for c in clients for lat in c.latencies.get("image", [])]
+        results["image"] = dict(summarize(latencies), complete=ok, uploads=images * rooms, elapsed_s=round(elapsed, 3))
+        log(f"image: {results['image']}")
+
+    await asyncio.gather(*(c.close() for c in clients))
+    return results
+
+
+async def _upload(client, body):
+    comm = client.communicator
+    upload_id = os.urandom(16)
+    meta = json.dumps({"kind": "image", "filename": "bench.png", "size": len(body)}).encode()
+    await comm.send_to(bytes_data=uploads.HEADER.pack(uploads.OP_START, upload_id) + meta)
+    await comm.send_to(bytes_data=uploads.HEADER.pack(uploads.OP_CHUNK, upload_id) + uploads.OFFSET.pack(0) + body)
+    # frames of one connection are handled in order, no need to wait for acks
+    await comm.send_to(bytes_data=uploads.HEADER.pack(uploads.OP_FINISH, upload_id))
+
+
+def git_revision():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True,
+            cwd=settings.BASE_DIR,
+        ).stdout.strip()
+    except Exception:
+        return None
+
+
+def save_result(path, results):
+    results = dict(results, revision=git_revision(), recorded_at=time.strftime("%Y-%m-%dT%H:%M:%S"))
+    previous = None
+    if os.path.exists(path):
+        with open(path) as fh:
+            for line in fh:
+                entry = json.loads(line)
+                if entry.get("params") == results["params"]:
+                    previous = entry
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path, "a") as fh:
+        fh.write(json.dumps(results) + "\n")
+    return previous
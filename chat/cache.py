@@ -0,0 +1,259 @@
+# chat/cache.py
+"""
+Recent-history cache.
+
+Each room keeps a bounded ring of its newest history entries, already
+serialized to JSON, so ``connect`` can build the history frame without
+touching the database. The ring lives in Redis (the same server used by
+CHANNEL_LAYERS) and a small in-process LRU with a short TTL sits in front of
+it to absorb reconnect storms. Message creation writes through to the ring;
+the database is only read on a cold miss.
+
+A cold fill races with messages committed after its snapshot was read, so
+appends are never skipped: on a cold room they are kept aside (bounded like
+the ring), and ``fill`` merges those its snapshot does not contain, in one
+atomic step. A fill that finds the ring already warm leaves it alone.
+"""
+import json
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+
+from .directory import get_directory_cache
+from .history import serialize_message
+
+logger = logging.getLogger(__name__)
+
+
+class LocalLRU:
+    def __init__(self, max_rooms=1000, ttl=2.0):
+        self.max_rooms = max_rooms
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, room):
+        with self._lock:
+            item = self._data.get(room)
+            if item is None:
+                return None
+            entries, expires = item
+            if expires < time.monotonic():
+                del self._data[room]
+                return None
+            self._data.move_to_end(room)
+            return entries
+
+    def set(self, room, entries):
+        with self._lock:
+            self._data[room] = (entries, time.monotonic() + self.ttl)
+            self._data.move_to_end(room)
+            while len(self._data) > self.max_rooms:
+                self._data.popitem(last=False)
+
+    def delete(self, room):
+        with self._lock:
+            self._data.pop(room, None)
+
+
+def _entry_id(entry):
+    try:
+        return json.loads(entry).get("id")
+    except (TypeError, ValueError, AttributeError):
+        return None
+
+
+def _merge(entries, pending, size):
+    """The snapshot plus the appends it missed, newest ``size``."""
+    seen = {_entry_id(e) for e in entries}
+    return (list(entries) + [e for e in pending if _entry_id(e) not in seen])[-size:]
+
+
+class MemoryRing:
+    """Process-local ring, used when there is no shared Redis (tests, InMemoryChannelLayer)."""
+
+    def __init__(self, size):
+        self.size = size
+        self._rings = {}
+        self._pending = {}  # room -> appends seen while cold
+        self._lock = threading.Lock()
+
+    def load(self, room):
+        with self._lock:
+            ring = self._rings.get(room)
+            return list(ring) if ring is not None else None
+
+    def fill(self, room, entries):
+        with self._lock:
+            if room in self._rings:
+                return
+            self._rings[room] = _merge(entries, self._pending.pop(room, []), self.size)
+
+    def append(self, room, entry):
+        with self._lock:
+            ring = self._rings.get(room)
+            if ring is None:
+                ring = self._pending.setdefault(room, [])
+            ring.append(entry)
+            del ring[:-self.size]
+
+    def delete(self, room):
+        with self._lock:
+            self._rings.pop(room, None)
+            self._pending.pop(room, None)
+
+
+# KEYS: list, warm marker. ARGV: size, ttl, snapshot entries...
+# Entries pushed while the room was cold (no marker) are appends the snapshot
+# may have missed: keep those whose id it does not hold, after it.
+FILL_LUA = """
+if redis.call('EXISTS', KEYS[2]) == 1 then
+    return 0
+end
+local size, ttl = tonumber(ARGV[1]), tonumber(ARGV[2])
+local pending = redis.call('LRANGE', KEYS[1], 0, -1)
+redis.call('DEL', KEYS[1])
+local seen = {}
+for i = 3, #ARGV do
+    local ok, m = pcall(cjson.decode, ARGV[i])
+    if ok and type(m) == 'table' and m.id then seen[tostring(m.id)] = true end
+    redis.call('RPUSH', KEYS[1], ARGV[i])
+end
+for _, entry in ipairs(pending) do
+    local ok, m = pcall(cjson.decode, entry)
+    if not (ok and type(m) == 'table' and m.id and seen[tostring(m.id)]) then
+        redis.call('RPUSH', KEYS[1], entry)
+    end
+end
+redis.call('LTRIM', KEYS[1], -size, -1)
+redis.call('EXPIRE', KEYS[1], ttl)
+redis.call('SET', KEYS[2], 1, 'EX', ttl)
+return 1
+"""
+
+
+class RedisRing:
+    """
+    Ring stored as a Redis list ``chat:history:<room>`` plus a ``:warm`` marker
+    (an empty room has no list, but is still a valid cache hit). Without the
+    marker the list only holds appends waiting for the next ``fill``.
+    """
+
+    def __init__(self, url, size, ttl=24 * 3600):
+        import redis
+
+        self.client = redis.Redis.from_url(url)
+        self.size = size
+        self.ttl = ttl
+        self._fill = self.client.register_script(FILL_LUA)
+
+    def _keys(self, room):
+        key = f"chat:history:{room}"
+        return key, key + ":warm"
+
+    def load(self, room):
+        key, warm = self._keys(room)
+        pipe = self.client.pipeline(transaction=False)
+        pipe.exists(warm)
+        pipe.lrange(key, 0, -1)
+        is_warm, entries = pipe.execute()
+        if not is_warm:
+            return None
+        return [e.decode("utf-8") for e in entries]
+
+    def fill(self, room, entries):
+        self._fill(keys=list(self._keys(room)), args=[self.size, self.ttl, *entries[-self.size:]])
+
+    def append(self, room, entry):
+        key, warm = self._keys(room)
+        # cold rooms keep the entry too, for the fill that is about to run
+        pipe = self.client.pipeline()
+        pipe.rpush(key, entry)
+        pipe.ltrim(key, -self.size, -1)
+        pipe.expire(key, self.ttl)
+        pipe.expire(warm, self.ttl)
+        pipe.execute()
+
+    def delete(self, room):
+        self.client.delete(*self._keys(room))
+
+
+class RecentHistoryCache:
+    def __init__(self, ring, local=None):
+        self.ring = ring
+        self.local = local or LocalLRU()
+
+    @property
+    def size(self):
+        return self.ring.size
+
+    def get(self, room, loader):
+        """
+        Return ``(entries, has_more)`` where entries are JSON strings. ``loader``
+        is called with the room name on a cold miss and must return
+        ``(messages, has_more)`` like ``history.fetch_page``.
+        """
+        entries = self.local.get(room)
+        if entries is None:
+            try:
+                entries = self.ring.load(room)
+            except Exception:
+                logger.exception("History cache read failed")
+                entries = None
+
+            if entries is None:
+                messages, _ = loader(room)
+                entries = [json.dumps(m) for m in messages]
+                try:
+                    self.ring.fill(room, entries)
+                except Exception:
+                    logger.exception("History cache fill failed")
+            self.local.set(room, entries)
+        return entries, len(entries) >= self.size
+
+    def append(self, room, message):
+        entry = json.dumps(message)
+        self.local.delete(room)
+        try:
+            self.ring.append(room, entry)
+        except Exception:
+            logger.exception("History cache write failed")
+            self.invalidate(room)
+
+    def invalidate(self, room):
+        self.local.delete(room)
+        try:
+            self.ring.delete(room)
+        except Exception:
+            logger.exception("History cache invalidate failed")
+
+
+def record_message(room_name, msg):
+    """Write-through hook for freshly created messages (sync, DB thread)."""
+    get_history_cache().append(room_name, serialize_message(msg))
+    get_directory_cache().note_message()
+
+
+_cache = None
+
+
+def get_history_cache():
+    global _cache
+    if _cache is None:
+        size = getattr(settings, "CHAT_HISTORY_CACHE_SIZE", 50)
+        url = getattr(settings, "CHAT_HISTORY_CACHE_URL", None)
+        ring = RedisRing(url, size) if url else MemoryRing(size)
+        local = LocalLRU(
+            max_rooms=getattr(settings, "CHAT_HISTORY_LOCAL_ROOMS", 1000),
+            ttl=getattr(settings, "CHAT_HISTORY_LOCAL_TTL", 2.0),
+        )
+        _cache = RecentHistoryCache(ring, local)
+    return _cache
+
+
+def reset_history_cache():
+    global _cache
+    _cache = None
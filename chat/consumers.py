@@ -1,35 +1,57 @@
 # chat/consumers.py
 import json
-import base64 
-from PIL import Image
-from io import BytesIO
-
-def detect_image_format(image_bytes):
-    try:
-        img = Image.open(BytesIO(image_bytes))
-        return img.format.lower()
-    except Exception:
-        return "png"
-
-import uuid
-import mimetypes
+import base64
+import functools
 import logging
+import time
+from urllib.parse import parse_qs
 
+from asgiref.sync import sync_to_async
 from channels.generic.websocket import AsyncWebsocketConsumer
 from channels.db import database_sync_to_async
 from django.contrib.auth.models import AnonymousUser
-from django.core.files.base import ContentFile
+from django.conf import settings
+from django.db import IntegrityError
 from django.utils import timezone
 
-from .models import Room, Message, UserStatus
+from .models import Message
+from . import history as message_history
+from .cache import get_history_cache, record_message
+from .persistence import get_persister, write_behind_enabled
+from .presence import get_presence
+from .readstate import get_read_marker
+from .rooms import get_room_cache
+from . import search as message_search
+from .frames import frame_event, packed_frame
+from .typing_state import get_typing_aggregator
+from . import attachments, images, metrics, ratelimit, uploads, wire
 
 logger = logging.getLogger(__name__)
 
 
+def resync_limit():
+    return getattr(settings, "CHAT_RESYNC_MAX_MESSAGES", 500)
+
+
 class ChatConsumer(AsyncWebsocketConsumer):
+    compact = False  # MessagePack frames instead of JSON text, see connect()
+    closing = False
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # inbound rate limits and slow-consumer policy (chat/ratelimit.py)
+        self.max_lag = ratelimit.max_outbound_lag()
+        self.outbound_policy = ratelimit.outbound_policy()
+        self.limiter = ratelimit.RateLimiter(ratelimit.connection_limits())
+        self.strikes = 0
+        self.notice_until = {}
+        self.clock_offsets = {}  # sending process -> smallest sent_at delay seen, see lag()
+        self.gap_sent = False
+
     async def connect(self):
         """
-        Accept connection, join room group, mark user online and send history.
+        Accept connection, join room group, mark user online and send history
+        (only the messages missed since ``?since=<message id>`` on reconnect).
         """
         try:
             self.room_name = self.scope["url_route"]["kwargs"]["room_name"]
@@ -40,38 +62,91 @@ class ChatConsumer(AsyncWebsocketConsumer):
 
         self.room_group_name = f"chat_{self.room_name}"
 
-        # Join group then accept connection
+        # Resolve the room once; it is created lazily by the first message.
+        try:
+            self.room = await database_sync_to_async(get_room_cache().get)(self.room_name)
+        except Exception:
+            logger.exception("Failed to resolve room")
+            self.room = None
+
+        # Join group then accept connection (compact clients negotiate chat/wire.py)
+        self.subprotocol = wire.negotiate(self.scope.get("subprotocols"))
+        self.compact = self.subprotocol is not None
         await self.channel_layer.group_add(self.room_group_name, self.channel_name)
-        await self.accept()
+        await self.accept(subprotocol=self.subprotocol)
+        metrics.CONNECTIONS.inc(self.room_name)
+        self.connection_counted = True
 
-        # set user status if authenticated
+        # register presence if authenticated
         user = self.scope.get("user")
         if user and getattr(user, "is_authenticated", False):
             try:
-                await self.set_user_status(user, True)
+                presence = get_presence()
+                await sync_to_async(presence.connect, thread_sensitive=False)(self.channel_name, user, self.room_name)
+                presence.ensure_running()
             except Exception:
-                logger.exception("Failed to set user status on connect")
+                logger.exception("Failed to register presence on connect")
 
-        # send recent history
+        # send recent history, or only what a reconnecting client missed
         try:
-            history = await self.get_history(self.room_name, limit=50)
-            await self.send(text_data=json.dumps({
-                "type": "history",
-                "messages": history
-            }))
+            entries, has_more = await self.get_recent_history(self.room_name)
+            since = self.resync_cursor()
+            if since is None or not await self.send_missed(since, entries):
+                await self.send_entries("history", entries, has_more=has_more)
         except Exception:
             logger.exception("Failed to send history")
 
+    def resync_cursor(self):
+        """The ``since=<message id>`` a reconnecting client passed in the URL, or None."""
+        query = parse_qs(self.scope.get("query_string", b"").decode("latin-1"))
+        try:
+            since = int(query["since"][0])
+        except (KeyError, ValueError):
+            return None
+        return since if since > 0 else None
+
+    async def send_missed(self, since, entries):
+        """
+        Send the messages after ``since`` as history_delta pages. Returns
+        False after sending a resync_gap marker when there are too many; the
+        client then drops what it has and gets the normal history frame.
+        """
+        missed = message_history.entries_after(entries, since)
+        if missed is not None:
+            # the recent-history ring reaches back far enough, no query at all
+            metrics.RESYNCS.inc("cache")
+            for start in range(0, len(missed), message_history.PAGE_SIZE) or [0]:
+                page = missed[start:start + message_history.PAGE_SIZE]
+                await self.send_entries("history_delta", page, has_more=start + len(page) < len(missed))
+            return True
+
+        limit = resync_limit()
+        if await self.missed_more_than(self.room_name, since, limit):
+            metrics.RESYNCS.inc("gap")
+            await self.send_payload({"type": "resync_gap", "since": since})
+            return False
+
+        metrics.RESYNCS.inc("db")
+        cursor = since
+        for _ in range(-(-limit // message_history.PAGE_SIZE)):
+            messages, more = await self.get_missed(self.room_name, cursor)
+            await self.send_payload({"type": "history_delta", "messages": messages, "has_more": more})
+            if not more:
+                break
+            cursor = messages[-1]["id"]
+        return True
+
     async def disconnect(self, close_code):
         """
-        Leave group and mark user offline on disconnect.
+        Leave group and drop this connection from presence on disconnect.
         """
-        user = self.scope.get("user")
-        if user and getattr(user, "is_authenticated", False):
-            try:
-                await self.set_user_status(user, False)
-            except Exception:
-                logger.exception("Failed to set user status on disconnect")
+        if getattr(self, "connection_counted", False):
+            metrics.CONNECTIONS.dec(self.room_name)
+
+        try:
+            await sync_to_async(get_presence().disconnect, thread_sensitive=False)(self.channel_name)
+        except Exception:
+            logger.exception("Failed to update presence on disconnect")
 
         await self.channel_layer.group_discard(self.room_group_name, self.channel_name)
 
@@ -81,28 +156,118 @@ class ChatConsumer(AsyncWebsocketConsumer):
         Expected JSON structure:
           { "type": "chat", "message": "..." }
           { "type": "typing" }
+          { "type": "read", "id": <newest message id seen> }
+          { "type": "load_older", "before": <message id>, "limit": 50 }
+          { "type": "presence" }
+          { "type": "search", "q": "...", "before": <message id> }
           { "type": "image", "image": "data:image/png;base64,..." }
           { "type": "file", "file": "data:...;base64,...", "filename": "name.ext" }
+        Binary frames carry chunked uploads, see chat/uploads.py, or the same
+        events as MessagePack maps from compact clients, see chat/wire.py.
         """
-        if not text_data:
+        size = len(bytes_data) if bytes_data else len(text_data or "")
+        if size > ratelimit.max_frame_bytes():
+            metrics.THROTTLED.inc("frame", "too_large")
+            await self.close(code=1009)  # message too big
             return
 
-        try:
-            data = json.loads(text_data)
-        except Exception:
-            logger.exception("Invalid JSON received")
+        if bytes_data:
+            if not (self.compact and wire.is_packed(bytes_data)):
+                metrics.count_received("binary")
+                try:
+                    upload_id = uploads.parse_frame(bytes_data)[1]
+                except uploads.UploadError:
+                    upload_id = None
+                if not await self.throttled("upload_bytes", size, upload_id=upload_id):
+                    await self.receive_upload_frame(bytes_data)
+                return
+            try:
+                data = wire.unpack(bytes_data)
+            except Exception:
+                logger.exception("Invalid compact frame received")
+                return
+        elif text_data:
+            try:
+                data = json.loads(text_data)
+            except Exception:
+                logger.exception("Invalid JSON received")
+                return
+        else:
             return
 
         msg_type = data.get("type")
+        metrics.count_received(msg_type)
+        if await self.throttled(msg_type):
+            return
+        if msg_type in ("image", "file") and await self.throttled("upload_bytes", size * 3 // 4):
+            return
         user = self.scope.get("user")
         username = user.username if user and hasattr(user, "username") else "Anonymous"
 
-        # Typing indicator
+        # Typing indicator, coalesced per room (see chat/typing_state.py)
         if msg_type == "typing":
-            await self.channel_layer.group_send(
-                self.room_group_name,
-                {"type": "broadcast_typing", "username": username}
-            )
+            get_typing_aggregator().touch(self.channel_layer, self.room_group_name, username)
+            return
+
+        # Read pointer, written in debounced batches (see chat/readstate.py)
+        if msg_type == "read":
+            try:
+                message_id = int(data.get("id"))
+            except (TypeError, ValueError):
+                return
+            self.mark_read(user, message_id)
+            return
+
+        # Older history page (keyset cursor)
+        if msg_type == "load_older":
+            try:
+                before = int(data.get("before"))
+                limit = int(data.get("limit") or message_history.PAGE_SIZE)
+            except (TypeError, ValueError):
+                return
+            try:
+                history, has_more = await self.get_history(self.room_name, before=before, limit=limit)
+            except Exception:
+                logger.exception("Failed to load older history")
+                return
+            await self.send_payload({
+                "type": "history_page",
+                "before": before,
+                "messages": history,
+                "has_more": has_more,
+            })
+            return
+
+        # Who is online in this room
+        if msg_type == "presence":
+            try:
+                usernames = await sync_to_async(get_presence().room_usernames, thread_sensitive=False)(self.room_name)
+            except Exception:
+                logger.exception("Failed to load presence")
+                return
+            await self.send_payload({"type": "presence", "usernames": usernames})
+            return
+
+        # Full-text search within this room
+        if msg_type == "search":
+            query = (data.get("q") or "").strip()
+            try:
+                before = int(data["before"]) if data.get("before") is not None else None
+            except (TypeError, ValueError):
+                return
+            if not query or not user or not getattr(user, "is_authenticated", False):
+                return
+            try:
+                results, next_before = await self.search_room(user, query, before)
+            except Exception:
+                logger.exception("Search failed")
+                return
+            await self.send_payload({
+                "type": "search_results",
+                "q": query,
+                "results": results,
+                "next_before": next_before,
+            })
             return
 
         # --- TEXT MESSAGE ---
@@ -112,21 +277,27 @@ class ChatConsumer(AsyncWebsocketConsumer):
                 return
 
             try:
-                msg_obj = await self.create_text_message(user, self.room_name, text)
-                ts = timezone.localtime(msg_obj.timestamp).strftime("%H:%M %d/%m/%Y")
+                if write_behind_enabled():
+                    # broadcast now, the row is written by the persister's next batch
+                    # through the room cache each time: the persister recreates a deleted room there
+                    self.room = await database_sync_to_async(get_room_cache().get_or_create)(self.room_name)
+                    msg_obj = await get_persister().submit(user, self.room.id, text, self.room_name)
+                    await sync_to_async(record_message, thread_sensitive=False)(self.room_name, msg_obj)
+                else:
+                    msg_obj = await self.create_text_message(user, self.room_name, text)
+                times = message_history.time_fields(msg_obj.timestamp)
             except Exception:
                 logger.exception("Failed to create text message")
                 return
 
-            await self.channel_layer.group_send(
-                self.room_group_name,
-                {
-                    "type": "broadcast_chat",
-                    "username": username,
-                    "message": text,
-                    "timestamp": ts,
-                }
-            )
+            await self.broadcast({
+                "type": "chat",
+                "id": msg_obj.pk,
+                "username": username,
+                "message": text,
+                **times,
+            })
+            self.mark_read(user, msg_obj.pk)
             return
 
         # --- IMAGE MESSAGE ---
@@ -134,25 +305,31 @@ class ChatConsumer(AsyncWebsocketConsumer):
             image_data_url = data.get("image")
             if not image_data_url or not user or not getattr(user, "is_authenticated", False):
                 return
+            if len(image_data_url) * 3 // 4 > uploads.max_upload_size():
+                # same answer as the chunked path, so the client stops waiting
+                await self.send_upload_error(None, "File too large")
+                return
 
+            # only a validated, re-encoded and saved image is broadcast
             try:
                 msg_obj = await self.create_image_message(user, self.room_name, image_data_url)
-                image_url = msg_obj.image.url if msg_obj and msg_obj.image else image_data_url
-                ts = timezone.localtime(msg_obj.timestamp).strftime("%H:%M %d/%m/%Y") if msg_obj else timezone.now().strftime("%H:%M %d/%m/%Y")
+                times = message_history.time_fields(msg_obj.timestamp)
+            except (uploads.UploadError, ValueError) as e:  # not an image, or bad base64
+                await self.send_upload_error(None, str(e))
+                return
             except Exception:
                 logger.exception("Failed to create image message")
-                image_url = image_data_url
-                ts = timezone.now().strftime("%H:%M %d/%m/%Y")
-
-            await self.channel_layer.group_send(
-                self.room_group_name,
-                {
-                    "type": "broadcast_image",
-                    "username": username,
-                    "image": image_url,
-                    "timestamp": ts,
-                }
-            )
+                return
+
+            await self.broadcast({
+                "type": "image",
+                "id": msg_obj.pk,
+                "username": username,
+                "image": msg_obj.image.url,
+                "thumbnails": msg_obj.thumbnail_urls(),
+                **times,
+            })
+            self.mark_read(user, msg_obj.pk)
             return
 
         # --- FILE MESSAGE ---
@@ -161,120 +338,357 @@ class ChatConsumer(AsyncWebsocketConsumer):
             original_name = data.get("filename", "file")
             if not file_data_url or not user or not getattr(user, "is_authenticated", False):
                 return
+            if len(file_data_url) * 3 // 4 > uploads.max_upload_size():
+                # same answer as the chunked path, so the client stops waiting
+                await self.send_upload_error(None, "File too large")
+                return
 
             try:
                 msg_obj = await self.create_file_message(user, self.room_name, file_data_url, original_name)
                 file_url = msg_obj.file.url if msg_obj and msg_obj.file else None
-                ts = timezone.localtime(msg_obj.timestamp).strftime("%H:%M %d/%m/%Y") if msg_obj else timezone.now().strftime("%H:%M %d/%m/%Y")
+                times = message_history.time_fields(msg_obj.timestamp if msg_obj else timezone.now())
             except Exception:
                 logger.exception("Failed to create file message")
                 return
 
-            await self.channel_layer.group_send(
-                self.room_group_name,
-                {
-                    "type": "broadcast_file",
-                    "username": username,
-                    "filename": original_name,
-                    "file_url": file_url,
-                    "timestamp": ts,
-                }
-            )
+            await self.broadcast({
+                "type": "file",
+                "id": msg_obj.pk,
+                "username": username,
+                "filename": original_name,
+                "file_url": file_url,
+                **times,
+            })
+            self.mark_read(user, msg_obj.pk)
+            return
+
+    # ---------------- CHUNKED UPLOADS -----------------
+    async def receive_upload_frame(self, bytes_data):
+        user = self.scope.get("user")
+        if not user or not getattr(user, "is_authenticated", False):
+            return
+
+        upload_id = None
+        try:
+            op, upload_id, payload = uploads.parse_frame(bytes_data)
+
+            if op == uploads.OP_START:
+                meta = json.loads(bytes(payload).decode("utf-8"))
+                upload = await sync_to_async(uploads.ChunkedUpload.start, thread_sensitive=False)(
+                    upload_id, user.pk, self.room_name,
+                    meta.get("kind"), meta.get("filename"), meta.get("size"),
+                )
+                await self.send_upload_ack(upload_id, upload.offset)
+                return
+
+            upload = await sync_to_async(uploads.ChunkedUpload.load, thread_sensitive=False)(upload_id, user.pk)
+
+            if op == uploads.OP_CHUNK:
+                offset, data = uploads.parse_chunk(payload)
+                offset = await sync_to_async(upload.write, thread_sensitive=False)(offset, data)
+                await self.send_upload_ack(upload_id, offset)
+                return
+
+            if op == uploads.OP_ABORT:
+                await sync_to_async(upload.discard, thread_sensitive=False)()
+                return
+
+            if op != uploads.OP_FINISH:
+                raise uploads.UploadError("Unknown opcode")
+            if not upload.complete:
+                await self.send_upload_ack(upload_id, upload.offset)
+                return
+        except uploads.UploadError as e:
+            await self.send_upload_error(upload_id, str(e))
+            return
+        except Exception:
+            logger.exception("Invalid upload frame")
+            await self.send_upload_error(upload_id, "Invalid upload frame")
             return
 
+        try:
+            msg_obj = await self.create_upload_message(user, self.room_name, upload)
+            times = message_history.time_fields(msg_obj.timestamp)
+        except uploads.UploadError as e:
+            await self.send_upload_error(upload_id, str(e))
+            return
+        except Exception:
+            logger.exception("Failed to create upload message")
+            await self.send_upload_error(upload_id, "Upload failed")
+            return
+
+        await self.send_payload({"type": "upload_done", "upload_id": upload_id})
+
+        if upload.kind == "image":
+            payload = {
+                "type": "image",
+                "id": msg_obj.pk,
+                "username": user.username,
+                "image": msg_obj.image.url,
+                "thumbnails": msg_obj.thumbnail_urls(),
+                **times,
+            }
+        else:
+            payload = {
+                "type": "file",
+                "id": msg_obj.pk,
+                "username": user.username,
+                "filename": upload.filename,
+                "file_url": msg_obj.file.url,
+                **times,
+            }
+        await self.broadcast(payload)
+        self.mark_read(user, msg_obj.pk)
+
+    async def send_upload_ack(self, upload_id, offset):
+        await self.send_payload({
+            "type": "upload_ack",
+            "upload_id": upload_id,
+            "offset": offset,
+        })
+
+    async def send_upload_error(self, upload_id, error):
+        await self.send_payload({
+            "type": "upload_error",
+            "upload_id": upload_id,
+            "error": error,
+        })
+
+    # ---------------- RATE LIMITS -----------------
+    async def throttled(self, kind, cost=1, upload_id=None):
+        """
+        Charge ``cost`` to the connection's and the user's bucket; True when
+        the event must be dropped. A dropped upload frame is always answered
+        with a notice carrying ``upload_id``: the client waits for an ack per
+        chunk and resumes the upload after ``retry_after`` instead.
+        """
+        if kind not in self.limiter.limits:
+            kind = "default"  # unknown types share one bucket, so clients cannot mint new ones
+        retry = self.limiter.check(None, kind, cost)
+        reason = "connection"
+        user = self.scope.get("user")
+        if not retry and user and getattr(user, "is_authenticated", False):
+            retry = ratelimit.get_user_limiter().check(user.pk, kind, cost)
+            reason = "user"
+        if not retry:
+            self.strikes = 0
+            return False
+
+        self.strikes += 1
+        if self.strikes > ratelimit.max_strikes():
+            metrics.THROTTLED.inc(kind, "disconnect")
+            await self.close(code=1008)  # policy violation
+            return True
+        metrics.THROTTLED.inc(kind, reason)
+        if upload_id is not None:
+            await self.send_payload({
+                "type": "rate_limited", "event": kind, "retry_after": round(retry, 3), "upload_id": upload_id,
+            })
+            return True
+        now = time.monotonic()
+        if self.notice_until.get(kind, 0) <= now:
+            # one notice per window, not one per dropped event
+            self.notice_until[kind] = now + retry
+            await self.send_payload({"type": "rate_limited", "event": kind, "retry_after": round(retry, 3)})
+        return True
+
+    def mark_read(self, user, message_id):
+        if self.room is None or not user or not getattr(user, "is_authenticated", False):
+            return
+        get_read_marker().mark(user.pk, self.room.id, message_id)
+
+    async def send_entries(self, frame_type, entries, **fields):
+        """Send pre-serialized history entries (JSON strings) as a ``messages`` frame."""
+        if self.compact:
+            await self.send_payload({"type": frame_type, "messages": entries, **fields})
+            return
+        # splice the entries into the frame as-is
+        extra = "".join(f", {json.dumps(k)}: {json.dumps(v)}" for k, v in fields.items())
+        await self.send(text_data='{"type": %s, "messages": [%s]%s}' % (
+            json.dumps(frame_type), ", ".join(entries), extra,
+        ))
+
+    async def send_payload(self, payload):
+        if self.compact:
+            await self.send(bytes_data=wire.pack(payload))
+        else:
+            await self.send(text_data=json.dumps(payload))
+
+    async def send(self, text_data=None, bytes_data=None, close=False):
+        if text_data is not None:
+            metrics.count_outbound(len(text_data.encode("utf-8")))
+        elif bytes_data is not None:
+            metrics.count_outbound(len(bytes_data))
+        await super().send(text_data=text_data, bytes_data=bytes_data, close=close)
+
+    async def broadcast(self, payload):
+        start = time.perf_counter()
+        await self.channel_layer.group_send(self.room_group_name, frame_event(payload))
+        metrics.GROUP_SEND_SECONDS.observe(payload["type"], value=time.perf_counter() - start)
+
     # ---------------- BROADCAST HANDLERS -----------------
-    async def broadcast_chat(self, event):
-        await self.send(text_data=json.dumps({
-            "type": "chat",
-            "username": event.get("username"),
-            "message": event.get("message"),
-            "timestamp": event.get("timestamp"),
-        }))
-
-    async def broadcast_image(self, event):
-        await self.send(text_data=json.dumps({
-            "type": "image",
-            "username": event.get("username"),
-            "image": event.get("image"),
-            "timestamp": event.get("timestamp"),
-        }))
-
-    async def broadcast_file(self, event):
-        await self.send(text_data=json.dumps({
-            "type": "file",
-            "username": event.get("username"),
-            "filename": event.get("filename"),
-            "file_url": event.get("file_url"),
-            "timestamp": event.get("timestamp"),
-        }))
-
-    async def broadcast_typing(self, event):
-        await self.send(text_data=json.dumps({
-            "type": "typing",
-            "username": event.get("username"),
-        }))
+    async def broadcast_frame(self, event):
+        # encoded once by the sender, see chat/frames.py. This runs once per
+        # member per message, so it only records its latency and size.
+        if self.closing:
+            return
+        start = time.perf_counter()
+        if self.lag(event) > self.max_lag:
+            await self.fell_behind()
+            return
+        self.gap_sent = False
+        if not self.compact:
+            await super().send(text_data=event["frame"])
+            size = event.get("size") or len(event["frame"].encode("utf-8"))
+        else:
+            packed = packed_frame(event["frame"])
+            await super().send(bytes_data=packed)
+            size = len(packed)
+        metrics.count_outbound(size)
+        metrics.observe_broadcast(time.perf_counter() - start)
+
+    def lag(self, event):
+        """
+        How long ``event`` waited before this member got to it. ``sent_at`` is
+        the sending host's clock, so it is measured against the smallest delay
+        seen from that process (clock skew plus transit), not taken as is.
+        """
+        sent_at = event.get("sent_at")
+        if sent_at is None:
+            return 0.0
+        delay = time.time() - sent_at
+        origin = event.get("origin")
+        baseline = min(self.clock_offsets.get(origin, delay), delay)
+        self.clock_offsets[origin] = baseline
+        return delay - baseline
+
+    async def fell_behind(self):
+        """This member reads slower than the room talks (its frames waited past max_lag)."""
+        if self.outbound_policy == "drop":
+            # skip stale frames until caught up; the client is told once so it
+            # can reconnect with since= and fetch what it missed
+            metrics.SLOW_CONSUMERS.inc("drop")
+            if not self.gap_sent:
+                self.gap_sent = True
+                await self.send_payload({"type": "resync_gap", "reconnect": True})
+            return
+        # the client reconnects with since= and resyncs what it missed
+        metrics.SLOW_CONSUMERS.inc("disconnect")
+        self.closing = True
+        await self.close(code=1013)  # try again later
 
     # ---------------- DATABASE METHODS (sync -> async wrappers) -----------------
+    @metrics.timed("get_recent_history")
     @database_sync_to_async
-    def get_history(self, room_name, limit=50):
+    def get_recent_history(self, room_name):
+        cache = get_history_cache()
+        return cache.get(room_name, lambda room: message_history.fetch_page(room, limit=cache.size))
+
+    @metrics.timed("get_history")
+    @database_sync_to_async
+    def get_history(self, room_name, before=None, limit=50):
+        return message_history.fetch_page(room_name, before=before, limit=limit)
+
+    @metrics.timed("missed_more_than")
+    @database_sync_to_async
+    def missed_more_than(self, room_name, since, limit):
+        if write_behind_enabled():
+            get_persister().flush_sync()  # messages broadcast but not written yet
+        return message_history.missed_more_than(room_name, since, limit)
+
+    @metrics.timed("get_missed")
+    @database_sync_to_async
+    def get_missed(self, room_name, since):
+        return message_history.fetch_since(room_name, since, limit=message_history.PAGE_SIZE)
+
+    def resolve_room(self):
+        if self.room is None:
+            self.room = get_room_cache().get_or_create(self.room_name)
+        return self.room
+
+    def new_message(self, **fields):
+        """INSERT with the cached room id; recreates the room if it was deleted meanwhile."""
         try:
-            room = Room.objects.get(name=room_name)
-        except Room.DoesNotExist:
-            return []
-
-        qs = Message.objects.filter(room=room).order_by("-timestamp")[:limit]
-        msgs = []
-        for m in reversed(qs):
-            msg_type = "file" if m.file else ("image" if m.image else "text")
-            msgs.append({
-                "username": m.user.username if m.user else "Anonymous",
-                "message": m.content or "",
-                "type": msg_type,
-                "image": m.image.url if m.image else None,
-                "file": m.file.url if m.file else None,
-                "filename": m.file.name.split("/")[-1] if m.file else None,
-                "timestamp": timezone.localtime(m.timestamp).strftime("%H:%M %d/%m/%Y"),
-            })
-        return msgs
+            return Message.objects.create(room_id=self.resolve_room().id, **fields)
+        except IntegrityError:
+            get_room_cache().invalidate(self.room_name)
+            self.room = None
+            return Message.objects.create(room_id=self.resolve_room().id, **fields)
 
+    @metrics.timed("search_room")
     @database_sync_to_async
-    def create_text_message(self, user, room_name, text):
-        room, _ = Room.objects.get_or_create(name=room_name)
-        return Message.objects.create(user=user, room=room, content=text)
+    def search_room(self, user, query, before):
+        room_ids = message_search.accessible_room_ids(user, self.scope.get("session"), self.room_name)
+        return message_search.search(query, room_ids, before=before)
 
+    @metrics.timed("create_text_message")
     @database_sync_to_async
-    def create_image_message(self, user, room_name, data_url):
+    def create_text_message(self, user, room_name, text):
+        msg = self.new_message(user=user, content=text)
+        message_search.index_message(msg, text)
+        record_message(room_name, msg)
+        return msg
+
+    @metrics.timed("create_image_message")
+    async def create_image_message(self, user, room_name, data_url):
         if "," not in data_url:
-            raise ValueError("Invalid image data URL")
-        header, b64data = data_url.split(",", 1)
-        ext = header.split(";")[0].split("/")[-1]
-        decoded = base64.b64decode(b64data)
-        kind = detect_image_format(decoded) or ext or "png"
-        filename = f"{uuid.uuid4().hex}.{kind}"
-        room, _ = Room.objects.get_or_create(name=room_name)
-        msg = Message.objects.create(user=user, room=room, content="")
-        msg.image.save(filename, ContentFile(decoded), save=True)
+            raise images.ImageError("Invalid image data URL")
+        _, b64data = data_url.split(",", 1)
+        sha256 = await sync_to_async(attachments.digest_base64, thread_sensitive=False)(b64data)
+        return await self.store_image_message(user, room_name, sha256, lambda: images.process(b64data=b64data))
+
+    async def store_image_message(self, user, room_name, sha256, process):
+        # an image uploaded before (in any room) is neither re-encoded nor written again
+        processed = None
+        if not await database_sync_to_async(attachments.exists)(sha256):
+            processed = await process()
+        try:
+            return await self.save_image_message(user, room_name, sha256, processed)
+        except attachments.AttachmentMissing:
+            # its last message was deleted between the lookup and the insert
+            return await self.save_image_message(user, room_name, sha256, await process())
+
+    @metrics.timed("save_image_message")
+    @database_sync_to_async
+    def save_image_message(self, user, room_name, sha256, processed):
+        create = functools.partial(self.new_message, user=user, content="")
+        msg = attachments.attach_image(create, sha256, processed)
+        record_message(room_name, msg)
         return msg
 
+    @metrics.timed("create_file_message")
     @database_sync_to_async
     def create_file_message(self, user, room_name, data_url, original_name):
         if "," not in data_url:
             raise ValueError("Invalid file data URL")
-        header, b64data = data_url.split(",", 1)
+        _, b64data = data_url.split(",", 1)
         decoded = base64.b64decode(b64data)
 
-        ext = mimetypes.guess_extension(header.split(";")[0].split(":")[-1]) or ""
-        filename = f"{uuid.uuid4().hex}_{original_name}"
-
-        room, _ = Room.objects.get_or_create(name=room_name)
-        msg = Message.objects.create(user=user, room=room, content="")
-        msg.file.save(filename, ContentFile(decoded), save=True)
+        create = functools.partial(self.new_message, user=user, content="")
+        msg = attachments.attach_file(create, attachments.digest_bytes(decoded), decoded, original_name)
+        record_message(room_name, msg)
         return msg
 
+    @metrics.timed("create_upload_message")
+    async def create_upload_message(self, user, room_name, upload):
+        try:
+            sha256 = await sync_to_async(attachments.digest_file, thread_sensitive=False)(upload.data_path)
+            if upload.kind == "image":
+                return await self.store_image_message(
+                    user, room_name, sha256, lambda: images.process(path=upload.data_path),
+                )
+            return await self.save_file_upload(user, room_name, upload, sha256)
+        finally:
+            await sync_to_async(upload.discard, thread_sensitive=False)()
+
+    @metrics.timed("save_file_upload")
     @database_sync_to_async
-    def set_user_status(self, user, is_online):
-        status, _ = UserStatus.objects.get_or_create(user=user)
-        status.is_online = is_online
-        status.last_seen = timezone.now()
-        status.save()
-        return status
+    def save_file_upload(self, user, room_name, upload, sha256):
+        staged = upload.open()
+        try:
+            create = functools.partial(self.new_message, user=user, content="")
+            msg = attachments.attach_file(create, sha256, staged, upload.filename)
+        finally:
+            staged.close()
+        record_message(room_name, msg)
+        return msg
@@ -0,0 +1,110 @@
+# chat/crypto.py
+"""
+At-rest encryption of ``Message.content``.
+
+Keys come from ``settings.CHAT_ENCRYPTION_KEYS``: the first key encrypts,
+all of them decrypt (MultiFernet), so a new key can be put in front and old
+rows re-encrypted in the background with ``manage.py rotate_message_keys``.
+
+History pages and search results are decrypted in bulk with
+``decrypt_many``, which splits large pages over a small thread pool instead
+of decrypting row by row inside the ORM loop.
+"""
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from cryptography.fernet import Fernet, InvalidToken, MultiFernet
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+
+DECRYPT_ERROR = "[Tin nhắn mã hóa lỗi]"
+
+_fernet = None
+_primary = None
+_pool = None
+_lock = threading.Lock()
+
+
+def _load():
+    global _fernet, _primary
+    keys = [k.strip() for k in getattr(settings, "CHAT_ENCRYPTION_KEYS", []) if k.strip()]
+    if not keys:
+        raise RuntimeError("CHAT_ENCRYPTION_KEYS is empty")
+    fernets = [Fernet(k.encode() if isinstance(k, str) else k) for k in keys]
+    _primary = fernets[0]
+    _fernet = MultiFernet(fernets)
+
+
+def get_fernet():
+    if _fernet is None:
+        with _lock:
+            if _fernet is None:
+                _load()
+    return _fernet
+
+
+def primary_fernet():
+    get_fernet()
+    return _primary
+
+
+@receiver(setting_changed)
+def _reset_keys(setting, **kwargs):
+    global _fernet, _primary
+    if setting == "CHAT_ENCRYPTION_KEYS":
+        _fernet = _primary = None
+
+
+def encrypt(text):
+    return get_fernet().encrypt(text.encode()).decode()
+
+
+def decrypt(token):
+    if not token:
+        return ""
+    try:
+        return get_fernet().decrypt(token.encode()).decode()
+    except (InvalidToken, ValueError):
+        return DECRYPT_ERROR
+
+
+def _decrypt_chunk(tokens):
+    return [decrypt(t) for t in tokens]
+
+
+def _get_pool():
+    global _pool
+    if _pool is None:
+        with _lock:
+            if _pool is None:
+                _pool = ThreadPoolExecutor(
+                    max_workers=getattr(settings, "CHAT_DECRYPT_WORKERS", 4),
+                    thread_name_prefix="chat-decrypt",
+                )
+    return _pool
+
+
+def decrypt_many(tokens, chunk_size=64):
+    """Decrypt a page of tokens, in parallel chunks when the page is large."""
+    tokens = list(tokens)
+    if len(tokens) <= chunk_size:
+        return _decrypt_chunk(tokens)
+    chunks = [tokens[i:i + chunk_size] for i in range(0, len(tokens), chunk_size)]
+    result = []
+    for part in _get_pool().map(_decrypt_chunk, chunks):
+        result.extend(part)
+    return result
+
+
+def needs_rotation(token):
+    """True when ``token`` was not encrypted with the current primary key."""
+    try:
+        primary_fernet().decrypt(token.encode())
+        return False
+    except InvalidToken:
+        return True
+
+
+def rotate(token):
+    return get_fernet().rotate(token.encode()).decode()
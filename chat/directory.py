@@ -0,0 +1,283 @@
+# chat/directory.py
+"""
+Paginated room directory for the home page.
+
+A page is built from one annotated query over Room (member count, last
+message time/author/preview and the lock flag, all as subqueries evaluated
+for the page's rows only) and cached as plain JSON, shared between processes
+through Redis when CHAT_DIRECTORY_CACHE_URL is set. Password rooms are cached
+without author and preview; ``fill_locked_previews`` adds them per request
+for the rooms the user can open.
+
+Invalidation:
+  * room created / deleted / members changed -> the directory version is
+    bumped and every cached page is dropped at once;
+  * new message -> only a "last message at" timestamp is written. Pages built
+    before it are still served for ``message_staleness`` seconds, so a busy
+    server rebuilds a page at most that often instead of once per message.
+"""
+import json
+import logging
+import threading
+import time
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import BooleanField, Count, ExpressionWrapper, IntegerField, OuterRef, Q, Subquery, Value
+from django.db.models.functions import Coalesce
+from django.db.models.signals import m2m_changed, post_delete, post_save
+from django.dispatch import receiver
+from django.utils import timezone
+
+from . import crypto
+from .models import Message, Room
+
+logger = logging.getLogger(__name__)
+
+PAGE_SIZE = 30
+MAX_PAGE_SIZE = 100
+PREVIEW_LENGTH = 80
+
+
+# ---------------- query -----------------
+def _preview(content, image, file):
+    if image:
+        return "📷 Ảnh"
+    if file:
+        return "📎 " + file.split("/")[-1]
+    text = " ".join((content or "").split())
+    return text if len(text) <= PREVIEW_LENGTH else text[:PREVIEW_LENGTH - 1] + "…"
+
+
+def _with_last_message(rooms):
+    members = (
+        Room.members.through.objects.filter(room_id=OuterRef("pk"))
+        .order_by().values("room_id").annotate(n=Count("user_id")).values("n")
+    )
+    last = Message.objects.filter(room_id=OuterRef("pk")).order_by("-timestamp", "-id")
+    return rooms.annotate(
+        member_count=Coalesce(Subquery(members, output_field=IntegerField()), Value(0)),
+        locked=ExpressionWrapper(Q(password__isnull=False) & ~Q(password=""), output_field=BooleanField()),
+        last_at=Subquery(last.values("timestamp")[:1]),
+        last_user=Subquery(last.values("user__username")[:1]),
+        last_content=Subquery(last.values("content")[:1]),
+        last_image=Subquery(last.values("image")[:1]),
+        last_file=Subquery(last.values("file")[:1]),
+        last_filename=Subquery(last.values("filename")[:1]),
+    ).order_by("id").values(
+        "id", "name", "created_by_id", "member_count", "locked",
+        "last_at", "last_user", "last_content", "last_image", "last_file", "last_filename",
+    )
+
+
+def _last_message(rows, hide_locked):
+    """``(last_username, preview)`` per row; locked rooms get None when ``hide_locked``."""
+    shown = [bool(r["last_at"]) and not (hide_locked and r["locked"]) for r in rows]
+    contents = crypto.decrypt_many(r["last_content"] if show else None for r, show in zip(rows, shown))
+    return [
+        (r["last_user"], _preview(content, r["last_image"], r["last_filename"] or r["last_file"]))
+        if show else (None, None)
+        for r, content, show in zip(rows, contents, shown)
+    ]
+
+
+def fetch_page(page=1, page_size=PAGE_SIZE):
+    """
+    Build one directory page: a COUNT plus a single annotated SELECT. The
+    page is shared by every user, so password rooms carry no last message
+    (see ``fill_locked_previews``).
+    """
+    page_size = max(1, min(int(page_size), MAX_PAGE_SIZE))
+    total = Room.objects.count()
+    num_pages = max(1, -(-total // page_size))
+    page = max(1, min(int(page), num_pages))
+
+    rows = list(_with_last_message(Room.objects.all())[(page - 1) * page_size:page * page_size])
+    rooms = []
+    for r, (username, preview) in zip(rows, _last_message(rows, hide_locked=True)):
+        last_at = r["last_at"]
+        rooms.append({
+            "id": r["id"],
+            "name": r["name"],
+            "locked": bool(r["locked"]),
+            "member_count": r["member_count"],
+            "created_by_id": r["created_by_id"],
+            "last_message_at": last_at.isoformat() if last_at else None,
+            "last_message_time": timezone.localtime(last_at).strftime("%H:%M %d/%m/%Y") if last_at else None,
+            "last_username": username,
+            "preview": preview,
+        })
+    return {
+        "rooms": rooms,
+        "page": page,
+        "num_pages": num_pages,
+        "count": total,
+        "has_next": page < num_pages,
+    }
+
+
+def fill_locked_previews(rooms, user, session=None):
+    """
+    Add the last message to the locked rooms of a page that ``user`` can
+    open: created by them, a member, or unlocked in this session (views.room).
+    One query, and only when the page has such rooms.
+    """
+    locked = {r["id"]: r for r in rooms if r["locked"] and r["last_message_at"]}
+    if not locked:
+        return rooms
+    unlocked = {
+        key[len("room_access_"):] for key, value in (session.items() if session is not None else [])
+        if key.startswith("room_access_") and value
+    }
+    openable = Room.objects.filter(pk__in=locked).filter(
+        Q(created_by=user) | Q(members=user) | Q(name__in=unlocked)
+    ).values("pk")
+    rows = list(_with_last_message(Room.objects.filter(pk__in=openable)))
+    for r, (username, preview) in zip(rows, _last_message(rows, hide_locked=False)):
+        locked[r["id"]].update(last_username=username, preview=preview)
+    return rooms
+
+
+# ---------------- cache -----------------
+class MemoryDirectoryStore:
+    """Process-local store, used when there is no shared Redis."""
+
+    def __init__(self):
+        self._version = 0
+        self._last_message_at = 0.0
+        self._pages = {}
+        self._lock = threading.Lock()
+
+    def state(self):
+        return self._version, self._last_message_at
+
+    def get_page(self, key):
+        with self._lock:
+            item = self._pages.get(key)
+        if item is None or item[1] < time.time():
+            return None
+        return item[0]
+
+    def set_page(self, key, value, ttl):
+        with self._lock:
+            self._pages[key] = (value, time.time() + ttl)
+
+    def bump_version(self):
+        with self._lock:
+            self._version += 1
+            self._pages.clear()
+
+    def touch_message(self, at):
+        self._last_message_at = max(self._last_message_at, at)
+
+
+class RedisDirectoryStore:
+    VERSION = "chat:directory:version"
+    LAST_MESSAGE = "chat:directory:last_message_at"
+
+    def __init__(self, url):
+        import redis
+
+        self.client = redis.Redis.from_url(url)
+
+    def state(self):
+        version, last = self.client.mget(self.VERSION, self.LAST_MESSAGE)
+        return int(version or 0), float(last or 0)
+
+    def get_page(self, key):
+        value = self.client.get(f"chat:directory:page:{key}")
+        return value.decode("utf-8") if value is not None else None
+
+    def set_page(self, key, value, ttl):
+        self.client.set(f"chat:directory:page:{key}", value, ex=max(1, int(ttl)))
+
+    def bump_version(self):
+        # old pages are keyed by the old version and simply expire
+        self.client.incr(self.VERSION)
+
+    def touch_message(self, at):
+        self.client.set(self.LAST_MESSAGE, repr(at))
+
+
+class RoomDirectoryCache:
+    def __init__(self, store, ttl=300.0, message_staleness=5.0):
+        self.store = store
+        self.ttl = ttl
+        self.message_staleness = message_staleness
+
+    def get_page(self, page=1, page_size=PAGE_SIZE):
+        """Return the page as a JSON string (sync, DB thread)."""
+        try:
+            version, last_message_at = self.store.state()
+            key = f"{version}:{page_size}:{page}"
+            cached = self.store.get_page(key)
+        except Exception:
+            logger.exception("Room directory cache read failed")
+            return json.dumps(fetch_page(page, page_size))
+
+        if cached is not None:
+            built_at, _, body = cached.partition("|")
+            built_at = float(built_at)
+            if built_at >= last_message_at or time.time() - built_at < self.message_staleness:
+                return body
+
+        built_at = time.time()
+        body = json.dumps(fetch_page(page, page_size))
+        try:
+            self.store.set_page(key, f"{built_at!r}|{body}", self.ttl)
+        except Exception:
+            logger.exception("Room directory cache write failed")
+        return body
+
+    def invalidate(self):
+        try:
+            self.store.bump_version()
+        except Exception:
+            logger.exception("Room directory invalidate failed")
+
+    def note_message(self):
+        try:
+            self.store.touch_message(time.time())
+        except Exception:
+            logger.exception("Room directory message mark failed")
+
+
+_cache = None
+
+
+def get_directory_cache():
+    global _cache
+    if _cache is None:
+        url = getattr(settings, "CHAT_DIRECTORY_CACHE_URL", None)
+        _cache = RoomDirectoryCache(
+            RedisDirectoryStore(url) if url else MemoryDirectoryStore(),
+            ttl=getattr(settings, "CHAT_DIRECTORY_CACHE_TTL", 300.0),
+            message_staleness=getattr(settings, "CHAT_DIRECTORY_MESSAGE_STALENESS", 5.0),
+        )
+    return _cache
+
+
+def reset_directory_cache():
+    global _cache
+    _cache = None
+
+
+# invalidate after commit, so a concurrent reader cannot re-cache the old rows
+def _invalidate_on_commit():
+    transaction.on_commit(lambda: get_directory_cache().invalidate())
+
+
+@receiver(post_save, sender=Room)
+def room_saved(sender, instance, **kwargs):
+    _invalidate_on_commit()
+
+
+@receiver(post_delete, sender=Room)
+def room_deleted(sender, instance, **kwargs):
+    _invalidate_on_commit()
+
+
+@receiver(m2m_changed, sender=Room.members.through)
+def room_members_changed(sender, action, **kwargs):
+    if action in ("post_add", "post_remove", "post_clear"):
+        _invalidate_on_commit()
@@ -0,0 +1,45 @@
+# chat/frames.py
+"""
+Broadcast frames are encoded once, by the consumer that produced the message,
+and carried through group_send as a ready-to-send string. Every member's
+consumer then forwards it untouched instead of rebuilding and re-dumping the
+payload per socket. Only the JSON frame travels through the channel layer;
+compact clients (see chat/wire.py) get it packed on the receiving side, once
+per process (``packed_frame``), so rooms without compact members pay nothing
+for them. ``sent_at`` and ``origin`` let members tell how far behind they are
+(see chat/ratelimit.py).
+"""
+import json
+import time
+import uuid
+from collections import OrderedDict
+
+from . import wire
+
+# identifies this process's sent_at clock to the members (ChatConsumer.lag)
+ORIGIN = uuid.uuid4().hex[:12]
+PACKED_CACHE_SIZE = 256
+
+# frame -> MessagePack bytes for the recent broadcasts. Only touched from the
+# event loop thread (broadcast_frame), so there is no lock.
+_packed = OrderedDict()
+
+
+def frame_event(payload):
+    """Wrap a wire payload into a group_send event for ``broadcast_frame``."""
+    frame = json.dumps(payload)
+    # byte size for the outbound metrics, so members do not re-encode to count
+    return {
+        "type": "broadcast_frame", "frame": frame, "size": len(frame.encode("utf-8")),
+        "sent_at": time.time(), "origin": ORIGIN,
+    }
+
+
+def packed_frame(frame):
+    """``frame`` packed for compact clients, packed once however many of them get it."""
+    packed = _packed.get(frame)
+    if packed is None:
+        packed = _packed[frame] = wire.pack(json.loads(frame))
+        if len(_packed) > PACKED_CACHE_SIZE:
+            _packed.popitem(last=False)
+    return packed
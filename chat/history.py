@@ -0,0 +1,140 @@
+# chat/history.py
+"""
+Message history queries.
+
+Pages are fetched newest-first over the (room_id, timestamp, id) index and
+returned oldest-first. Older pages are addressed with a keyset cursor (the id
+of the oldest message the client already has), so every page costs the same
+no matter how deep into a room's history the client scrolls.
+
+Reconnecting clients resync with the id of the last message they received
+(``since``): they get only what came after it in (timestamp, id) order,
+newest-last, as long as it is at most ``CHAT_RESYNC_MAX_MESSAGES`` messages,
+otherwise a gap marker.
+
+Pages that run past the oldest message in the table continue, transparently,
+in the room's archive segments (chat/archive.py).
+"""
+import json
+
+from django.core.files.storage import default_storage
+from django.db.models import Q, Subquery
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from . import archive, crypto
+from .models import Message
+
+PAGE_SIZE = 50
+MAX_PAGE_SIZE = 200
+
+
+def time_fields(dt):
+    """Display string for room.html plus epoch seconds for compact clients."""
+    return {"timestamp": timezone.localtime(dt).strftime("%H:%M %d/%m/%Y"), "ts": int(dt.timestamp())}
+
+
+def serialize_message(m, content=None):
+    """``content`` is the already decrypted text; decrypted on demand otherwise."""
+    msg_type = "file" if m.file else ("image" if m.image else "text")
+    return {
+        "id": m.pk,
+        "username": m.user.username if m.user else "Anonymous",
+        "message": content if content is not None else m.decrypted(),
+        "type": msg_type,
+        "image": m.image.url if m.image else None,
+        "thumbnails": m.thumbnail_urls(),
+        "file": m.file.url if m.file else None,
+        "filename": (m.filename or m.file.name.split("/")[-1]) if m.file else None,
+        **time_fields(m.timestamp),
+    }
+
+
+def fetch_page(room_name, before=None, limit=PAGE_SIZE):
+    """
+    Return ``(messages, has_more)`` for one page of ``room_name`` history,
+    older than message id ``before`` when given. Runs a single query.
+    """
+    limit = max(1, min(int(limit), MAX_PAGE_SIZE))
+    qs = Message.objects.filter(room__name=room_name).select_related("user")
+
+    if before is not None:
+        cursor = Message.objects.filter(pk=before).values("timestamp")
+        qs = qs.filter(
+            Q(timestamp__lt=Subquery(cursor)) | Q(timestamp=Subquery(cursor), pk__lt=before)
+        )
+
+    rows = list(qs.order_by("-timestamp", "-pk")[:limit + 1])
+    if len(rows) > limit:
+        return serialize_page(rows[:limit][::-1]), True
+
+    # ran past the oldest hot message: continue in the archive (chat/archive.py)
+    records, has_more = archive.read_before(room_name, before, limit - len(rows))
+    return serialize_archived(records) + serialize_page(rows[::-1]), has_more
+
+
+def serialize_page(rows):
+    """Serialize loaded rows, decrypting their contents in one batch."""
+    contents = crypto.decrypt_many(m.content for m in rows)
+    return [serialize_message(m, content) for m, content in zip(rows, contents)]
+
+
+def serialize_archived(records):
+    """Serialize archive records (chat/archive.py) like ``serialize_page`` does rows."""
+    contents = crypto.decrypt_many(r["content"] for r in records)
+    url = default_storage.url
+    return [
+        {
+            "id": r["id"],
+            "username": r["username"],
+            "message": content or "",
+            "type": "file" if r["file"] else ("image" if r["image"] else "text"),
+            "image": url(r["image"]) if r["image"] else None,
+            "thumbnails": {size: url(name) for size, name in r["thumbnails"].items()} if r["image"] else {},
+            "file": url(r["file"]) if r["file"] else None,
+            "filename": (r["filename"] or r["file"].split("/")[-1]) if r["file"] else None,
+            **time_fields(parse_datetime(r["timestamp"])),
+        }
+        for r, content in zip(records, contents)
+    ]
+
+
+# ---------------- resync -----------------
+# Message ids do not follow send order: write-behind reserves them in blocks
+# per process (chat/persistence.py). Resync follows the room's (timestamp, id)
+# order like the history pages, from the message the client got last.
+def entries_after(entries, since):
+    """
+    Cached history entries (JSON strings, oldest first) after the one with
+    message id ``since``, or None when ``since`` is not among them (older than
+    the cache, or not cached at all).
+    """
+    ids = [json.loads(entry)["id"] for entry in entries]
+    if since not in ids:
+        return None
+    return entries[ids.index(since) + 1:]
+
+
+def _after(room_name, since):
+    cursor = Message.objects.filter(pk=since).values("timestamp")
+    return Message.objects.filter(room__name=room_name).filter(
+        Q(timestamp__gt=Subquery(cursor)) | Q(timestamp=Subquery(cursor), pk__gt=since)
+    )
+
+
+def missed_more_than(room_name, since, limit):
+    """
+    True when more than ``limit`` messages follow ``since`` (an index probe, no
+    rows loaded), or when ``since`` is no stored message of the room, so there
+    is nothing to resync from.
+    """
+    if not Message.objects.filter(pk=since, room__name=room_name).exists():
+        return True
+    return _after(room_name, since).order_by("timestamp", "pk")[limit:limit + 1].exists()
+
+
+def fetch_since(room_name, since, limit=PAGE_SIZE):
+    """``(messages, has_more)`` for the oldest ``limit`` messages after message id ``since``."""
+    limit = max(1, min(int(limit), MAX_PAGE_SIZE))
+    rows = list(_after(room_name, since).select_related("user").order_by("timestamp", "pk")[:limit + 1])
+    return serialize_page(rows[:limit]), len(rows) > limit
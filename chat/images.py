@@ -0,0 +1,124 @@
+# chat/images.py
+"""
+Image pipeline for chat uploads.
+
+Decoding and re-encoding happen in a process pool so neither the daphne event
+loop nor the database_sync_to_async thread is blocked by Pillow. The worker
+only deals with local paths: it writes a web-optimized copy and a few
+thumbnails into the upload staging directory, and chat/attachments.py moves
+them into content-addressed storage.
+"""
+import asyncio
+import base64
+import functools
+import multiprocessing
+import os
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from io import BytesIO
+
+from django.conf import settings
+from PIL import Image, ImageOps
+
+from .uploads import UploadError, staging_dir
+
+FORMAT = "webp"
+QUALITY = 80
+
+_pool = None
+
+
+class ImageError(UploadError):
+    pass
+
+
+def get_pool():
+    global _pool
+    if _pool is None:
+        workers = getattr(settings, "CHAT_IMAGE_WORKERS", None) or min(2, os.cpu_count() or 1)
+        _pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"))
+    return _pool
+
+
+def shutdown_pool():
+    global _pool
+    if _pool is not None:
+        _pool.shutdown(wait=True)
+        _pool = None
+
+
+def _encode(img, out_dir, **options):
+    fd, path = tempfile.mkstemp(suffix=f".{FORMAT}", dir=out_dir)
+    with os.fdopen(fd, "wb") as fh:
+        img.save(fh, FORMAT, quality=QUALITY, method=4, **options)
+    return path
+
+
+def process_image(out_dir, path=None, b64data=None, max_pixels=None, max_dimension=2048, sizes=(160, 480)):
+    """
+    Runs in a worker process. Validates the image, drops EXIF/ICC metadata by
+    re-encoding, and returns the paths of the web variant and thumbnails:
+
+        {"path": ..., "width": ..., "height": ..., "thumbnails": {"160": ...}}
+    """
+    source = path if path is not None else BytesIO(base64.b64decode(b64data))
+    if max_pixels:
+        Image.MAX_IMAGE_PIXELS = max_pixels
+
+    try:
+        with Image.open(source) as probe:
+            probe.verify()
+        if not isinstance(source, str):
+            source.seek(0)
+        img = Image.open(source)
+        img.load()
+    except Exception as e:
+        raise ImageError(f"Invalid image: {e}")
+
+    if getattr(img, "is_animated", False):
+        # Keep animations intact; only the thumbnails are flattened.
+        result = {
+            "path": _encode(img, out_dir, save_all=True),
+            "width": img.width,
+            "height": img.height,
+            "thumbnails": {},
+        }
+        img.seek(0)
+        img = img.convert("RGBA")
+    else:
+        img = ImageOps.exif_transpose(img)
+        if img.mode not in ("RGB", "RGBA"):
+            img = img.convert("RGBA" if "transparency" in img.info or img.mode in ("LA", "PA") else "RGB")
+
+        web = img.copy()
+        web.thumbnail((max_dimension, max_dimension), Image.LANCZOS)
+        result = {
+            "path": _encode(web, out_dir),
+            "width": web.width,
+            "height": web.height,
+            "thumbnails": {},
+        }
+
+    for size in sizes:
+        if size >= max(img.width, img.height):
+            continue
+        thumb = img.copy()
+        thumb.thumbnail((size, size), Image.LANCZOS)
+        result["thumbnails"][str(size)] = _encode(thumb, out_dir)
+    return result
+
+
+async def process(path=None, b64data=None):
+    """Run ``process_image`` in the process pool."""
+    loop = asyncio.get_running_loop()
+    job = functools.partial(
+        process_image,
+        staging_dir(),
+        path=path,
+        b64data=b64data,
+        max_pixels=getattr(settings, "CHAT_IMAGE_MAX_PIXELS", 40_000_000),
+        max_dimension=getattr(settings, "CHAT_IMAGE_MAX_DIMENSION", 2048),
+        sizes=tuple(getattr(settings, "CHAT_IMAGE_THUMBNAIL_SIZES", (160, 480))),
+    )
+    return await loop.run_in_executor(get_pool(), job)
+
@@ -0,0 +1,330 @@
+# chat/layers.py
+"""
+Channel layer sharded over several Redis servers.
+
+``ShardedChannelLayer`` is channels_redis' ``RedisChannelLayer`` with its
+host selection replaced by a consistent hash ring. Each room group
+(``chat_<room>``) lives on one shard: its member set and every
+``group_send`` for it go there. Each process's channel inbox
+(``specific.<process>!``) also lives on one shard. Spreading rooms and
+processes over CHAT_CHANNEL_SHARDS spreads the group_send load, so
+throughput is no longer capped by a single Redis core.
+
+channels_redis' own hash splits a 4096-slot space into ``len(hosts)``
+contiguous ranges, so adding a host moves about half of all keys. On the
+ring, every shard owns REPLICAS points derived from its *name* (its
+address, or the ``name`` key of a host dict). Going from N to N+1 shards
+moves only about 1/(N+1) of the rooms, and all of them move to the new
+shard. Keep shard names stable when a URL changes (a password rotation,
+for example) by giving the host a ``name``.
+
+Rebalancing after a change to the shard list:
+
+1. ``manage.py channel_shards --hosts <new list>`` shows how the current
+   rooms would move.
+2. Roll the new list out to every process at once. A group's members are
+   only found on the shard the sender hashes it to, so processes on
+   different lists must not serve the same rooms for long.
+3. Restarting closes the sockets, and clients reconnect with ``since=``.
+   They re-join their groups on the new owner and resync what they missed
+   (chat/history.py). Group keys left behind on the old owners expire
+   after ``group_expiry``.
+
+``HybridChannelLayer`` (CHAT_LOCAL_DELIVERY) adds a local fast path on top
+of the sharding. Members of a group that live in this process get
+``group_send`` straight into their in-memory receive buffer. Only the remote
+members are written to Redis: one ZRANGE on the group's shard, then one
+script per shard that holds remote inboxes. A room whose members all sit on
+the sending process costs one read instead of a write plus a BRPOP per
+message. Membership is still kept in Redis, so other processes reach our
+members as before.
+
+Ordering is the same as with the plain layer. When other processes have
+members in the group they can send to it too, and their earlier messages
+may still wait in this process's Redis inbox. The local copy then goes
+behind them: a small marker is added to our own inbox and the pump hands
+the held message to the local members when it reaches the marker. While any
+message is held, later local sends and group_sends queue up behind it.
+"""
+import asyncio
+import hashlib
+import logging
+import itertools
+import threading
+import time
+from bisect import bisect
+from collections import OrderedDict, defaultdict
+
+from channels.exceptions import ChannelFull
+from channels_redis.core import RedisChannelLayer
+from channels_redis.utils import decode_hosts
+
+logger = logging.getLogger(__name__)
+
+REPLICAS = 160
+MEMO_SIZE = 65536
+MARKER = "__local_marker__"
+
+
+def _point(value):
+    return int.from_bytes(hashlib.blake2b(value.encode("utf8"), digest_size=8).digest(), "big")
+
+
+def shard_name(host):
+    if "name" in host:
+        return host["name"]
+    if "address" in host:
+        return host["address"]
+    if "master_name" in host:
+        return f"sentinel:{host['master_name']}"
+    return f"{host.get('host', 'localhost')}:{host.get('port', 6379)}/{host.get('db', 0)}"
+
+
+class HashRing:
+    """Maps keys to the index of one of ``names``; stable when names are added or removed."""
+
+    def __init__(self, names, replicas=REPLICAS):
+        if len(set(names)) != len(names):
+            raise ValueError(f"Shard names must be unique: {names}")
+        points = sorted((_point(f"{name}#{i}"), index) for index, name in enumerate(names) for i in range(replicas))
+        self._points = [p for p, _ in points]
+        self._nodes = [n for _, n in points]
+        self._memo = {}
+
+    def node(self, key):
+        index = self._memo.get(key)
+        if index is None:
+            if len(self._memo) >= MEMO_SIZE:
+                self._memo.clear()
+            index = self._nodes[bisect(self._points, _point(key)) % len(self._points)]
+            self._memo[key] = index
+        return index
+
+
+class ShardedChannelLayer(RedisChannelLayer):
+    def __init__(self, hosts=None, replicas=REPLICAS, **kwargs):
+        hosts = [dict(h) for h in decode_hosts(hosts)]
+        self.shard_names = [shard_name(h) for h in hosts]
+        for h in hosts:
+            h.pop("name", None)  # not a connection option
+        super().__init__(hosts=hosts, **kwargs)
+        self.ring = HashRing(self.shard_names, replicas)
+
+    def consistent_hash(self, value):
+        if self.ring_size == 1:
+            return 0
+        # the inbox of a process-specific channel is keyed by its non-local
+        # part; hash that on every path (send() passes the full name)
+        if "!" in value:
+            value = self.non_local_name(value)
+        return self.ring.node(value)
+
+
+# group_send script of channels_redis: append to each inbox under capacity
+GROUP_SEND_LUA = """
+    local over_capacity = 0
+    local current_time = ARGV[#ARGV - 1]
+    local expiry = ARGV[#ARGV]
+    for i=1,#KEYS do
+        if redis.call('ZCOUNT', KEYS[i], '-inf', '+inf') < tonumber(ARGV[i + #KEYS]) then
+            redis.call('ZADD', KEYS[i], current_time, ARGV[i])
+            redis.call('EXPIRE', KEYS[i], expiry)
+        else
+            over_capacity = over_capacity + 1
+        end
+    end
+    return over_capacity
+"""
+
+
+class HybridChannelLayer(ShardedChannelLayer):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.local_groups = defaultdict(set)
+        self._forward_locks = {}
+        self._pump = None
+        self._pump_loop = None
+        # marker token -> [(group, channel, message)] waiting for the pump to
+        # reach that marker in our inbox; tokens only grow, like their scores
+        self._held = OrderedDict()
+        self._held_lock = threading.Lock()
+        self._tokens = itertools.count(1)
+        self._last_score = 0.0
+
+    @property
+    def inbox(self):
+        return f"specific.{self.client_prefix}!"
+
+    def is_local(self, channel):
+        return "!" in channel and self.non_local_name(channel).endswith(self.client_prefix + "!")
+
+    def _deliver(self, channel, message):
+        """Put ``message`` in a local channel's buffer; False when it is full."""
+        queue = self.receive_buffer[channel]
+        if queue.full():
+            return False
+        loop = self._pump_loop
+        if loop is None or loop is asyncio.get_running_loop():
+            queue.put_nowait(message)
+        else:  # sent from another thread's loop (async_to_sync)
+            loop.call_soon_threadsafe(queue.put_nowait, message)
+        return True
+
+    def _deliver_group(self, group, message):
+        local = self.local_groups.get(group)
+        if not local:
+            return
+        dropped = sum(not self._deliver(channel, message) for channel in list(local))
+        if dropped:
+            logger.info("%s local channels over capacity in group %s", dropped, group)
+
+    # ---------------- ordering -----------------
+    def _hold(self, delivery):
+        """Queue ``delivery`` behind the newest held marker; False when nothing is held."""
+        with self._held_lock:
+            if not self._held:
+                return False
+            next(reversed(self._held.values())).append(delivery)
+            return True
+
+    async def _hold_behind_inbox(self, delivery):
+        """Hold ``delivery`` until the pump has read everything now in our inbox."""
+        with self._held_lock:
+            token = next(self._tokens)
+            self._held[token] = [delivery]
+            score = self._last_score = max(time.time(), self._last_score + 1e-6)
+        key = self.prefix + self.inbox
+        marker = self.serialize({"__asgi_channel__": [self.inbox + "marker"], MARKER: token})
+        connection = self.connection(self.consistent_hash(self.inbox))
+        await connection.zadd(key, {marker: score})
+        await connection.expire(key, int(self.expiry))
+
+    def _release(self, token):
+        """The pump reached ``token``: deliver what it held (and anything held before it)."""
+        with self._held_lock:
+            ready = []
+            while self._held and next(iter(self._held)) <= token:
+                ready.extend(self._held.popitem(last=False)[1])
+        for group, channel, message in ready:
+            if group is not None:
+                self._deliver_group(group, message)
+            elif not self._deliver(channel, message):
+                logger.info("Local channel %s over capacity", channel)
+
+    # ---------------- receiving -----------------
+    # channels_redis lets one waiting receive() hold a lock and BRPOP for
+    # everyone, which would never notice a message put in its own buffer in
+    # memory. Instead one pump task per event loop moves this process's Redis
+    # inbox into the buffers, and receive() only waits on its buffer.
+    def _start_pump(self):
+        loop = asyncio.get_running_loop()
+        if self._pump is None or self._pump.done() or self._pump_loop is not loop:
+            self._pump_loop = loop
+            self._pump = loop.create_task(self._run_pump())
+
+    async def _run_pump(self):
+        while True:
+            try:
+                channel, message = await self.receive_single(self.inbox)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("Receiving from %s failed", self.inbox)
+                await asyncio.sleep(1)
+                continue
+            if MARKER in message:
+                self._release(message[MARKER])
+                continue
+            for name in channel if isinstance(channel, list) else [channel]:
+                self.receive_buffer[name].put_nowait(message)
+
+    async def receive(self, channel):
+        if not self.is_local(channel):
+            return await super().receive(channel)
+        assert self.require_valid_channel_name(channel), "Channel name not valid"
+        self._start_pump()
+        queue = self.receive_buffer[channel]
+        try:
+            return await queue.get()
+        finally:
+            if queue.empty() and self.receive_buffer.get(channel) is queue:
+                del self.receive_buffer[channel]
+
+    async def close_pools(self):
+        if self._pump is not None:
+            self._pump.cancel()
+            self._pump = self._pump_loop = None
+        await super().close_pools()
+
+    # ---------------- sending -----------------
+    async def send(self, channel, message):
+        if not self.is_local(channel):
+            return await super().send(channel, message)
+        assert isinstance(message, dict), "message is not a dict"
+        assert self.require_valid_channel_name(channel), "Channel name not valid"
+        if self._hold((None, channel, message)):
+            return
+        if not self._deliver(channel, message):
+            raise ChannelFull()
+
+    async def group_add(self, group, channel):
+        await super().group_add(group, channel)
+        if self.is_local(channel):
+            self.local_groups[group].add(channel)
+
+    async def group_discard(self, group, channel):
+        members = self.local_groups.get(group)
+        if members is not None:
+            members.discard(channel)
+            if not members:
+                del self.local_groups[group]
+                self._forward_locks.pop(group, None)
+        await super().group_discard(group, channel)
+
+    async def group_send(self, group, message):
+        assert self.require_valid_group_name(group), "Group name not valid"
+        lock = self._forward_locks.get(group)
+        if lock is None:
+            lock = self._forward_locks[group] = asyncio.Lock()
+        async with lock:
+            shared = await self._forward(group, message)
+            if not self.local_groups.get(group):
+                return
+            delivery = (group, None, message)
+            if self._hold(delivery):
+                return
+            if shared:
+                # other processes send to this group too: go behind their messages
+                await self._hold_behind_inbox(delivery)
+            else:
+                self._deliver_group(group, message)
+
+    async def _forward(self, group, message):
+        """
+        Write ``message`` to the Redis inboxes of the group's members in other
+        processes. Returns whether there were any.
+        """
+        key = self._group_key(group)
+        connection = self.connection(self.consistent_hash(group))
+        names = await connection.zrangebyscore(key, min=int(time.time()) - self.group_expiry, max="+inf")
+        remote = [n for n in (x.decode("utf8") for x in names) if not self.is_local(n)]
+        if not remote:
+            return False
+
+        by_connection, messages, capacities = self._map_channel_keys_to_connection(remote, message)
+        now = time.time()
+        for index, keys in by_connection.items():
+            over = await self.connection(index).eval(
+                GROUP_SEND_LUA, len(keys), *keys,
+                *[messages[k] for k in keys], *[capacities[k] for k in keys], now, self.expiry,
+            )
+            if over:
+                logger.info("%s of %s channels over capacity in group %s", over, len(remote), group)
+        return True
+
+    async def flush(self):
+        self.local_groups.clear()
+        self._forward_locks.clear()
+        with self._held_lock:
+            self._held.clear()
+        await super().flush()
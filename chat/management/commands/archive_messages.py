@@ -0,0 +1,55 @@
+# chat/management/commands/archive_messages.py
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from chat import archive
+from chat.cache import get_history_cache
+from chat.models import Room
+
+
+class Command(BaseCommand):
+    help = (
+        "Chuyển tin nhắn cũ hơn CHAT_ARCHIVE_AFTER_DAYS ra tệp nén theo phòng/tháng "
+        "(chat/archive.py). Dùng --every để chạy định kỳ như một tiến trình nền."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--days", type=int, default=None, help="Mặc định CHAT_ARCHIVE_AFTER_DAYS")
+        parser.add_argument("--batch-size", type=int, default=archive.BATCH_SIZE)
+        parser.add_argument("--room", action="append", help="Chỉ lưu trữ phòng này (lặp lại được)")
+        parser.add_argument("--every", type=float, default=0, help="Chạy lại sau mỗi N giây (0 = chạy một lần)")
+
+    def handle(self, *args, **options):
+        if not archive.archive_configured():
+            # the segments become the only copy of the messages they hold
+            raise CommandError("Set CHAT_ARCHIVE_ROOT to a persistent disk shared with the web processes first.")
+        days = options["days"] if options["days"] is not None else getattr(settings, "CHAT_ARCHIVE_AFTER_DAYS", 180)
+        while True:
+            self.run_once(days, options)
+            if not options["every"]:
+                return
+            time.sleep(options["every"])
+
+    def run_once(self, days, options):
+        cutoff = timezone.now() - timedelta(days=days)
+        room_ids = None
+        if options["room"]:
+            room_ids = Room.objects.filter(name__in=options["room"]).values_list("id", flat=True)
+
+        started = time.monotonic()
+        total = 0
+        names = dict(Room.objects.values_list("id", "name"))
+        for room_id, moved in archive.archive_older_than(cutoff, options["batch_size"], room_ids):
+            total += moved
+            # the recent-history ring may hold rows that are now archived
+            get_history_cache().invalidate(names.get(room_id, ""))
+            self.stdout.write(f"room {names.get(room_id, room_id)}: {moved} archived")
+
+        rate = total / max(time.monotonic() - started, 1e-6)
+        self.stdout.write(self.style.SUCCESS(
+            f"Done: {total} messages older than {cutoff:%Y-%m-%d} archived ({rate:.0f} rows/s)."
+        ))
@@ -0,0 +1,68 @@
+# chat/management/commands/bench_fanout.py
+import asyncio
+import json
+import time
+
+from django.core.management.base import BaseCommand
+
+from chat.consumers import ChatConsumer
+from chat.frames import frame_event
+
+
+class Command(BaseCommand):
+    help = "Đo CPU cho mỗi tin nhắn khi phát tới cả phòng: json.dumps từng socket so với frame mã hóa một lần."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--sizes", default="10,100,500,2000", help="Số thành viên mỗi phòng, cách nhau bởi dấu phẩy")
+        parser.add_argument("--messages", type=int, default=200)
+
+    def handle(self, *args, **options):
+        sizes = [int(s) for s in options["sizes"].split(",")]
+        self.stdout.write(f"{'members':>8} {'per-socket dumps':>18} {'encode once':>14} {'speedup':>8}")
+        for size in sizes:
+            legacy, once = asyncio.run(self.run(size, options["messages"]))
+            self.stdout.write(f"{size:>8} {legacy * 1e6:>15.1f} us {once * 1e6:>11.1f} us {legacy / once:>7.1f}x")
+
+    async def run(self, size, messages):
+        sent = []
+
+        async def base_send(message):
+            sent.append(message)
+
+        consumers = []
+        for _ in range(size):
+            consumer = ChatConsumer()
+            consumer.base_send = base_send
+            consumers.append(consumer)
+
+        payload = {
+            "type": "chat",
+            "id": 123456,
+            "username": "alice",
+            "message": "Xin chào mọi người! " * 4,
+            "timestamp": "10:42 16/10/2026",
+        }
+
+        # Previous behaviour: every member rebuilds the dict and dumps it.
+        start = time.process_time()
+        for _ in range(messages):
+            event = dict(payload, type="broadcast_chat")
+            for consumer in consumers:
+                await consumer.send(text_data=json.dumps({
+                    "type": "chat",
+                    "id": event.get("id"),
+                    "username": event.get("username"),
+                    "message": event.get("message"),
+                    "timestamp": event.get("timestamp"),
+                }))
+            sent.clear()
+        legacy = (time.process_time() - start) / messages
+
+        start = time.process_time()
+        for _ in range(messages):
+            event = frame_event(payload)
+            for consumer in consumers:
+                await consumer.broadcast_frame(event)
+            sent.clear()
+        once = (time.process_time() - start) / messages
+        return legacy, once
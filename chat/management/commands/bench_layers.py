@@ -0,0 +1,89 @@
+# chat/management/commands/bench_layers.py
+import asyncio
+import time
+
+from channels_redis.core import RedisChannelLayer
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from chat.layers import HybridChannelLayer
+
+LAYERS = {"redis": RedisChannelLayer, "hybrid": HybridChannelLayer}
+
+
+class Command(BaseCommand):
+    help = (
+        "So sánh phát tin tới cả phòng qua RedisChannelLayer và HybridChannelLayer (chat/layers.py). "
+        "Một phần thành viên (--remote) nằm ở một channel layer khác, như một tiến trình daphne khác."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--members", type=int, default=200)
+        parser.add_argument("--messages", type=int, default=50)
+        parser.add_argument("--remote", default="0,0.5,1", help="Tỉ lệ thành viên ở tiến trình khác, cách nhau bởi dấu phẩy")
+        parser.add_argument("--hosts", help="Redis URL, cách nhau bởi dấu phẩy (mặc định CHAT_CHANNEL_SHARDS)")
+        parser.add_argument("--fake", type=int, default=0, help="Dùng N máy chủ fakeredis trong bộ nhớ thay cho Redis thật")
+
+    def handle(self, *args, **options):
+        hosts = options["hosts"].split(",") if options["hosts"] else list(settings.CHAT_CHANNEL_SHARDS)
+        servers = None
+        if options["fake"]:
+            try:
+                import fakeredis
+                import lupa  # noqa: F401
+            except ImportError:
+                raise CommandError("--fake cần fakeredis và lupa")
+            servers = [fakeredis.FakeServer() for _ in range(options["fake"])]
+            hosts = [f"redis://fake-{i}" for i in range(options["fake"])]
+
+        self.stdout.write(f"{'layer':>7} {'remote':>7} {'ms/message':>11} {'deliveries/s':>13}")
+        for share in [float(s) for s in options["remote"].split(",")]:
+            for name, base in LAYERS.items():
+                layer_class = base if servers is None else fake_layer(base, servers)
+                elapsed = asyncio.run(self.run(layer_class, hosts, options["members"], share, options["messages"]))
+                per_message = elapsed / options["messages"]
+                rate = options["members"] * options["messages"] / elapsed
+                self.stdout.write(f"{name:>7} {share:>7.0%} {per_message * 1e3:>11.2f} {rate:>13.0f}")
+
+    async def run(self, layer_class, hosts, members, share, messages):
+        capacity = messages + 10
+        sender = layer_class(hosts=hosts, capacity=capacity)
+        other = layer_class(hosts=hosts, capacity=capacity)
+        group = f"chat_bench_{time.monotonic_ns()}"
+        remote = int(members * share)
+
+        joined = []
+        for i in range(members):
+            layer = other if i < remote else sender
+            channel = await layer.new_channel()
+            await layer.group_add(group, channel)
+            joined.append((layer, channel))
+
+        async def drain(layer, channel):
+            for _ in range(messages):
+                await layer.receive(channel)
+
+        receivers = [asyncio.ensure_future(drain(layer, channel)) for layer, channel in joined]
+        frame = '{"type":"chat","message":"' + "x" * 200 + '"}'
+        start = time.perf_counter()
+        for n in range(messages):
+            await sender.group_send(group, {"type": "broadcast_frame", "frame": frame, "n": n})
+        await asyncio.gather(*receivers)
+        elapsed = time.perf_counter() - start
+
+        for layer, channel in joined:
+            await layer.group_discard(group, channel)
+        await sender.close_pools()
+        await other.close_pools()
+        return elapsed
+
+
+def fake_layer(base, servers):
+    import fakeredis
+
+    class FakeLayer(base):
+        def create_pool(self, index):
+            return fakeredis.aioredis.FakeRedis(server=servers[index]).connection_pool
+
+    FakeLayer.__name__ = base.__name__
+    return FakeLayer
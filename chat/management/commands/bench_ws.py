@@ -0,0 +1,94 @@
+# chat/management/commands/bench_ws.py
+import asyncio
+import json
+import shutil
+import tempfile
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test.utils import override_settings
+
+from chat.bench import run_benchmark, save_result
+from chat.cache import reset_history_cache
+from chat.directory import reset_directory_cache
+from chat.presence import reset_presence
+from chat.ratelimit import reset_user_limiter
+from chat.rooms import reset_room_cache
+
+
+class Command(BaseCommand):
+    help = (
+        "Tải thử WebSocket trong tiến trình: N phòng x M client qua ASGI application "
+        "(connect, lịch sử, chat, typing, ảnh). Chạy trên database test riêng và "
+        "ghi kết quả vào file JSON lines để so sánh giữa các commit."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--rooms", type=int, default=4)
+        parser.add_argument("--clients", type=int, default=25, help="Số client mỗi phòng")
+        parser.add_argument("--messages", type=int, default=5, help="Số tin mỗi người gửi")
+        parser.add_argument("--senders", type=int, default=5, help="Số người gửi mỗi phòng")
+        parser.add_argument("--typing-rounds", type=int, default=3)
+        parser.add_argument("--images", type=int, default=1, help="Số ảnh tải lên mỗi phòng (0 để bỏ qua)")
+        parser.add_argument("--timeout", type=float, default=60.0)
+        parser.add_argument(
+            "--layer", choices=["memory", "configured"], default="memory",
+            help="memory = InMemoryChannelLayer (như CHANNEL_LAYERS_OVERRIDE); configured = CHANNEL_LAYERS hiện tại",
+        )
+        parser.add_argument("--output", default=str(settings.BASE_DIR / "bench_results.jsonl"))
+        parser.add_argument("--keep-db", action="store_true", help="Giữ lại database test sau khi chạy")
+
+    def handle(self, *args, **options):
+        media_root = tempfile.mkdtemp(prefix="bench-media-")
+        # the load generator sends far faster than any client may (chat/ratelimit.py)
+        overrides = {"MEDIA_ROOT": media_root, "CHAT_RATE_LIMITS": {}, "CHAT_USER_RATE_LIMITS": {}}
+        if options["layer"] == "memory":
+            overrides.update({
+                "CHANNEL_LAYERS": {"default": {
+                    "BACKEND": "channels.layers.InMemoryChannelLayer",
+                    "CONFIG": {"capacity": 10000},
+                }},
+                "CHAT_HISTORY_CACHE_URL": None,
+                "CHAT_PRESENCE_URL": None,
+                "CHAT_DIRECTORY_CACHE_URL": None,
+            })
+
+        old_name = connection.settings_dict["NAME"]
+        connection.creation.create_test_db(verbosity=0, autoclobber=True, keepdb=options["keep_db"])
+        try:
+            with override_settings(**overrides):
+                reset_directory_cache()
+                reset_history_cache()
+                reset_presence()
+                reset_room_cache()
+                reset_user_limiter()
+                from chat_project.asgi import application
+
+                results = asyncio.run(run_benchmark(
+                    application,
+                    rooms=options["rooms"],
+                    clients_per_room=options["clients"],
+                    messages=options["messages"],
+                    senders=options["senders"],
+                    typing_rounds=options["typing_rounds"],
+                    images=options["images"],
+                    timeout=options["timeout"],
+                    log=self.stdout.write,
+                ))
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0, keepdb=options["keep_db"])
+            shutil.rmtree(media_root, ignore_errors=True)
+
+        previous = save_result(options["output"], results)
+        self.stdout.write(self.style.SUCCESS(f"Đã lưu kết quả vào {options['output']}"))
+        if previous:
+            self.stdout.write(f"So với lần chạy trước ({previous.get('revision')}, {previous.get('recorded_at')}):")
+            for section in ("connect", "chat", "image"):
+                if section in results and section in previous:
+                    for key in ("p50_ms", "p99_ms"):
+                        old, new = previous[section].get(key), results[section].get(key)
+                        if old and new:
+                            self.stdout.write(f"  {section}.{key}: {old} -> {new} ({(new - old) / old:+.0%})")
+        else:
+            self.stdout.write(json.dumps(results, indent=2))
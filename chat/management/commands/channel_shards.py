@@ -0,0 +1,60 @@
+# chat/management/commands/channel_shards.py
+from collections import Counter
+
+from channels_redis.utils import decode_hosts
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from chat.layers import REPLICAS, HashRing, shard_name
+from chat.models import Room
+
+
+class Command(BaseCommand):
+    help = (
+        "Xem các phòng chat được chia trên các shard Redis của channel layer (chat/layers.py). "
+        "Với --hosts, cho biết bao nhiêu phòng sẽ chuyển shard nếu đổi sang danh sách mới."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--hosts", help="Danh sách shard mới, cách nhau bởi dấu phẩy")
+        parser.add_argument("--replicas", type=int, default=REPLICAS)
+
+    def handle(self, *args, **options):
+        config = settings.CHANNEL_LAYERS.get("default", {}).get("CONFIG", {})
+        current = [shard_name(h) for h in decode_hosts(config.get("hosts"))]
+        groups = [f"chat_{name}" for name in Room.objects.values_list("name", flat=True).iterator()]
+        if not groups:
+            self.stdout.write("Chưa có phòng nào.")
+            return
+
+        ring = HashRing(current, options["replicas"])
+        before = [ring.node(g) for g in groups]
+        self.report("Hiện tại", current, before)
+        if not options["hosts"]:
+            return
+
+        proposed = [shard_name(h) for h in decode_hosts([u.strip() for u in options["hosts"].split(",") if u.strip()])]
+        if not proposed:
+            raise CommandError("--hosts không có shard nào")
+        new_ring = HashRing(proposed, options["replicas"])
+        after = [new_ring.node(g) for g in groups]
+        self.report("Sau khi đổi", proposed, after)
+
+        moves = Counter(
+            (current[old], proposed[new]) for old, new in zip(before, after) if current[old] != proposed[new]
+        )
+        moved = sum(moves.values())
+        self.stdout.write(f"\nPhòng chuyển shard: {moved}/{len(groups)} ({moved / len(groups):.1%})")
+        for (src, dst), n in moves.most_common():
+            self.stdout.write(f"  {src} -> {dst}: {n}")
+        self.stdout.write(
+            "\nTriển khai danh sách mới cho mọi tiến trình cùng lúc; client kết nối lại với since= "
+            "sẽ vào nhóm trên shard mới, khóa nhóm cũ tự hết hạn sau group_expiry."
+        )
+
+    def report(self, title, names, owners):
+        counts = Counter(owners)
+        self.stdout.write(f"{title}:")
+        for index, name in enumerate(names):
+            n = counts.get(index, 0)
+            self.stdout.write(f"  {name:<40} {n:>7} phòng ({n / len(owners):.1%})")
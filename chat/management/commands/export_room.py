@@ -0,0 +1,40 @@
+# chat/management/commands/export_room.py
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from chat import transfer
+from chat.models import Room
+
+
+class Command(BaseCommand):
+    help = (
+        "Xuất toàn bộ lịch sử một phòng ra tệp NDJSON nén gzip (chat/transfer.py), "
+        "đọc theo con trỏ phía máy chủ nên chạy được với hàng triệu tin nhắn."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("room", help="Tên phòng")
+        parser.add_argument("output", help="Tệp .ndjson.gz đích, hoặc - cho stdout")
+        parser.add_argument("--chunk-size", type=int, default=transfer.BATCH_SIZE)
+        parser.add_argument("--bundle", action="store_true", help="Nhúng ảnh/tệp đính kèm vào bản xuất")
+        parser.add_argument("--no-archive", action="store_true", help="Bỏ qua tin nhắn đã lưu trữ (chat/archive.py)")
+
+    def handle(self, *args, **options):
+        room = Room.objects.filter(name=options["room"]).first()
+        if room is None:
+            raise CommandError(f"Room {options['room']!r} does not exist")
+        # progress goes to stderr when the dump itself goes to stdout
+        log = self.stderr if options["output"] == "-" else self.stdout
+
+        started = time.monotonic()
+        count = 0
+        with transfer.open_dump(options["output"], "w") as out:
+            for count in transfer.export_room(
+                room, out, bundle=options["bundle"], chunk_size=options["chunk_size"],
+                include_archive=not options["no_archive"],
+            ):
+                rate = count / max(time.monotonic() - started, 1e-6)
+                log.write(f"{count} messages exported ({rate:.0f} rows/s)")
+
+        log.write(self.style.SUCCESS(f"Done: {count} messages of {room.name} exported."))
@@ -0,0 +1,41 @@
+# chat/management/commands/import_room.py
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from chat import transfer
+from chat.cache import get_history_cache
+
+
+class Command(BaseCommand):
+    help = (
+        "Nhập lịch sử phòng từ tệp do export_room tạo ra, đọc dần từng dòng và "
+        "ghi bằng bulk_create theo khối."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("input", help="Tệp .ndjson.gz, hoặc - cho stdin")
+        parser.add_argument("--room", help="Nhập vào phòng tên này (mặc định tên trong bản xuất)")
+        parser.add_argument("--append", action="store_true", help="Thêm vào phòng đã tồn tại")
+        parser.add_argument("--create-users", action="store_true", help="Tạo người dùng chưa có (không mật khẩu)")
+        parser.add_argument("--batch-size", type=int, default=transfer.BATCH_SIZE)
+
+    def handle(self, *args, **options):
+        started = time.monotonic()
+        room, count = None, 0
+        try:
+            with transfer.open_dump(options["input"], "r") as lines:
+                for room, count in transfer.import_room(
+                    lines, name=options["room"], append=options["append"],
+                    create_users=options["create_users"], batch_size=options["batch_size"],
+                ):
+                    rate = count / max(time.monotonic() - started, 1e-6)
+                    self.stdout.write(f"{count} messages imported ({rate:.0f} rows/s)")
+        except transfer.TransferError as exc:
+            # batches written before the error stay; rerun into a fresh room or with --append
+            raise CommandError(f"{exc} ({count} messages imported)") from exc
+        finally:
+            if room is not None:
+                get_history_cache().invalidate(room.name)
+
+        self.stdout.write(self.style.SUCCESS(f"Done: {count} messages imported into {room.name}."))
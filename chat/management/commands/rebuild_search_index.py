@@ -0,0 +1,45 @@
+# chat/management/commands/rebuild_search_index.py
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from chat import crypto
+from chat.models import Message
+from chat.search import index_messages, search_available
+
+
+class Command(BaseCommand):
+    help = "Lập lại chỉ mục tìm kiếm cho tin nhắn đã có (giải mã theo từng khối id)."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--chunk-size", type=int, default=2000)
+        parser.add_argument("--start-id", type=int, default=0)
+
+    def handle(self, *args, **options):
+        if not search_available():
+            self.stderr.write("Search is not supported on this database.")
+            return
+
+        last_id = options["start_id"]
+        indexed = 0
+        started = time.monotonic()
+        while True:
+            rows = list(
+                Message.objects.filter(pk__gt=last_id)
+                .exclude(content__isnull=True).exclude(content="")
+                .order_by("pk").values_list("id", "content")[:options["chunk_size"]]
+            )
+            if not rows:
+                break
+            last_id = rows[-1][0]
+            texts = crypto.decrypt_many(token for _, token in rows)
+            with transaction.atomic():
+                index_messages(
+                    (pk, text) for (pk, _), text in zip(rows, texts) if text != crypto.DECRYPT_ERROR
+                )
+            indexed += len(rows)
+            rate = indexed / max(time.monotonic() - started, 1e-6)
+            self.stdout.write(f"id <= {last_id}: {indexed} indexed ({rate:.0f} rows/s)")
+
+        self.stdout.write(self.style.SUCCESS(f"Done: {indexed} messages indexed."))
@@ -0,0 +1,52 @@
+# chat/management/commands/rotate_message_keys.py
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from chat import crypto
+from chat.models import Message
+
+
+class Command(BaseCommand):
+    help = (
+        "Mã hóa lại Message.content bằng khóa đầu tiên trong CHAT_ENCRYPTION_KEYS, "
+        "theo từng khối id để chạy được trên hàng triệu dòng."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--chunk-size", type=int, default=2000)
+        parser.add_argument("--start-id", type=int, default=0, help="Tiếp tục từ id này (lần chạy trước bị dừng)")
+        parser.add_argument("--sleep", type=float, default=0.0, help="Nghỉ giữa các khối (giây) để giảm tải DB")
+
+    def handle(self, *args, **options):
+        chunk_size = options["chunk_size"]
+        last_id = options["start_id"]
+        scanned = rotated = 0
+        started = time.monotonic()
+
+        while True:
+            rows = list(
+                Message.objects.filter(pk__gt=last_id)
+                .exclude(content__isnull=True).exclude(content="")
+                .order_by("pk").only("id", "content")[:chunk_size]
+            )
+            if not rows:
+                break
+            last_id = rows[-1].pk
+            scanned += len(rows)
+
+            stale = [m for m in rows if crypto.needs_rotation(m.content)]
+            for m in stale:
+                m.content = crypto.rotate(m.content)
+            if stale:
+                with transaction.atomic():
+                    Message.objects.bulk_update(stale, ["content"], batch_size=500)
+                rotated += len(stale)
+
+            rate = scanned / max(time.monotonic() - started, 1e-6)
+            self.stdout.write(f"id <= {last_id}: {scanned} scanned, {rotated} re-encrypted ({rate:.0f} rows/s)")
+            if options["sleep"]:
+                time.sleep(options["sleep"])
+
+        self.stdout.write(self.style.SUCCESS(f"Done: {rotated}/{scanned} rows re-encrypted."))
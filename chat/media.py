@@ -0,0 +1,167 @@
+# chat/media.py
+"""
+Async serving of MEDIA_ROOT (``chat_images/``, ``chat_files/``, ``blobs/``).
+
+``serve_media`` streams a file in CHUNK_SIZE pieces read in a worker thread,
+so a large download never sits in memory or blocks the event loop. It
+answers ``Range: bytes=...`` with 206 (one range; ``If-Range`` honoured;
+several ranges get the whole file), ``If-None-Match`` / ``If-Modified-Since``
+with 304, and sets ``ETag``, ``Last-Modified`` and ``Cache-Control``.
+Content-addressed blobs (chat/attachments.py) are immutable; other media
+get CHAT_MEDIA_MAX_AGE. Types a browser could run as a page are sent as
+attachments.
+
+With CHAT_MEDIA_ACCEL = "nginx" (``X-Accel-Redirect`` to
+CHAT_MEDIA_ACCEL_PREFIX, an ``internal`` location aliased to MEDIA_ROOT) or
+"sendfile" (``X-Sendfile`` with the absolute path, Apache/lighttpd), the view
+only checks the file and sets headers and the front server sends the bytes,
+ranges included.
+"""
+import asyncio
+import mimetypes
+import os
+import re
+import stat
+from urllib.parse import quote
+
+from django.conf import settings
+from django.core.exceptions import SuspiciousFileOperation
+from django.http import Http404, HttpResponse, HttpResponseNotAllowed, StreamingHttpResponse
+from django.utils._os import safe_join
+from django.utils.http import http_date, parse_http_date_safe, quote_etag
+
+from .attachments import CACHE_CONTROL, PREFIX
+
+CHUNK_SIZE = 256 * 1024
+RANGE_RE = re.compile(r"^bytes=(\d*)-(\d*)$")
+# served inline; anything else (html, svg, js...) is forced to download
+INLINE_TYPES = ("image/", "video/", "audio/", "application/pdf", "text/plain")
+ENCODED_TYPES = {
+    "bzip2": "application/x-bzip",
+    "gzip": "application/gzip",
+    "xz": "application/x-xz",
+    "br": "application/x-brotli",
+    "compress": "application/x-compress",
+}
+
+
+def max_age():
+    return getattr(settings, "CHAT_MEDIA_MAX_AGE", 30 * 24 * 3600)
+
+
+def _etag(st):
+    return quote_etag(f"{st.st_size:x}-{st.st_mtime_ns:x}")
+
+
+def _cache_control(path):
+    return CACHE_CONTROL if path.startswith(PREFIX + "/") else f"public, max-age={max_age()}"
+
+
+def not_modified(request, etag, mtime):
+    """True when the client's copy is current (If-None-Match wins over If-Modified-Since)."""
+    if_none_match = request.headers.get("If-None-Match")
+    if if_none_match is not None:
+        tags = [t.strip() for t in if_none_match.split(",")]
+        return "*" in tags or etag in tags or f"W/{etag}" in tags
+    since = parse_http_date_safe(request.headers.get("If-Modified-Since", ""))
+    return since is not None and int(mtime) <= since
+
+
+def byte_range(request, size, etag, mtime):
+    """
+    ``(start, end)`` inclusive for a satisfiable single Range, None to send
+    the whole file, or ``False`` when the range cannot be satisfied.
+    """
+    header = request.headers.get("Range")
+    if not header or size == 0:
+        return None
+    if_range = request.headers.get("If-Range")
+    if if_range:
+        date = parse_http_date_safe(if_range)
+        if if_range != etag and (date is None or int(mtime) > date):
+            return None  # the client's partial copy is stale
+    match = RANGE_RE.match(header.strip())
+    if match is None:
+        return None  # several ranges or another unit: the whole file is a valid answer
+    first, last = match.groups()
+    if not first:
+        if not last or int(last) == 0:
+            return False
+        return max(size - int(last), 0), size - 1
+    start = int(first)
+    end = min(int(last), size - 1) if last else size - 1
+    if start >= size or (last and int(last) < start):
+        return False
+    return start, end
+
+
+async def _stream(path, start, length):
+    fh = await asyncio.to_thread(open, path, "rb")
+    try:
+        await asyncio.to_thread(fh.seek, start)
+        while length > 0:
+            chunk = await asyncio.to_thread(fh.read, min(CHUNK_SIZE, length))
+            if not chunk:
+                break
+            length -= len(chunk)
+            yield chunk
+    finally:
+        await asyncio.to_thread(fh.close)
+
+
+def _headers(response, path, st, etag, content_type):
+    response["ETag"] = etag
+    response["Last-Modified"] = http_date(st.st_mtime)
+    response["Cache-Control"] = _cache_control(path)
+    response["Accept-Ranges"] = "bytes"
+    if content_type and not content_type.startswith(INLINE_TYPES):
+        response["Content-Disposition"] = f"attachment; filename*=UTF-8''{quote(os.path.basename(path))}"
+    return response
+
+
+async def serve_media(request, path):
+    """``MEDIA_URL<path>``: stream ``MEDIA_ROOT/<path>`` with ranges, validators and cache headers."""
+    if request.method not in ("GET", "HEAD"):
+        return HttpResponseNotAllowed(["GET", "HEAD"])
+    try:
+        full_path = safe_join(settings.MEDIA_ROOT, path)
+        st = await asyncio.to_thread(os.stat, full_path)
+    except (OSError, ValueError, SuspiciousFileOperation) as exc:  # missing, or outside MEDIA_ROOT
+        raise Http404(path) from exc
+    if not stat.S_ISREG(st.st_mode):
+        raise Http404(path)
+
+    etag = _etag(st)
+    content_type, encoding = mimetypes.guess_type(full_path)
+    # a compressed file is sent as such, not for the browser to unpack (as FileResponse does)
+    content_type = ENCODED_TYPES.get(encoding) or content_type or "application/octet-stream"
+    if not_modified(request, etag, st.st_mtime):
+        return _headers(HttpResponse(status=304), path, st, etag, None)
+
+    accel = getattr(settings, "CHAT_MEDIA_ACCEL", "")
+    if accel:
+        response = HttpResponse(content_type=content_type)
+        if accel == "sendfile":
+            response["X-Sendfile"] = full_path
+        else:
+            prefix = getattr(settings, "CHAT_MEDIA_ACCEL_PREFIX", "/protected-media/")
+            response["X-Accel-Redirect"] = prefix.rstrip("/") + "/" + quote(path)
+        return _headers(response, path, st, etag, content_type)
+
+    span = byte_range(request, st.st_size, etag, st.st_mtime)
+    if span is False:
+        response = HttpResponse(status=416)
+        response["Content-Range"] = f"bytes */{st.st_size}"
+        return response
+    start, end = span or (0, st.st_size - 1)
+    length = end - start + 1 if st.st_size else 0
+
+    if request.method == "HEAD":
+        response = HttpResponse(content_type=content_type)
+    else:
+        response = StreamingHttpResponse(_stream(full_path, start, length), content_type=content_type)
+    response["Content-Length"] = str(length)
+    if span:
+        response.status_code = 206
+        response["Content-Range"] = f"bytes {start}-{end}/{st.st_size}"
+    return _headers(response, path, st, etag, content_type)
@@ -0,0 +1,313 @@
+# chat/metrics.py
+"""
+In-process metrics for the chat server, exposed in the Prometheus text format
+on ``/metrics`` (see ``metrics_view``).
+
+Counters, gauges and histograms live in a module-level registry and are
+updated from ChatConsumer: connections per room, received events per type,
+latency of every DB wrapper and broadcast handler (``timed``), group_send
+latency and outbound frames/bytes. Executor queue depths and the write-behind
+persister's stats are read when the page is rendered.
+
+Values are per process; with several ASGI workers scrape each one (or put
+them behind distinct targets). No client library is needed.
+"""
+import functools
+from bisect import bisect_left
+import hmac
+import math
+import threading
+import time
+
+from asgiref.sync import SyncToAsync
+from django.conf import settings
+from django.http import HttpResponse, HttpResponseForbidden
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in pairs) + "}"
+
+
+def _number(value):
+    return "+Inf" if value == math.inf else str(value)
+
+
+class Metric:
+    kind = None
+
+    def __init__(self, name, doc, labelnames=()):
+        self.name = name
+        self.doc = doc
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        if len(labels) != len(self.labelnames):
+            raise ValueError(f"{self.name} expects labels {self.labelnames}")
+        return tuple(map(str, labels)) if labels else ()
+
+    def header(self):
+        return [f"# HELP {self.name} {self.doc}", f"# TYPE {self.name} {self.kind}"]
+
+    def clear(self):
+        with self._lock:
+            self._values.clear()
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, *labels, amount=1):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, *labels):
+        return self._values.get(self._key(labels), 0)
+
+    def render(self):
+        with self._lock:
+            items = sorted(self._values.items())
+        return self.header() + [
+            f"{self.name}{_labels(self.labelnames, key)} {_number(value)}" for key, value in items
+        ]
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def dec(self, *labels, amount=1):
+        key = self._key(labels)
+        with self._lock:
+            value = self._values.get(key, 0) - amount
+            # drop series that return to zero (e.g. rooms nobody is in any more)
+            if value:
+                self._values[key] = value
+            else:
+                self._values.pop(key, None)
+
+    def set(self, *labels, value):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, doc, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, doc, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+
+    def observe(self, *labels, value):
+        key = self._key(labels)
+        with self._lock:
+            self._observe(key, value)
+
+    def _observe(self, key, value):
+        state = self._values.get(key)
+        if state is None:
+            state = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+        state[0][bisect_left(self.buckets, value)] += 1
+        state[1] += value
+        state[2] += 1
+
+    def count(self, *labels):
+        state = self._values.get(self._key(labels))
+        return state[2] if state else 0
+
+    def render(self):
+        with self._lock:
+            items = sorted((k, (list(v[0]), v[1], v[2])) for k, v in self._values.items())
+        lines = self.header()
+        for key, (counts, total, count) in items:
+            cumulative = 0
+            for bound, n in zip(self.buckets, counts):
+                cumulative += n
+                le = _labels(self.labelnames, key, [("le", _number(bound))])
+                lines.append(f"{self.name}_bucket{le} {cumulative}")
+            lines.append(f"{self.name}_sum{_labels(self.labelnames, key)} {total}")
+            lines.append(f"{self.name}_count{_labels(self.labelnames, key)} {count}")
+        return lines
+
+
+# ---------------- registry -----------------
+_metrics = []
+_collectors = []
+
+
+def register(metric):
+    _metrics.append(metric)
+    return metric
+
+
+def collector(func):
+    """Register ``func() -> [(name, kind, doc, [(labels dict, value)])]``, called on render."""
+    _collectors.append(func)
+    return func
+
+
+def render():
+    lines = []
+    for metric in _metrics:
+        lines.extend(metric.render())
+    for func in _collectors:
+        for name, kind, doc, samples in func():
+            lines.append(f"# HELP {name} {doc}")
+            lines.append(f"# TYPE {name} {kind}")
+            for labels, value in samples:
+                lines.append(f"{name}{_labels(labels.keys(), labels.values())} {_number(value)}")
+    return "\n".join(lines) + "\n"
+
+
+def reset():
+    for metric in _metrics:
+        metric.clear()
+
+
+CONNECTIONS = register(Gauge("chat_connections", "Open WebSocket connections per room.", ["room"]))
+RECEIVED = register(Counter("chat_received_events_total", "Inbound WebSocket events by type.", ["type"]))
+HANDLER_SECONDS = register(Histogram(
+    "chat_handler_seconds", "Latency of consumer DB wrappers and broadcast handlers, queueing included.", ["handler"],
+))
+HANDLER_INFLIGHT = register(Gauge("chat_handler_inflight", "Handler calls started but not finished.", ["handler"]))
+HANDLER_ERRORS = register(Counter("chat_handler_errors_total", "Handler calls that raised.", ["handler"]))
+GROUP_SEND_SECONDS = register(Histogram("chat_group_send_seconds", "Latency of channel layer group_send.", ["kind"]))
+OUTBOUND_FRAMES = register(Counter("chat_outbound_frames_total", "Frames written to WebSockets."))
+OUTBOUND_BYTES = register(Counter("chat_outbound_bytes_total", "Bytes written to WebSockets."))
+THROTTLED = register(Counter(
+    "chat_throttled_total", "Inbound events dropped (or connections closed) by rate and size limits.", ["event", "reason"],
+))
+SLOW_CONSUMERS = register(Counter(
+    "chat_slow_consumer_total", "Broadcasts to a member whose outbound queue was full, by policy.", ["action"],
+))
+HANDSHAKE_USERS = register(Counter(
+    "chat_handshake_users_total", "WebSocket handshakes by how the user was resolved.", ["result"],
+))
+RESYNCS = register(Counter(
+    "chat_resyncs_total", "Reconnects with since=, by where the missed messages came from.", ["source"],
+))
+
+# received event types outside this set are counted as "other" to bound label cardinality
+EVENT_TYPES = {"chat", "typing", "read", "load_older", "presence", "search", "image", "file", "binary"}
+
+
+def timed(handler):
+    """Record latency, in-flight count and errors of an async method as ``handler``."""
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            HANDLER_INFLIGHT.inc(handler)
+            start = time.perf_counter()
+            try:
+                return await func(*args, **kwargs)
+            except Exception:
+                HANDLER_ERRORS.inc(handler)
+                raise
+            finally:
+                HANDLER_SECONDS.observe(handler, value=time.perf_counter() - start)
+                HANDLER_INFLIGHT.dec(handler)
+        return wrapper
+    return decorator
+
+
+def count_received(msg_type):
+    RECEIVED.inc(msg_type if msg_type in EVENT_TYPES else "other")
+
+
+# Outbound frames are counted once per socket per message, so these skip the
+# label handling (render() and other threads still need the lock).
+_BROADCAST_KEY = ("broadcast_frame",)
+
+
+def count_outbound(size):
+    with OUTBOUND_FRAMES._lock:
+        frames = OUTBOUND_FRAMES._values
+        frames[()] = frames.get((), 0) + 1
+    with OUTBOUND_BYTES._lock:
+        sent = OUTBOUND_BYTES._values
+        sent[()] = sent.get((), 0) + size
+
+
+def observe_broadcast(seconds):
+    with HANDLER_SECONDS._lock:
+        HANDLER_SECONDS._observe(_BROADCAST_KEY, seconds)
+
+
+# ---------------- collectors -----------------
+def _queue_depth(executor):
+    queue = getattr(executor, "_work_queue", None)
+    return queue.qsize() if queue is not None else 0
+
+
+@collector
+def _executors():
+    # database_sync_to_async runs on asgiref's thread-sensitive executor(s)
+    sync_depth = _queue_depth(SyncToAsync.single_thread_executor) + sum(
+        _queue_depth(e) for e in list(SyncToAsync.context_to_thread_executor.values())
+    )
+    samples = [({"pool": "database_sync_to_async"}, sync_depth)]
+
+    from . import crypto
+    if crypto._pool is not None:
+        samples.append(({"pool": "decrypt"}, _queue_depth(crypto._pool)))
+    return [("chat_executor_queue_depth", "gauge", "Work items waiting for a thread.", samples)]
+
+
+@collector
+def _persister():
+    from . import persistence
+    if persistence._persister is None:
+        return []
+    stats = persistence._persister.stats()
+    return [
+        ("chat_write_behind_pending", "gauge", "Messages queued for the next bulk insert.",
+         [({}, stats["pending"])]),
+        ("chat_write_behind_oldest_pending_seconds", "gauge", "Age of the oldest queued message.",
+         [({}, stats["oldest_pending_age"])]),
+        ("chat_write_behind_flushed_rows_total", "counter", "Messages written by the persister.",
+         [({}, stats["flushed_rows"])]),
+        ("chat_write_behind_failed_rows_total", "counter", "Messages the persister dropped.",
+         [({}, stats["failed_rows"])]),
+        ("chat_write_behind_sync_flushes_total", "counter", "Sends that wrote a full queue out themselves.",
+         [({}, stats["sync_flushes"])]),
+        ("chat_write_behind_max_flush_lag_seconds", "gauge", "Longest queue-to-disk delay seen.",
+         [({}, stats["max_flush_lag"])]),
+    ]
+
+
+# ---------------- view -----------------
+def _trusted(request):
+    user = getattr(request, "user", None)
+    return (
+        settings.DEBUG
+        or (user is not None and user.is_staff)
+        or request.META.get("REMOTE_ADDR") in getattr(settings, "INTERNAL_IPS", ())
+    )
+
+
+def metrics_view(request):
+    """
+    Prometheus endpoint. With CHAT_METRICS_TOKEN set it requires
+    ``Authorization: Bearer <token>``; without one it is only served in DEBUG,
+    to staff and to INTERNAL_IPS, since label values include room names.
+    """
+    token = getattr(settings, "CHAT_METRICS_TOKEN", "")
+    if token:
+        supplied = request.headers.get("Authorization", "").removeprefix("Bearer ").strip()
+        if not hmac.compare_digest(supplied, token):
+            return HttpResponseForbidden()
+    elif not _trusted(request):
+        return HttpResponseForbidden()
+    return HttpResponse(render(), content_type=CONTENT_TYPE)
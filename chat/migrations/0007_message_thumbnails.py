@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-16 20:28
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0006_alter_message_content'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='message',
+            name='thumbnails',
+            field=models.JSONField(blank=True, default=dict),
+        ),
+    ]
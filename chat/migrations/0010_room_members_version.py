@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-16 20:34
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0009_message_timestamp_default'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='room',
+            name='members_version',
+            field=models.PositiveIntegerField(default=0),
+        ),
+    ]
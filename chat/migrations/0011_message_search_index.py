@@ -0,0 +1,37 @@
+# Full-text index for chat/search.py. Kept outside the model on purpose:
+# PostgreSQL gets a tsvector column + GIN index on chat_message, SQLite an
+# FTS5 table keyed by message id.
+
+from django.db import migrations
+
+
+def create_index(apps, schema_editor):
+    vendor = schema_editor.connection.vendor
+    if vendor == "postgresql":
+        schema_editor.execute("ALTER TABLE chat_message ADD COLUMN search_vector tsvector")
+        schema_editor.execute("CREATE INDEX chat_msg_search_gin ON chat_message USING gin (search_vector)")
+    elif vendor == "sqlite":
+        schema_editor.execute(
+            "CREATE VIRTUAL TABLE chat_message_fts USING fts5("
+            "content, tokenize = 'unicode61 remove_diacritics 2')"
+        )
+
+
+def drop_index(apps, schema_editor):
+    vendor = schema_editor.connection.vendor
+    if vendor == "postgresql":
+        schema_editor.execute("DROP INDEX IF EXISTS chat_msg_search_gin")
+        schema_editor.execute("ALTER TABLE chat_message DROP COLUMN IF EXISTS search_vector")
+    elif vendor == "sqlite":
+        schema_editor.execute("DROP TABLE IF EXISTS chat_message_fts")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0010_room_members_version'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_index, drop_index),
+    ]
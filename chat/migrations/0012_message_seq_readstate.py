@@ -0,0 +1,73 @@
+# Generated by Django 5.2.18 on 2026-10-16 20:48
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+def number_existing_messages(apps, schema_editor):
+    """Give existing messages their per-room seq in (timestamp, id) order."""
+    Room = apps.get_model('chat', 'Room')
+    Message = apps.get_model('chat', 'Message')
+    for room_id in Room.objects.values_list('id', flat=True).iterator():
+        seq = 0
+        batch = []
+        for msg in Message.objects.filter(room_id=room_id).order_by('timestamp', 'id').only('id').iterator(chunk_size=2000):
+            seq += 1
+            msg.seq = seq
+            batch.append(msg)
+            if len(batch) >= 2000:
+                Message.objects.bulk_update(batch, ['seq'])
+                batch = []
+        if batch:
+            Message.objects.bulk_update(batch, ['seq'])
+        Room.objects.filter(pk=room_id).update(message_seq=seq)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0011_message_search_index'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ReadState',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('last_read_id', models.BigIntegerField(default=0)),
+                ('last_read_seq', models.PositiveBigIntegerField(default=0)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='message',
+            name='seq',
+            field=models.PositiveBigIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='room',
+            name='message_seq',
+            field=models.PositiveBigIntegerField(default=0),
+        ),
+        migrations.AddConstraint(
+            model_name='message',
+            constraint=models.UniqueConstraint(fields=('room', 'seq'), name='chat_msg_room_seq'),
+        ),
+        migrations.AddField(
+            model_name='readstate',
+            name='room',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='read_states', to='chat.room'),
+        ),
+        migrations.AddField(
+            model_name='readstate',
+            name='user',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='read_states', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AddConstraint(
+            model_name='readstate',
+            constraint=models.UniqueConstraint(fields=('user', 'room'), name='chat_readstate_user_room'),
+        ),
+        migrations.RunPython(number_existing_messages, migrations.RunPython.noop),
+    ]
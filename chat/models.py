@@ -1,8 +1,10 @@
-from django.db import models
+from django.db import IntegrityError, connection, models, transaction
+from django.db.models import F
 from django.contrib.auth.models import User
 from django.utils import timezone
 from django.contrib.auth.hashers import make_password, check_password
-from cryptography.fernet import Fernet
+
+from . import crypto
 
 class Room(models.Model):
     name = models.CharField(max_length=255, unique=True)
@@ -10,10 +12,35 @@ class Room(models.Model):
     password = models.CharField(max_length=128, blank=True, null=True)
     members = models.ManyToManyField(User, related_name="rooms", blank=True)
     created_by = models.ForeignKey(User, on_delete=models.CASCADE, related_name="created_rooms", null=True, blank=True)  # ✅ ai tạo phòng
+    members_version = models.PositiveIntegerField(default=0)  # tăng mỗi khi danh sách thành viên đổi
+    message_seq = models.PositiveBigIntegerField(default=0)  # seq của tin nhắn mới nhất (chat/readstate.py)
 
     def __str__(self):
         return self.name
 
+    @staticmethod
+    def allocate_seqs(room_id, count=1):
+        """
+        Reserve ``count`` consecutive message seqs in a room and return the
+        first. Call inside the transaction that inserts the messages.
+        """
+        if connection.vendor == "postgresql" or (
+            connection.vendor == "sqlite" and connection.features.can_return_columns_from_insert  # 3.35+
+        ):
+            # one round trip with UPDATE ... RETURNING
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    f"UPDATE {Room._meta.db_table} SET message_seq = message_seq + %s WHERE id = %s RETURNING message_seq",
+                    [count, room_id],
+                )
+                row = cursor.fetchone()
+            if row is None:
+                raise IntegrityError(f"Room {room_id} does not exist")
+            return row[0] - count + 1
+        if not Room.objects.filter(pk=room_id).update(message_seq=F("message_seq") + count):
+            raise IntegrityError(f"Room {room_id} does not exist")
+        return Room.objects.filter(pk=room_id).values_list("message_seq", flat=True).get() - count + 1
+
     def set_password(self, raw_password):
         self.password = make_password(raw_password)
 
@@ -22,17 +49,136 @@ class Room(models.Model):
 
 
 
+class Attachment(models.Model):
+    """Tệp đính kèm lưu theo SHA-256 nội dung, dùng chung giữa các tin nhắn (chat/attachments.py)."""
+    sha256 = models.CharField(max_length=64, unique=True)
+    kind = models.CharField(max_length=10)  # "image" | "file"
+    name = models.CharField(max_length=255)  # blobs/ab/abcdef....webp
+    thumbnails = models.JSONField(default=dict, blank=True)
+    size = models.PositiveBigIntegerField(default=0)
+    refcount = models.PositiveIntegerField(default=0)  # số Message đang trỏ tới
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f"{self.sha256[:12]} x{self.refcount}"
+
+
+
 class Message(models.Model):
     user = models.ForeignKey(User, on_delete=models.CASCADE)
     room = models.ForeignKey(Room, on_delete=models.CASCADE)
-    content = models.TextField(blank=True)
+    content = models.TextField(blank=True, null=True)
     image = models.ImageField(upload_to="chat_images/", null=True, blank=True)
+    thumbnails = models.JSONField(default=dict, blank=True)  # {"160": "chat_images/..._160.webp"}
     file = models.FileField(upload_to="chat_files/", null=True, blank=True)  # ✅ thêm dòng này
-    timestamp = models.DateTimeField(auto_now_add=True)
+    timestamp = models.DateTimeField(default=timezone.now)  # write-behind keeps the send time
+    seq = models.PositiveBigIntegerField(null=True, blank=True)  # 1, 2, 3... trong từng phòng
+    attachment = models.ForeignKey(Attachment, on_delete=models.PROTECT, null=True, blank=True, related_name="messages")
+    filename = models.CharField(max_length=255, blank=True, default="")  # tên gốc của tệp đính kèm
+
+    class Meta:
+        indexes = [
+            # history pages: WHERE room_id = ? ORDER BY timestamp DESC, id DESC
+            models.Index(fields=["room", "timestamp", "id"], name="chat_msg_room_ts_id"),
+        ]
+        constraints = [
+            models.UniqueConstraint(fields=["room", "seq"], name="chat_msg_room_seq"),
+        ]
 
     def __str__(self):
         return f"{self.user.username} - {self.room.name}: {self.content[:30]}"
 
+    # content is encrypted at rest (chat/crypto.py). Instances loaded from the
+    # database hold the token, instances built in code hold plain text; any
+    # assignment to content (new text) marks it as plain again.
+    content_encrypted = False
+
+    def __setattr__(self, name, value):
+        if name == "content":
+            self.__dict__["content_encrypted"] = False
+        super().__setattr__(name, value)
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        msg = super().from_db(db, field_names, values)
+        msg.content_encrypted = True
+        return msg
+
+    def refresh_from_db(self, using=None, fields=None, **kwargs):
+        super().refresh_from_db(using, fields, **kwargs)
+        if (fields is None or "content" in fields) and "content" not in self.get_deferred_fields():
+            self.content_encrypted = True  # reloaded as the stored token
+
+    def save(self, *args, **kwargs):
+        if self._state.adding and self.seq is None and self.room_id is not None:
+            # number and insert in one transaction so a failed insert leaves no gap
+            with transaction.atomic():
+                self.seq = Room.allocate_seqs(self.room_id)
+                return self._save_encrypted(*args, **kwargs)
+        return self._save_encrypted(*args, **kwargs)
+
+    def _save_encrypted(self, *args, **kwargs):
+        if not self.content or self.content_encrypted:
+            return super().save(*args, **kwargs)
+        plain = self.content
+        self.content = crypto.encrypt(plain)
+        try:
+            super().save(*args, **kwargs)
+        finally:
+            self.content = plain
+
+    def decrypted(self):
+        if self.content_encrypted:
+            return crypto.decrypt(self.content)
+        return self.content or ""
+
+    def thumbnail_urls(self):
+        if not self.image:
+            return {}
+        storage = self.image.storage
+        return {size: storage.url(name) for size, name in (self.thumbnails or {}).items()}
+
+
+
+class ReadState(models.Model):
+    """Tin nhắn cuối cùng người dùng đã đọc trong một phòng."""
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name="read_states")
+    room = models.ForeignKey(Room, on_delete=models.CASCADE, related_name="read_states")
+    last_read_id = models.BigIntegerField(default=0)
+    last_read_seq = models.PositiveBigIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["user", "room"], name="chat_readstate_user_room"),
+        ]
+
+    def __str__(self):
+        return f"{self.user_id} @ {self.room_id}: {self.last_read_seq}"
+
+
+class ArchiveSegment(models.Model):
+    """Một khối tin nhắn cũ đã chuyển ra tệp nén (chat/archive.py)."""
+    room = models.ForeignKey(Room, on_delete=models.CASCADE, related_name="archive_segments")
+    month = models.CharField(max_length=7)  # "2025-01"
+    name = models.CharField(max_length=255)  # <room id>/<month>.ndjson.gz, trong CHAT_ARCHIVE_ROOT
+    offset = models.PositiveBigIntegerField()
+    length = models.PositiveBigIntegerField()
+    first_id = models.BigIntegerField()
+    last_id = models.BigIntegerField()
+    count = models.PositiveIntegerField()
+    first_at = models.DateTimeField()
+    last_at = models.DateTimeField()
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            # history pages past the hot table: WHERE room_id = ? ORDER BY last_id DESC
+            models.Index(fields=["room", "last_id"], name="chat_archive_room_last_id"),
+        ]
+
+    def __str__(self):
+        return f"{self.name} [{self.first_id}..{self.last_id}]"
 
 
 class UserStatus(models.Model):
@@ -42,32 +188,3 @@ class UserStatus(models.Model):
 
     def __str__(self):
         return f"{self.user.username} ({'Online' if self.is_online else 'Offline'})"
-from cryptography.fernet import Fernet
-from django.conf import settings
-
-# Sinh 1 khóa bí mật (chạy 1 lần duy nhất)
-# import os; from cryptography.fernet import Fernet; print(Fernet.generate_key().decode())
-
-ENCRYPTION_KEY = b"n5QergO_eFsagxO-wIon6QCJhxKYNodnRWVX9s6ueMw="
-fernet = Fernet(ENCRYPTION_KEY)
-
-class Message(models.Model):
-    user = models.ForeignKey(User, on_delete=models.CASCADE)
-    room = models.ForeignKey(Room, on_delete=models.CASCADE)
-    content = models.TextField(blank=True, null=True)
-    image = models.ImageField(upload_to='chat_images/', blank=True, null=True)
-    file = models.FileField(upload_to='chat_files/', blank=True, null=True)
-    timestamp = models.DateTimeField(auto_now_add=True)
-
-    def save(self, *args, **kwargs):
-        if self.content:
-            self.content = fernet.encrypt(self.content.encode()).decode()
-        super().save(*args, **kwargs)
-
-    def decrypted(self):
-        if not self.content:
-            return ""
-        try:
-            return fernet.decrypt(self.content.encode()).decode()
-        except Exception:
-            return "[Tin nhắn mã hóa lỗi]"
@@ -0,0 +1,325 @@
+# chat/persistence.py
+"""
+Write-behind persistence for text messages (CHAT_WRITE_BEHIND = True).
+
+Instead of a get_or_create + INSERT round trip before every broadcast, the
+consumer reserves a message id, broadcasts immediately and hands the row to
+the process-wide ``WriteBehindPersister``. The persister collects rows from
+all consumers and writes them with one ``bulk_create`` whenever the batch is
+full or the oldest row has waited ``max_delay`` seconds. When the database
+falls behind and ``max_pending`` rows are queued, the sender that reaches
+the cap writes the queue out before its message is broadcast, so memory
+stays bounded and the order is kept. Whatever is still
+queued at shutdown is written from the ASGI lifespan shutdown event
+(``lifespan``), on SIGTERM before the server's own handler runs, and as a
+last resort from an atexit hook.
+
+Ids are reserved in the database itself, so rows inserted elsewhere with
+autoincrement (images, files, imports, other processes) never take them:
+from the table's sequence on PostgreSQL, from ``sqlite_sequence`` on SQLite.
+Other backends have no such reservation and keep writing synchronously.
+
+A room deleted by another process while its rows are queued (the room cache
+may still hand out its id for a while) is recreated under the same name and
+the rows are written there, as ``ChatConsumer.new_message`` does.
+"""
+import asyncio
+import atexit
+import logging
+import signal
+import threading
+import time
+from collections import deque
+
+from channels.db import database_sync_to_async
+from django.conf import settings
+from django.db import NotSupportedError, connection, transaction
+from django.utils import timezone
+
+from . import crypto
+from .models import Message, Room
+from .rooms import get_room_cache
+from .search import index_messages
+
+logger = logging.getLogger(__name__)
+
+
+class IdAllocator:
+    """
+    Hands out message ids ahead of the INSERT, reserved in blocks in the
+    database (see the module docstring), so they never collide with rows
+    inserted elsewhere.
+    """
+
+    def __init__(self, block=100):
+        self.block = block
+        self._ids = deque()
+        self._lock = threading.Lock()
+
+    def take(self):
+        with self._lock:
+            return self._ids.popleft() if self._ids else None
+
+    def refill(self):
+        """Reserve a new block of ids (sync, DB thread)."""
+        table = Message._meta.db_table
+        if connection.vendor == "postgresql":
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    "SELECT nextval(pg_get_serial_sequence(%s, 'id')) FROM generate_series(1, %s)",
+                    [table, self.block],
+                )
+                ids = [row[0] for row in cursor.fetchall()]
+        elif connection.vendor == "sqlite":
+            ids = self._reserve_sqlite(table)
+        else:
+            raise NotSupportedError(f"Write-behind cannot reserve ids on {connection.vendor}")
+        with self._lock:
+            self._ids.extend(ids)
+
+    def _reserve_sqlite(self, table):
+        # the id column is AUTOINCREMENT: new rows get max(sqlite_sequence.seq, MAX(id)) + 1,
+        # so moving seq past the block keeps every other insert out of it. The
+        # UPDATE takes the write lock before anything is read.
+        top = f"(SELECT COALESCE(MAX(id), 0) FROM {table})"
+        with transaction.atomic(), connection.cursor() as cursor:
+            cursor.execute(
+                f"UPDATE sqlite_sequence SET seq = MAX(seq, {top}) + %s WHERE name = %s",
+                [self.block, table],
+            )
+            if cursor.rowcount == 0:  # no row was ever inserted
+                cursor.execute(
+                    f"INSERT INTO sqlite_sequence (name, seq) SELECT %s, {top} + %s",
+                    [table, self.block],
+                )
+            cursor.execute("SELECT seq FROM sqlite_sequence WHERE name = %s", [table])
+            end = cursor.fetchone()[0]
+        return list(range(end - self.block + 1, end + 1))
+
+
+class WriteBehindPersister:
+    def __init__(self, max_batch=500, max_delay=0.05, max_pending=10000):
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.max_pending = max_pending
+        self.allocator = IdAllocator()
+        self._pending = []
+        self._lock = threading.Lock()
+        self._wake = None
+        self._task = None
+        self._loop = None
+
+        self.flushed_rows = 0
+        self.flushed_batches = 0
+        self.failed_rows = 0
+        self.sync_flushes = 0
+        self.last_flush_lag = 0.0
+        self.max_flush_lag = 0.0
+
+    # ---------------- producer side -----------------
+    async def submit(self, user, room_id, text, room_name=None):
+        """
+        Reserve an id, queue the row and return the unsaved Message.
+        ``room_name`` lets the row be saved in a recreated room if this one is
+        deleted before the flush.
+        """
+        msg_id = self.allocator.take()
+        if msg_id is None:
+            await database_sync_to_async(self.allocator.refill)()
+            msg_id = self.allocator.take()
+
+        msg = Message(id=msg_id, user=user, room_id=room_id, content=text, timestamp=timezone.now())
+        with self._lock:
+            self._pending.append((time.monotonic(), msg, room_name))
+            size = len(self._pending)
+
+        self._ensure_running()
+        if size >= self.max_pending:
+            # the database is not keeping up: write synchronously instead of queueing more
+            self.sync_flushes += 1
+            await self.flush()
+        elif size >= self.max_batch:
+            self._wake.set()
+        return msg
+
+    def _ensure_running(self):
+        loop = asyncio.get_running_loop()
+        if self._task is None or self._task.done() or self._loop is not loop:
+            self._loop = loop
+            self._wake = asyncio.Event()
+            self._task = loop.create_task(self._run())
+            self._flush_on_sigterm(loop)
+
+    def _flush_on_sigterm(self, loop):
+        """
+        Write the queue out on SIGTERM (daphne has no lifespan shutdown, and
+        atexit does not run when the server's handler stops the process),
+        then hand the signal to whatever handled it before.
+        """
+        if threading.current_thread() is not threading.main_thread():
+            return
+        previous = signal.getsignal(signal.SIGTERM)
+
+        def on_sigterm():
+            loop.remove_signal_handler(signal.SIGTERM)
+            signal.signal(signal.SIGTERM, previous if previous is not None else signal.SIG_DFL)
+            task = loop.create_task(self.flush())
+            task.add_done_callback(lambda _: signal.raise_signal(signal.SIGTERM))
+
+        try:
+            loop.add_signal_handler(signal.SIGTERM, on_sigterm)
+        except (NotImplementedError, RuntimeError, ValueError):
+            pass  # not a Unix loop, or a loop that is not the main one
+
+    # ---------------- consumer side -----------------
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout=self.max_delay)
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+            try:
+                await self.flush()
+            except Exception:
+                logger.exception("Write-behind flush failed")
+
+    def _take_batch(self):
+        with self._lock:
+            batch, self._pending = self._pending[:self.max_batch], self._pending[self.max_batch:]
+        return batch
+
+    async def flush(self):
+        while True:
+            batch = self._take_batch()
+            if not batch:
+                return
+            await database_sync_to_async(self._write)(batch)
+
+    def flush_sync(self):
+        """Drain the queue from synchronous code (atexit, management commands)."""
+        while True:
+            batch = self._take_batch()
+            if not batch:
+                return
+            self._write(batch)
+
+    def _write(self, batch):
+        rows = [_encrypted(msg) for _, msg, _ in batch]
+        written = {row.pk for row in rows}
+        try:
+            with transaction.atomic():
+                _number(rows)
+                Message.objects.bulk_create(rows)
+        except Exception:
+            logger.exception("Bulk insert of %d messages failed, retrying one by one", len(rows))
+            try:
+                _recreate_rooms(rows, {msg.room_id: name for _, msg, name in batch if name})
+            except Exception:
+                logger.exception("Failed to recreate deleted rooms")
+            for row in rows:
+                try:
+                    with transaction.atomic():
+                        row.seq = None
+                        _number([row])
+                        Message.objects.bulk_create([row])
+                except Exception:
+                    self.failed_rows += 1
+                    written.discard(row.pk)
+                    logger.exception("Dropping message %s", row.pk)
+
+        try:
+            index_messages([(msg.pk, msg.content) for _, msg, _ in batch if msg.pk in written])
+        except Exception:
+            logger.exception("Failed to index %d messages", len(written))
+
+        lag = time.monotonic() - batch[0][0]
+        self.flushed_rows += len(rows)
+        self.flushed_batches += 1
+        self.last_flush_lag = lag
+        self.max_flush_lag = max(self.max_flush_lag, lag)
+
+    def stats(self):
+        with self._lock:
+            pending = len(self._pending)
+            oldest = self._pending[0][0] if self._pending else None
+        return {
+            "pending": pending,
+            "oldest_pending_age": time.monotonic() - oldest if oldest is not None else 0.0,
+            "flushed_rows": self.flushed_rows,
+            "flushed_batches": self.flushed_batches,
+            "failed_rows": self.failed_rows,
+            "sync_flushes": self.sync_flushes,
+            "last_flush_lag": self.last_flush_lag,
+            "max_flush_lag": self.max_flush_lag,
+        }
+
+
+def _number(rows):
+    # bulk_create skips Message.save(), which is where seqs are assigned
+    by_room = {}
+    for row in rows:
+        by_room.setdefault(row.room_id, []).append(row)
+    for room_id, room_rows in by_room.items():
+        first = Room.allocate_seqs(room_id, len(room_rows))
+        for offset, row in enumerate(room_rows):
+            row.seq = first + offset
+
+
+def _recreate_rooms(rows, names):
+    """Move rows whose room no longer exists to a room of the same name, created if need be."""
+    existing = set(Room.objects.filter(pk__in=names).values_list("pk", flat=True))
+    moved = {}
+    for room_id, name in names.items():
+        if room_id not in existing:
+            get_room_cache().invalidate(name)
+            moved[room_id] = get_room_cache().get_or_create(name).id
+    for row in rows:
+        row.room_id = moved.get(row.room_id, row.room_id)
+
+
+def _encrypted(msg):
+    # bulk_create skips Message.save(), which is where content is encrypted
+    return Message(
+        id=msg.id,
+        user_id=msg.user_id,
+        room_id=msg.room_id,
+        content=crypto.encrypt(msg.content) if msg.content else msg.content,
+        timestamp=msg.timestamp,
+    )
+
+
+_persister = None
+
+
+def write_behind_enabled():
+    # ids can only be reserved on PostgreSQL and SQLite (IdAllocator)
+    return getattr(settings, "CHAT_WRITE_BEHIND", False) and connection.vendor in ("postgresql", "sqlite")
+
+
+def get_persister():
+    global _persister
+    if _persister is None:
+        _persister = WriteBehindPersister(
+            max_batch=getattr(settings, "CHAT_WRITE_BEHIND_BATCH", 500),
+            max_delay=getattr(settings, "CHAT_WRITE_BEHIND_DELAY", 0.05),
+            max_pending=getattr(settings, "CHAT_WRITE_BEHIND_MAX_PENDING", 10000),
+        )
+        atexit.register(_persister.flush_sync)
+    return _persister
+
+
+async def lifespan(scope, receive, send):
+    """ASGI lifespan app: write out queued rows on shutdown (servers that send it, e.g. uvicorn)."""
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            if _persister is not None:
+                try:
+                    await _persister.flush()
+                except Exception:
+                    logger.exception("Write-behind flush at shutdown failed")
+            await send({"type": "lifespan.shutdown.complete"})
+            return
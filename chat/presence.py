@@ -0,0 +1,240 @@
+# chat/presence.py
+"""
+Presence service.
+
+Every WebSocket connection is registered under its channel name, so a user
+with two tabs stays online until the last one closes. Entries carry an expiry
+that the owning process refreshes on a heartbeat; if a process dies, its
+connections simply age out. ``last_seen`` changes are collected and written to
+``UserStatus`` in one upsert per flush instead of a get_or_create + save on
+every connect and disconnect. Rows a dead process left online are turned
+offline by the next heartbeat of any process (``expire_stale``).
+
+The state lives in Redis, or in process memory when there is no shared Redis
+(tests, InMemoryChannelLayer).
+"""
+import asyncio
+import logging
+import threading
+import time
+from datetime import datetime, timezone as dt_timezone
+
+from channels.db import database_sync_to_async
+from django.conf import settings
+
+from .models import UserStatus
+
+logger = logging.getLogger(__name__)
+
+
+def _member(conn, user_id, username):
+    return f"{conn}|{user_id}|{username}"
+
+
+def _parse(member):
+    conn, user_id, username = member.split("|", 2)
+    return conn, int(user_id), username
+
+
+class MemoryPresence:
+    def __init__(self):
+        self._rooms = {}  # room -> {member: expires}
+        self._users = {}  # user_id -> {conn: expires}
+        self._dirty = {}  # user_id -> last seen timestamp
+        self._lock = threading.Lock()
+
+    def add(self, conn, user_id, username, room, expires):
+        with self._lock:
+            self._rooms.setdefault(room, {})[_member(conn, user_id, username)] = expires
+            self._users.setdefault(user_id, {})[conn] = expires
+            self._dirty[user_id] = time.time()
+
+    def refresh(self, conns, expires):
+        with self._lock:
+            for conn, user_id, username, room in conns:
+                self._rooms.setdefault(room, {})[_member(conn, user_id, username)] = expires
+                self._users.setdefault(user_id, {})[conn] = expires
+
+    def remove(self, conn, user_id, username, room):
+        with self._lock:
+            self._rooms.get(room, {}).pop(_member(conn, user_id, username), None)
+            self._users.get(user_id, {}).pop(conn, None)
+            self._dirty[user_id] = time.time()
+
+    def room_usernames(self, room, now):
+        with self._lock:
+            members = [m for m, exp in self._rooms.get(room, {}).items() if exp > now]
+        return sorted({_parse(m)[2] for m in members})
+
+    def online_user_ids(self, user_ids, now):
+        with self._lock:
+            return {
+                uid for uid in user_ids
+                if any(exp > now for exp in self._users.get(uid, {}).values())
+            }
+
+    def drain_dirty(self):
+        with self._lock:
+            dirty, self._dirty = self._dirty, {}
+        return dirty
+
+
+class RedisPresence:
+    """
+    presence:room:<room>   ZSET  "<conn>|<user_id>|<username>" -> expiry
+    presence:user:<uid>    ZSET  "<conn>" -> expiry
+    presence:dirty         HASH  user_id -> last seen (epoch seconds)
+    """
+
+    def __init__(self, url):
+        import redis
+
+        self.client = redis.Redis.from_url(url, decode_responses=True)
+
+    def add(self, conn, user_id, username, room, expires):
+        pipe = self.client.pipeline(transaction=False)
+        pipe.zadd(f"presence:room:{room}", {_member(conn, user_id, username): expires})
+        pipe.zadd(f"presence:user:{user_id}", {conn: expires})
+        pipe.hset("presence:dirty", user_id, time.time())
+        pipe.execute()
+
+    def refresh(self, conns, expires):
+        now = time.time()
+        pipe = self.client.pipeline(transaction=False)
+        for conn, user_id, username, room in conns:
+            pipe.zadd(f"presence:room:{room}", {_member(conn, user_id, username): expires})
+            pipe.zadd(f"presence:user:{user_id}", {conn: expires})
+            # drop entries left behind by crashed processes
+            pipe.zremrangebyscore(f"presence:room:{room}", "-inf", now)
+            pipe.zremrangebyscore(f"presence:user:{user_id}", "-inf", now)
+        pipe.execute()
+
+    def remove(self, conn, user_id, username, room):
+        pipe = self.client.pipeline(transaction=False)
+        pipe.zrem(f"presence:room:{room}", _member(conn, user_id, username))
+        pipe.zrem(f"presence:user:{user_id}", conn)
+        pipe.hset("presence:dirty", user_id, time.time())
+        pipe.execute()
+
+    def room_usernames(self, room, now):
+        members = self.client.zrangebyscore(f"presence:room:{room}", now, "+inf")
+        return sorted({_parse(m)[2] for m in members})
+
+    def online_user_ids(self, user_ids, now):
+        user_ids = list(user_ids)
+        pipe = self.client.pipeline(transaction=False)
+        for uid in user_ids:
+            pipe.zcount(f"presence:user:{uid}", now, "+inf")
+        return {uid for uid, count in zip(user_ids, pipe.execute()) if count}
+
+    def drain_dirty(self):
+        pipe = self.client.pipeline()
+        pipe.hgetall("presence:dirty")
+        pipe.delete("presence:dirty")
+        dirty, _ = pipe.execute()
+        return {int(uid): float(ts) for uid, ts in dirty.items()}
+
+
+class PresenceService:
+    def __init__(self, backend, heartbeat=30.0):
+        self.backend = backend
+        self.heartbeat = heartbeat
+        self.ttl = heartbeat * 3
+        self._local = {}  # conn -> (conn, user_id, username, room)
+        self._task = None
+        self._loop = None
+
+    def _expires(self):
+        return time.time() + self.ttl
+
+    # ---------------- sync API (call from a thread) -----------------
+    def connect(self, conn, user, room):
+        entry = (conn, user.pk, user.username, room)
+        self._local[conn] = entry
+        self.backend.add(*entry, expires=self._expires())
+
+    def disconnect(self, conn):
+        entry = self._local.pop(conn, None)
+        if entry is not None:
+            self.backend.remove(*entry)
+
+    def room_usernames(self, room):
+        return self.backend.room_usernames(room, time.time())
+
+    def online_user_ids(self, user_ids):
+        return self.backend.online_user_ids(user_ids, time.time())
+
+    def flush_last_seen(self):
+        """Write pending last_seen/is_online changes to UserStatus in one upsert."""
+        dirty = self.backend.drain_dirty()
+        if not dirty:
+            return 0
+        online = self.online_user_ids(dirty)
+        rows = [
+            UserStatus(user_id=uid, is_online=uid in online, last_seen=datetime.fromtimestamp(ts, tz=dt_timezone.utc))
+            for uid, ts in dirty.items()
+        ]
+        UserStatus.objects.bulk_create(
+            rows,
+            update_conflicts=True,
+            unique_fields=["user"],
+            update_fields=["is_online", "last_seen"],
+        )
+        return len(rows)
+
+    def expire_stale(self, chunk=500):
+        """
+        Turn off ``is_online`` for users whose process died without
+        disconnecting them: not seen for a TTL and without a live connection.
+        """
+        cutoff = datetime.fromtimestamp(time.time() - self.ttl, tz=dt_timezone.utc)
+        stale = list(
+            UserStatus.objects.filter(is_online=True, last_seen__lt=cutoff).values_list("user_id", flat=True)
+        )
+        expired = 0
+        for start in range(0, len(stale), chunk):
+            user_ids = stale[start:start + chunk]
+            gone = set(user_ids) - self.online_user_ids(user_ids)
+            if gone:
+                # last_seen__lt again: a flush that ran meanwhile wins
+                expired += UserStatus.objects.filter(
+                    user_id__in=gone, is_online=True, last_seen__lt=cutoff
+                ).update(is_online=False)
+        return expired
+
+    def beat(self):
+        self.backend.refresh(list(self._local.values()), self._expires())
+        self.flush_last_seen()
+        self.expire_stale()
+
+    # ---------------- background heartbeat -----------------
+    def ensure_running(self):
+        loop = asyncio.get_running_loop()
+        if self._task is None or self._task.done() or self._loop is not loop:
+            self._loop = loop
+            self._task = loop.create_task(self._run())
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.heartbeat)
+            try:
+                await database_sync_to_async(self.beat)()
+            except Exception:
+                logger.exception("Presence heartbeat failed")
+
+
+_service = None
+
+
+def get_presence():
+    global _service
+    if _service is None:
+        url = getattr(settings, "CHAT_PRESENCE_URL", None)
+        backend = RedisPresence(url) if url else MemoryPresence()
+        _service = PresenceService(backend, heartbeat=getattr(settings, "CHAT_PRESENCE_HEARTBEAT", 30.0))
+    return _service
+
+
+def reset_presence():
+    global _service
+    _service = None
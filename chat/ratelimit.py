@@ -0,0 +1,138 @@
+# chat/ratelimit.py
+"""
+Inbound rate limits and outbound backpressure for ChatConsumer.
+
+Inbound: every event type has a token bucket per connection
+(CHAT_RATE_LIMITS) and one per user shared by all of that user's connections
+in this process (CHAT_USER_RATE_LIMITS). Binary upload frames draw from the
+"upload_bytes" bucket by size. An event over either budget is dropped and the
+client gets one ``rate_limited`` notice per window (a dropped upload chunk gets
+its own notice with the ``upload_id``, and the client resumes the upload); a connection that keeps
+pushing (CHAT_RATE_LIMIT_MAX_STRIKES drops in a row) is closed. Frames larger
+than CHAT_MAX_FRAME_BYTES close the connection before they are parsed.
+
+Outbound: a socket's pending broadcasts wait in its channel layer inbox,
+which is bounded by the layer's ``capacity``. Every frame carries the time it
+was sent to the group and the sending process; a member that takes longer
+than CHAT_OUTBOUND_MAX_LAG to get to it, beyond the smallest delay seen from
+that process (so clock skew between hosts cancels out), is reading slower than
+the room talks (its ASGI server applies backpressure on send). The policy
+(CHAT_OUTBOUND_POLICY) then either drops the stale frames until the member has
+caught up, sending one ``resync_gap`` so the client can reconnect, or
+disconnects it; either way the client reconnects with ``since=`` and resyncs
+what it missed. Measuring lag
+instead of queueing per socket costs one clock read per frame, so the
+encode-once fan-out (chat/frames.py) stays as cheap as before.
+"""
+import time
+
+from django.conf import settings
+
+# event type -> (tokens per second, burst); "upload_bytes" is counted in bytes
+DEFAULT_LIMITS = {
+    "chat": (5, 10),
+    "typing": (10, 30),  # cheap, coalesced per room (chat/typing_state.py)
+    "read": (5, 10),
+    "load_older": (2, 5),
+    "search": (1, 3),
+    "presence": (1, 3),
+    "image": (0.5, 3),
+    "file": (0.5, 3),
+    "upload_bytes": (4 * 1024 * 1024, 16 * 1024 * 1024),
+    "default": (10, 20),
+}
+DEFAULT_USER_LIMITS = {
+    "chat": (10, 20),
+    "image": (1, 5),
+    "file": (1, 5),
+    "upload_bytes": (8 * 1024 * 1024, 32 * 1024 * 1024),
+}
+PRUNE_AT = 10000
+
+
+class TokenBucket:
+    __slots__ = ("rate", "burst", "tokens", "updated")
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def take(self, cost=1, now=None):
+        """Spend ``cost`` tokens; returns 0 when allowed, else seconds until it would be."""
+        self.refill(time.monotonic() if now is None else now)
+        if cost <= self.tokens:
+            self.tokens -= cost
+            return 0.0
+        if cost > self.burst:  # can never fit, e.g. a frame larger than the byte burst
+            cost = self.burst
+        return (cost - self.tokens) / self.rate if self.rate > 0 else float("inf")
+
+
+class RateLimiter:
+    """Token buckets keyed by (owner, event type). Used from the event loop thread only."""
+
+    def __init__(self, limits):
+        self.limits = limits
+        self._buckets = {}
+
+    def check(self, owner, kind, cost=1):
+        rule = self.limits.get(kind) or self.limits.get("default")
+        if rule is None:
+            return 0.0
+        key = (owner, kind)
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            if len(self._buckets) >= PRUNE_AT:
+                self.prune()
+            bucket = self._buckets[key] = TokenBucket(*rule)
+        return bucket.take(cost)
+
+    def prune(self):
+        """Forget buckets that have refilled completely; they behave like new ones."""
+        now = time.monotonic()
+        for key, bucket in list(self._buckets.items()):
+            bucket.refill(now)
+            if bucket.tokens >= bucket.burst:
+                del self._buckets[key]
+
+
+def connection_limits():
+    return getattr(settings, "CHAT_RATE_LIMITS", DEFAULT_LIMITS)
+
+
+def max_frame_bytes():
+    return getattr(settings, "CHAT_MAX_FRAME_BYTES", 1024 * 1024)
+
+
+def max_strikes():
+    return getattr(settings, "CHAT_RATE_LIMIT_MAX_STRIKES", 50)
+
+
+_user_limiter = None
+
+
+def get_user_limiter():
+    global _user_limiter
+    if _user_limiter is None:
+        _user_limiter = RateLimiter(getattr(settings, "CHAT_USER_RATE_LIMITS", DEFAULT_USER_LIMITS))
+    return _user_limiter
+
+
+def reset_user_limiter():
+    global _user_limiter
+    _user_limiter = None
+
+
+# ---------------- outbound -----------------
+def max_outbound_lag():
+    return getattr(settings, "CHAT_OUTBOUND_MAX_LAG", 5.0)
+
+
+def outbound_policy():
+    return getattr(settings, "CHAT_OUTBOUND_POLICY", "disconnect")
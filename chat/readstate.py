@@ -0,0 +1,138 @@
+# chat/readstate.py
+"""
+Read pointers and unread counts.
+
+Every message gets a per-room ``seq`` (1, 2, 3, ...) when it is inserted and
+``Room.message_seq`` holds the newest one, so a user's unread count in a room
+is ``room.message_seq - read_state.last_read_seq``: no COUNT(*) over Message,
+and the counts for a whole page of rooms come from one query.
+
+Clients report what they have seen with a ``read`` WebSocket event. Reports
+are debounced per process: the newest message id per (user, room) is kept in
+memory and written once per ``interval`` with a single upsert.
+"""
+import asyncio
+import logging
+import threading
+
+from channels.db import database_sync_to_async
+from django.conf import settings
+from django.db.models import OuterRef, Subquery, Value
+from django.db.models.functions import Coalesce
+
+from .models import Message, ReadState, Room
+
+logger = logging.getLogger(__name__)
+
+# a read report whose message is not in the database yet (write-behind) is
+# retried on the next flushes, then dropped
+MAX_ATTEMPTS = 3
+
+
+def unread_counts(user, room_names):
+    """``{room name: unread count}`` for ``room_names``, in one query."""
+    room_names = list(room_names)
+    if not room_names or not user.is_authenticated:
+        return {}
+    read_seq = ReadState.objects.filter(user=user, room=OuterRef("pk")).values("last_read_seq")[:1]
+    rows = (
+        Room.objects.filter(name__in=room_names)
+        .annotate(read_seq=Coalesce(Subquery(read_seq), Value(0)))
+        .values_list("name", "message_seq", "read_seq")
+    )
+    return {name: max(0, seq - read) for name, seq, read in rows}
+
+
+class ReadMarker:
+    def __init__(self, interval=2.0):
+        self.interval = interval
+        self._pending = {}  # (user_id, room_id) -> [message_id, attempts]
+        self._lock = threading.Lock()
+        self._task = None
+        self._loop = None
+
+    def mark(self, user_id, room_id, message_id):
+        """Record that ``user_id`` has read ``room_id`` up to ``message_id``."""
+        key = (user_id, room_id)
+        with self._lock:
+            current = self._pending.get(key)
+            if current is None or message_id > current[0]:
+                self._pending[key] = [message_id, 0]
+        self._schedule()
+
+    def _schedule(self):
+        loop = asyncio.get_running_loop()
+        if self._task is None or self._task.done() or self._loop is not loop:
+            self._loop = loop
+            self._task = loop.create_task(self._flush_later())
+
+    async def _flush_later(self):
+        await asyncio.sleep(self.interval)
+        try:
+            await database_sync_to_async(self.flush)()
+        except Exception:
+            logger.exception("Read state flush failed")
+        with self._lock:
+            retry = bool(self._pending)
+        if retry:
+            self._task = self._loop.create_task(self._flush_later())
+
+    def flush(self):
+        """Write pending read pointers (sync, DB thread). Returns rows written."""
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        if not pending:
+            return 0
+
+        messages = {
+            pk: (room_id, seq)
+            for pk, room_id, seq in Message.objects.filter(
+                pk__in={message_id for message_id, _ in pending.values()}
+            ).values_list("pk", "room_id", "seq")
+        }
+        # pointers only move forward, e.g. when another tab reports an older message
+        current = {
+            (user_id, room_id): seq
+            for user_id, room_id, seq in ReadState.objects.filter(
+                user_id__in={user_id for user_id, _ in pending},
+                room_id__in={room_id for _, room_id in pending},
+            ).values_list("user_id", "room_id", "last_read_seq")
+        }
+        rows = []
+        retry = {}
+        for (user_id, room_id), (message_id, attempts) in pending.items():
+            found = messages.get(message_id)
+            if found is not None and found[0] == room_id and found[1] is not None:
+                if found[1] <= current.get((user_id, room_id), 0):
+                    continue
+                rows.append(ReadState(user_id=user_id, room_id=room_id, last_read_id=message_id, last_read_seq=found[1]))
+            elif found is None and attempts + 1 < MAX_ATTEMPTS:
+                retry[(user_id, room_id)] = [message_id, attempts + 1]
+
+        if retry:
+            with self._lock:
+                for key, value in retry.items():
+                    self._pending.setdefault(key, value)
+        if rows:
+            ReadState.objects.bulk_create(
+                rows,
+                update_conflicts=True,
+                unique_fields=["user", "room"],
+                update_fields=["last_read_id", "last_read_seq", "updated_at"],
+            )
+        return len(rows)
+
+
+_marker = None
+
+
+def get_read_marker():
+    global _marker
+    if _marker is None:
+        _marker = ReadMarker(interval=getattr(settings, "CHAT_READ_DEBOUNCE", 2.0))
+    return _marker
+
+
+def reset_read_marker():
+    global _marker
+    _marker = None
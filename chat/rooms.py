@@ -0,0 +1,101 @@
+# chat/rooms.py
+"""
+Per-process room metadata cache.
+
+A consumer resolves its room once on connect and every message after that is
+written with the cached ``room_id``, instead of a ``Room.objects.get_or_create``
+per message. Entries are dropped when a room is created, deleted or its
+member set changes, and otherwise expire after ``ttl`` seconds so other
+processes' changes are picked up as well.
+"""
+import threading
+import time
+from collections import namedtuple
+
+from django.conf import settings
+from django.db.models import F
+from django.db.models.signals import m2m_changed, post_delete
+from django.dispatch import receiver
+
+from .models import Room
+
+RoomMeta = namedtuple("RoomMeta", ["id", "name", "is_private", "members_version"])
+
+
+def _meta(room):
+    return RoomMeta(room.pk, room.name, room.is_private, room.members_version)
+
+
+class RoomMetaCache:
+    def __init__(self, ttl=60.0):
+        self.ttl = ttl
+        self._rooms = {}
+        self._lock = threading.Lock()
+
+    def _cached(self, name):
+        with self._lock:
+            item = self._rooms.get(name)
+        if item is not None and item[1] > time.monotonic():
+            return item[0]
+        return None
+
+    def _store(self, meta):
+        with self._lock:
+            self._rooms[meta.name] = (meta, time.monotonic() + self.ttl)
+        return meta
+
+    def get(self, name):
+        """Cached metadata for ``name``, or None if the room does not exist (sync)."""
+        meta = self._cached(name)
+        if meta is None:
+            room = Room.objects.filter(name=name).first()
+            if room is None:
+                return None
+            meta = self._store(_meta(room))
+        return meta
+
+    def get_or_create(self, name):
+        meta = self._cached(name)
+        if meta is None:
+            room, _ = Room.objects.get_or_create(name=name)
+            meta = self._store(_meta(room))
+        return meta
+
+    def invalidate(self, name):
+        with self._lock:
+            self._rooms.pop(name, None)
+
+
+_cache = None
+
+
+def get_room_cache():
+    global _cache
+    if _cache is None:
+        _cache = RoomMetaCache(ttl=getattr(settings, "CHAT_ROOM_CACHE_TTL", 60.0))
+    return _cache
+
+
+def reset_room_cache():
+    global _cache
+    _cache = None
+
+
+@receiver(m2m_changed, sender=Room.members.through)
+def bump_members_version(sender, instance, action, reverse, **kwargs):
+    if action not in ("post_add", "post_remove", "post_clear"):
+        return
+    if reverse:
+        # user.rooms.add(...): instance is the user, pk_set holds room ids
+        rooms = Room.objects.filter(pk__in=kwargs.get("pk_set") or ())
+    else:
+        rooms = Room.objects.filter(pk=instance.pk)
+    names = list(rooms.values_list("name", flat=True))
+    rooms.update(members_version=F("members_version") + 1)
+    for name in names:
+        get_room_cache().invalidate(name)
+
+
+@receiver(post_delete, sender=Room)
+def forget_deleted_room(sender, instance, **kwargs):
+    get_room_cache().invalidate(instance.name)
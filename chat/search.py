@@ -0,0 +1,128 @@
+# chat/search.py
+"""
+Full-text message search.
+
+Message.content is encrypted at rest, so the index is fed the plain text at
+write time (``index_messages``) rather than computed from the column:
+
+  * PostgreSQL: ``chat_message.search_vector`` (tsvector, GIN index)
+  * SQLite:     ``chat_message_fts`` (FTS5, rowid = message id)
+
+Both are created by migration 0011. Note that the index itself holds the
+searchable terms in clear. Results are paged newest-first with a keyset
+cursor (``before`` = smallest id of the previous page) and decrypted in one
+batch through ``history.serialize_page``.
+"""
+import logging
+
+from django.db import connection
+from django.db.models import Q
+
+from .history import serialize_page
+from .models import Message, Room
+
+logger = logging.getLogger(__name__)
+
+PAGE_SIZE = 20
+MAX_PAGE_SIZE = 100
+TS_CONFIG = "simple"
+
+
+def search_available():
+    return connection.vendor in ("postgresql", "sqlite")
+
+
+def index_messages(rows):
+    """Add ``(message_id, plain_text)`` pairs to the index (sync, DB thread)."""
+    rows = [(pk, text) for pk, text in rows if text]
+    if not rows:
+        return
+    with connection.cursor() as cursor:
+        if connection.vendor == "postgresql":
+            cursor.executemany(
+                f"UPDATE chat_message SET search_vector = to_tsvector('{TS_CONFIG}', %s) WHERE id = %s",
+                [(text, pk) for pk, text in rows],
+            )
+        elif connection.vendor == "sqlite":
+            cursor.executemany(
+                "INSERT OR REPLACE INTO chat_message_fts (rowid, content) VALUES (%s, %s)",
+                rows,
+            )
+
+
+def index_message(msg, text):
+    try:
+        index_messages([(msg.pk, text)])
+    except Exception:
+        # search must never break sending; rebuild_search_index repairs gaps
+        logger.exception("Failed to index message %s", msg.pk)
+
+
+def _fts5_query(query):
+    # quote every term so user input cannot use FTS5 query syntax
+    return " ".join('"%s"' % term.replace('"', '""') for term in query.split())
+
+
+def search_ids(query, room_ids, before=None, limit=PAGE_SIZE):
+    room_ids = list(room_ids)
+    if not query.strip() or not room_ids:
+        return []
+    placeholders = ", ".join(["%s"] * len(room_ids))
+    before_sql = "AND m.id < %s" if before is not None else ""
+    params_tail = ([before] if before is not None else []) + [limit]
+
+    if connection.vendor == "postgresql":
+        sql = (
+            f"SELECT m.id FROM chat_message m "
+            f"WHERE m.room_id IN ({placeholders}) "
+            f"AND m.search_vector @@ plainto_tsquery('{TS_CONFIG}', %s) {before_sql} "
+            f"ORDER BY m.id DESC LIMIT %s"
+        )
+        params = room_ids + [query] + params_tail
+    elif connection.vendor == "sqlite":
+        sql = (
+            f"SELECT m.id FROM chat_message_fts f JOIN chat_message m ON m.id = f.rowid "
+            f"WHERE chat_message_fts MATCH %s AND m.room_id IN ({placeholders}) {before_sql} "
+            f"ORDER BY m.id DESC LIMIT %s"
+        )
+        params = [_fts5_query(query)] + room_ids + params_tail
+    else:
+        raise NotImplementedError(f"Search is not supported on {connection.vendor}")
+
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params)
+        return [row[0] for row in cursor.fetchall()]
+
+
+def search(query, room_ids, before=None, limit=PAGE_SIZE):
+    """
+    Return ``(results, next_before)``; results are history entries plus the
+    room name, newest first. ``next_before`` is None on the last page.
+    """
+    limit = max(1, min(int(limit), MAX_PAGE_SIZE))
+    ids = search_ids(query, room_ids, before=before, limit=limit + 1)
+    has_more = len(ids) > limit
+    ids = ids[:limit]
+
+    rows = list(Message.objects.filter(pk__in=ids).select_related("user", "room").order_by("-pk"))
+    results = serialize_page(rows)
+    for entry, m in zip(results, rows):
+        entry["room"] = m.room.name
+    return results, (ids[-1] if has_more else None)
+
+
+def accessible_room_ids(user, session=None, room_name=None):
+    """
+    Rooms ``user`` may search: public rooms, rooms they are a member of and
+    password rooms unlocked in this session (see views.room).
+    """
+    unlocked = [
+        key[len("room_access_"):] for key, value in (session.items() if session is not None else [])
+        if key.startswith("room_access_") and value
+    ]
+    qs = Room.objects.filter(
+        Q(password__isnull=True) | Q(password="") | Q(members=user) | Q(name__in=unlocked)
+    )
+    if room_name is not None:
+        qs = qs.filter(name=room_name)
+    return set(qs.values_list("id", flat=True))
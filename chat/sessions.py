@@ -0,0 +1,58 @@
+# chat/sessions.py
+"""
+Session engine: Django's ``cached_db`` (sessions are read from the
+SESSION_CACHE_ALIAS cache, Redis in production, and written through to the
+database) that keeps working while the cache is down.
+
+A failed cache read falls back to the session table, and a failed cache
+write or delete is logged instead of failing the request, so logins and
+logouts still reach the database. A logout made during a cache outage can
+leave the old entry in the cache until it expires or the key is deleted by
+hand; the error is logged for that reason.
+"""
+import logging
+
+from django.contrib.sessions.backends import cached_db
+
+logger = logging.getLogger(__name__)
+
+
+class SessionStore(cached_db.SessionStore):
+    def load(self):
+        try:
+            data = self._cache.get(self.cache_key)
+        except Exception:
+            logger.warning("Session cache unavailable, reading the database", exc_info=True)
+            data = None
+        if data is not None:
+            return data
+
+        s = self._get_session_from_db()
+        if not s:
+            return {}
+        data = self.decode(s.session_data)
+        try:
+            self._cache.set(self.cache_key, data, self.get_expiry_age(expiry=s.expire_date))
+        except Exception:
+            logger.warning("Session cache unavailable, not repopulating", exc_info=True)
+        return data
+
+    def exists(self, session_key):
+        try:
+            if session_key and (self.cache_key_prefix + session_key) in self._cache:
+                return True
+        except Exception:
+            logger.warning("Session cache unavailable, reading the database", exc_info=True)
+        return cached_db.DBStore.exists(self, session_key)
+
+    def delete(self, session_key=None):
+        if session_key is None:
+            if self.session_key is None:
+                return
+            session_key = self.session_key
+        # database first: a logout must stick even when the cache is down
+        cached_db.DBStore.delete(self, session_key)
+        try:
+            self._cache.delete(self.cache_key_prefix + session_key)
+        except Exception:
+            logger.error("Could not drop session %s… from the cache", session_key[:8], exc_info=True)
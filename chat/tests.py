@@ -1,3 +1,1351 @@
-from django.test import TestCase
+import asyncio
+import base64
+import functools
+import json
+import os
+import shutil
+import tempfile
+from datetime import datetime, timedelta, timezone as dt_timezone
+from io import BytesIO, StringIO
+from unittest import mock, skipUnless
 
-# Create your tests here.
+from asgiref.sync import async_to_sync
+from channels.db import database_sync_to_async
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from cryptography.fernet import Fernet
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.management import CommandError, call_command
+from django.db import connection
+from django.core.cache import caches
+from django.test import Client, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from PIL import Image
+
+from . import attachments, bench, crypto, history, images, metrics, persistence, typing_state, uploads, wire
+from .frames import frame_event, packed_frame
+from .layers import HashRing, HybridChannelLayer, ShardedChannelLayer
+from .cache import get_history_cache, reset_history_cache
+from .directory import get_directory_cache, reset_directory_cache
+from .presence import get_presence, reset_presence
+from .ratelimit import reset_user_limiter
+from .readstate import get_read_marker, reset_read_marker, unread_counts
+from .rooms import get_room_cache, reset_room_cache
+from .models import Attachment, Message, ReadState, Room, UserStatus
+from .routing import websocket_urlpatterns
+from .wsauth import CachedAuthMiddlewareStack, get_user_cache, reset_user_cache
+
+try:
+    import fakeredis
+    import lupa  # noqa: F401  (fakeredis needs it for the layer's Lua scripts)
+except ImportError:
+    fakeredis = None
+
+TEST_CHANNEL_LAYERS = {"default": {"BACKEND": "channels.layers.InMemoryChannelLayer"}}
+TEST_CACHES = {
+    "default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"},
+    "sessions": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache", "LOCATION": "sessions"},
+}
+
+
+def streamed(response):
+    """Body of a response streamed from an async iterator (chat/media.py)."""
+    async def read():
+        return b"".join([chunk async for chunk in response.streaming_content])
+    return async_to_sync(read)()
+
+
+class ChatConsumerTestCase(TransactionTestCase):
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        self.upload_dir = tempfile.mkdtemp()
+        self.settings_override = override_settings(
+            CHANNEL_LAYERS=TEST_CHANNEL_LAYERS,
+            MEDIA_ROOT=self.media_root,
+            CHAT_UPLOAD_TEMP_DIR=self.upload_dir,
+            CHAT_HISTORY_CACHE_URL=None,
+            CHAT_PRESENCE_URL=None,
+            CHAT_DIRECTORY_CACHE_URL=None,
+            CACHES=TEST_CACHES,
+            SESSION_ENGINE="chat.sessions",
+            SESSION_CACHE_ALIAS="sessions",
+        )
+        self.settings_override.enable()
+        reset_user_limiter()
+        reset_user_cache()
+        reset_read_marker()
+        reset_directory_cache()
+        reset_history_cache()
+        reset_presence()
+        reset_room_cache()
+        self.user = User.objects.create_user(username="alice", password="pw")
+
+    def tearDown(self):
+        self.settings_override.disable()
+        reset_directory_cache()
+        reset_history_cache()
+        reset_presence()
+        reset_room_cache()
+        shutil.rmtree(self.media_root, ignore_errors=True)
+        shutil.rmtree(self.upload_dir, ignore_errors=True)
+
+    async def connect(self, room="lobby", user=None):
+        communicator = WebsocketCommunicator(URLRouter(websocket_urlpatterns), f"/ws/chat/{room}/")
+        communicator.scope["user"] = user or self.user
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        history = await communicator.receive_json_from()
+        self.assertEqual(history["type"], "history")
+        communicator.history = history["messages"]
+        return communicator
+
+
+class ChunkedUploadTests(ChatConsumerTestCase):
+    def frame(self, op, upload_id, payload=b""):
+        return uploads.HEADER.pack(op, upload_id) + payload
+
+    def test_chunked_file_upload_with_resume(self):
+        async def run():
+            upload_id = b"\x01" * 16
+            body = b"hello world, " * 100
+            meta = json.dumps({"kind": "file", "filename": "notes.txt", "size": len(body)}).encode()
+
+            ws = await self.connect()
+            await ws.send_to(bytes_data=self.frame(uploads.OP_START, upload_id, meta))
+            self.assertEqual((await ws.receive_json_from())["offset"], 0)
+
+            await ws.send_to(bytes_data=self.frame(uploads.OP_CHUNK, upload_id, uploads.OFFSET.pack(0) + body[:500]))
+            self.assertEqual((await ws.receive_json_from())["offset"], 500)
+            await ws.disconnect()
+
+            # Reconnect and resume from the offset the server reports.
+            ws = await self.connect()
+            await ws.send_to(bytes_data=self.frame(uploads.OP_START, upload_id, meta))
+            offset = (await ws.receive_json_from())["offset"]
+            self.assertEqual(offset, 500)
+            await ws.send_to(bytes_data=self.frame(uploads.OP_CHUNK, upload_id, uploads.OFFSET.pack(offset) + body[offset:]))
+            self.assertEqual((await ws.receive_json_from())["offset"], len(body))
+
+            await ws.send_to(bytes_data=self.frame(uploads.OP_FINISH, upload_id))
+            self.assertEqual((await ws.receive_json_from())["type"], "upload_done")
+            event = await ws.receive_json_from()
+            self.assertEqual(event["type"], "file")
+            self.assertEqual(event["filename"], "notes.txt")
+            await ws.disconnect()
+
+        async_to_sync(run)()
+        msg = Message.objects.get()
+        with msg.file.open("rb") as fh:
+            self.assertEqual(fh.read(), b"hello world, " * 100)
+
+    def test_upload_size_cap(self):
+        async def run():
+            meta = json.dumps({"kind": "file", "filename": "big.bin", "size": 2048}).encode()
+            ws = await self.connect()
+            await ws.send_to(bytes_data=self.frame(uploads.OP_START, b"\x02" * 16, meta))
+            reply = await ws.receive_json_from()
+            await ws.disconnect()
+            return reply
+
+        with override_settings(CHAT_UPLOAD_MAX_BYTES=1024):
+            reply = async_to_sync(run)()
+        self.assertEqual(reply["type"], "upload_error")
+
+    def test_oversized_legacy_upload_gets_an_error(self):
+        big = "data:application/octet-stream;base64," + base64.b64encode(b"x" * 2048).decode()
+
+        async def run():
+            ws = await self.connect()
+            await ws.send_json_to({"type": "file", "file": big, "filename": "big.bin"})
+            file_reply = await ws.receive_json_from()
+            await ws.send_json_to({"type": "image", "image": big})
+            image_reply = await ws.receive_json_from()
+            await ws.disconnect()
+            return file_reply, image_reply
+
+        with override_settings(CHAT_UPLOAD_MAX_BYTES=1024):
+            replies = async_to_sync(run)()
+        for reply in replies:
+            self.assertEqual(reply, {"type": "upload_error", "upload_id": None, "error": "File too large"})
+        self.assertFalse(Message.objects.exists())
+
+
+class ImagePipelineTests(ChatConsumerTestCase):
+    @classmethod
+    def tearDownClass(cls):
+        images.shutdown_pool()
+        super().tearDownClass()
+
+    def test_image_is_reencoded_with_thumbnails(self):
+        buf = BytesIO()
+        exif = Image.Exif()
+        exif[0x010F] = "CameraMaker"
+        Image.new("RGB", (1200, 800), "red").save(buf, "JPEG", exif=exif)
+        data_url = "data:image/jpeg;base64," + base64.b64encode(buf.getvalue()).decode()
+
+        async def run():
+            ws = await self.connect()
+            await ws.send_json_to({"type": "image", "image": data_url})
+            event = await ws.receive_json_from(timeout=30)
+            await ws.disconnect()
+            return event
+
+        event = async_to_sync(run)()
+        self.assertEqual(sorted(event["thumbnails"]), ["160", "480"])
+        msg = Message.objects.get()
+        self.assertTrue(msg.image.name.endswith(".webp"))
+        with Image.open(msg.image.path) as img:
+            self.assertEqual(img.format, "WEBP")
+            self.assertFalse(img.getexif())
+        with Image.open(msg.image.storage.path(msg.thumbnails["160"])) as thumb:
+            self.assertEqual(thumb.size, (160, 107))
+
+    def test_rejected_image_is_not_broadcast(self):
+        bogus = "data:image/png;base64," + base64.b64encode(b"not an image at all").decode()
+
+        async def run():
+            sender = await self.connect("imgs")
+            other = await self.connect("imgs")
+            await sender.send_json_to({"type": "image", "image": bogus})
+            reply = await sender.receive_json_from(timeout=10)
+            nothing = await other.receive_nothing(timeout=0.3)
+            await sender.disconnect()
+            await other.disconnect()
+            return reply, nothing
+
+        reply, nothing = async_to_sync(run)()
+        self.assertEqual(reply["type"], "upload_error")
+        self.assertIsNone(reply["upload_id"])
+        self.assertTrue(nothing)
+        self.assertFalse(Message.objects.exists())
+
+
+class HistoryTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username="bob", password="pw")
+        self.room = Room.objects.create(name="history")
+        self.ids = [
+            Message.objects.create(user=self.user, room=self.room, content=str(i)).pk
+            for i in range(12)
+        ]
+
+    def test_pages_walk_backwards_with_single_query(self):
+        with self.assertNumQueries(1):
+            page, has_more = history.fetch_page("history", limit=5)
+        self.assertEqual([m["id"] for m in page], self.ids[-5:])
+        self.assertTrue(has_more)
+
+        with self.assertNumQueries(1):
+            page, has_more = history.fetch_page("history", before=page[0]["id"], limit=5)
+        self.assertEqual([m["id"] for m in page], self.ids[-10:-5])
+
+        page, has_more = history.fetch_page("history", before=page[0]["id"], limit=5)
+        self.assertEqual([m["id"] for m in page], self.ids[:2])
+        self.assertFalse(has_more)
+
+
+class HistoryCacheTests(ChatConsumerTestCase):
+    def test_connect_serves_cached_history_with_write_through(self):
+        async def run():
+            ws = await self.connect("cached")
+            await ws.send_json_to({"type": "chat", "message": "first"})
+            await ws.receive_json_from()
+            await ws.disconnect()
+
+        async_to_sync(run)()
+        # warmed by the first connect, then extended by create_text_message
+        self.assertEqual(len(get_history_cache().ring.load("cached")), 1)
+
+        async def reconnect():
+            ws = await self.connect("cached")
+            await ws.disconnect()
+            return ws.history
+
+        with CaptureQueriesContext(connection) as queries:
+            history_messages = async_to_sync(reconnect)()
+        self.assertFalse([q for q in queries if "chat_message" in q["sql"]])
+        self.assertEqual([m["id"] for m in history_messages], [Message.objects.get().pk])
+
+    def test_message_committed_during_a_cold_fill_is_kept(self):
+        cache = get_history_cache()
+        snapshot = [json.dumps({"id": 1, "message": "old"})]
+
+        def loader(room):
+            # a message commits and is written through after the snapshot was read
+            cache.append(room, {"id": 2, "message": "new"})
+            return [json.loads(e) for e in snapshot], False
+
+        entries, _ = cache.get("racy", loader)
+        self.assertEqual([json.loads(e)["id"] for e in cache.ring.load("racy")], [1, 2])
+        # a second, stale fill does not overwrite the warm ring
+        cache.ring.fill("racy", snapshot)
+        self.assertEqual(len(cache.ring.load("racy")), 2)
+
+
+class WriteBehindTests(ChatConsumerTestCase):
+    def test_broadcast_before_batched_insert(self):
+        persister = persistence.WriteBehindPersister(max_batch=10, max_delay=60)
+
+        async def run():
+            ws = await self.connect("wb")
+            for text in ("one", "two", "three"):
+                await ws.send_json_to({"type": "chat", "message": text})
+            events = [await ws.receive_json_from() for _ in range(3)]
+            self.assertEqual(await database_sync_to_async(Message.objects.count)(), 0)
+            self.assertEqual(persister.stats()["pending"], 3)
+            await persister.flush()
+            await ws.disconnect()
+            return events
+
+        with override_settings(CHAT_WRITE_BEHIND=True), \
+                mock.patch.object(persistence, "_persister", persister):
+            events = async_to_sync(run)()
+
+        rows = list(Message.objects.order_by("id"))
+        self.assertEqual([m.pk for m in rows], [e["id"] for e in events])
+        self.assertEqual([m.decrypted() for m in rows], ["one", "two", "three"])
+        self.assertEqual(persister.stats()["flushed_batches"], 1)
+
+    def test_reserved_ids_are_not_taken_by_other_inserts_and_shutdown_flushes(self):
+        room = Room.objects.create(name="wb2")
+        persister = persistence.WriteBehindPersister(max_batch=10, max_delay=60)
+        sent = []
+
+        async def lifespan_shutdown():
+            msg = await persister.submit(self.user, room.pk, "queued")
+            sent.append(msg.pk)
+            # an image/file message inserted meanwhile with autoincrement
+            other = await database_sync_to_async(Message.objects.create)(user=self.user, room=room, content="")
+            sent.append(other.pk)
+            events = iter([{"type": "lifespan.startup"}, {"type": "lifespan.shutdown"}])
+            replies = []
+
+            async def receive():
+                return next(events)
+
+            async def send(message):
+                replies.append(message["type"])
+
+            await persistence.lifespan({"type": "lifespan"}, receive, send)
+            return replies
+
+        with mock.patch.object(persistence, "_persister", persister):
+            replies = async_to_sync(lifespan_shutdown)()
+
+        self.assertEqual(replies, ["lifespan.startup.complete", "lifespan.shutdown.complete"])
+        self.assertNotEqual(sent[0], sent[1])
+        self.assertEqual(sorted(Message.objects.values_list("pk", flat=True)), sorted(sent))
+        self.assertEqual(persister.stats()["failed_rows"], 0)
+
+    def test_room_deleted_before_flush_is_recreated(self):
+        room = Room.objects.create(name="wb3")
+        persister = persistence.WriteBehindPersister(max_batch=10, max_delay=60)
+
+        async def submit():
+            return await persister.submit(self.user, room.pk, "kept", "wb3")
+
+        msg = async_to_sync(submit)()
+        # deleted by another process: this one's room cache still holds the old id
+        Room.objects.filter(pk=room.pk).delete()
+        persister.flush_sync()
+
+        saved = Message.objects.get(pk=msg.pk)
+        self.assertEqual(saved.room.name, "wb3")
+        self.assertNotEqual(saved.room_id, room.pk)
+        self.assertEqual(saved.decrypted(), "kept")
+        self.assertEqual(persister.stats()["failed_rows"], 0)
+
+    def test_full_queue_is_written_by_the_sender(self):
+        room = Room.objects.create(name="wb4")
+        persister = persistence.WriteBehindPersister(max_batch=10, max_delay=60, max_pending=3)
+
+        async def run():
+            ids = [(await persister.submit(self.user, room.pk, f"m{i}")).pk for i in range(2)]
+            self.assertEqual(persister.stats()["pending"], 2)
+            ids.append((await persister.submit(self.user, room.pk, "m2")).pk)
+            # the third send reached the cap and wrote the queue before returning
+            self.assertEqual(persister.stats()["pending"], 0)
+            return ids
+
+        ids = async_to_sync(run)()
+        rows = list(Message.objects.order_by("seq"))
+        self.assertEqual([(m.pk, m.decrypted()) for m in rows], list(zip(ids, ["m0", "m1", "m2"])))
+        self.assertEqual(persister.stats()["sync_flushes"], 1)
+
+
+class TypingTests(ChatConsumerTestCase):
+    def test_keystrokes_are_coalesced_per_room(self):
+        bob = User.objects.create_user(username="bob", password="pw")
+
+        async def run():
+            alice_ws = await self.connect("typing")
+            bob_ws = await self.connect("typing", user=bob)
+            for _ in range(20):
+                await alice_ws.send_json_to({"type": "typing"})
+            await bob_ws.send_json_to({"type": "typing"})
+            event = await alice_ws.receive_json_from(timeout=2)
+            self.assertTrue(await alice_ws.receive_nothing(timeout=0.7))
+            await alice_ws.disconnect()
+            await bob_ws.disconnect()
+            return event
+
+        with mock.patch.object(typing_state, "_aggregator", typing_state.TypingAggregator(interval=0.1)):
+            event = async_to_sync(run)()
+        self.assertEqual(event, {"type": "typing_state", "usernames": ["alice", "bob"]})
+
+
+class PresenceTests(ChatConsumerTestCase):
+    def test_second_tab_keeps_user_online(self):
+        async def run():
+            tab1 = await self.connect("presence")
+            tab2 = await self.connect("presence")
+            await tab1.disconnect()
+            await tab2.send_json_to({"type": "presence"})
+            reply = await tab2.receive_json_from()
+            online_after_one = await database_sync_to_async(get_presence().online_user_ids)([self.user.pk])
+            await tab2.disconnect()
+            return reply, online_after_one
+
+        reply, online_after_one = async_to_sync(run)()
+        self.assertEqual(reply, {"type": "presence", "usernames": ["alice"]})
+        self.assertEqual(online_after_one, {self.user.pk})
+        self.assertEqual(get_presence().room_usernames("presence"), [])
+
+        self.assertFalse(UserStatus.objects.exists())
+        with CaptureQueriesContext(connection) as queries:
+            get_presence().flush_last_seen()
+        self.assertEqual(len([q for q in queries if "chat_userstatus" in q["sql"]]), 1)
+        self.assertFalse(UserStatus.objects.get(user=self.user).is_online)
+
+    def test_heartbeat_expires_users_left_online_by_a_dead_process(self):
+        bob = User.objects.create_user(username="bob", password="pw")
+        presence = get_presence()
+        presence.connect("alice-conn", self.user, "presence")
+        presence.flush_last_seen()
+        # bob's process crashed: his row says online but no connection is registered
+        long_ago = datetime.fromtimestamp(0, tz=dt_timezone.utc)
+        UserStatus.objects.create(user=bob, is_online=True, last_seen=long_ago)
+        # alice has been connected for longer than the TTL
+        UserStatus.objects.filter(user=self.user).update(last_seen=long_ago)
+
+        presence.beat()
+
+        self.assertFalse(UserStatus.objects.get(user=bob).is_online)
+        self.assertTrue(UserStatus.objects.get(user=self.user).is_online)
+
+
+class RoomCacheTests(ChatConsumerTestCase):
+    def test_messages_write_with_cached_room_id(self):
+        Room.objects.create(name="cached-room")
+
+        async def run():
+            ws = await self.connect("cached-room")
+            for text in ("a", "b", "c"):
+                await ws.send_json_to({"type": "chat", "message": text})
+                await ws.receive_json_from()
+            await ws.disconnect()
+
+        with CaptureQueriesContext(connection) as queries:
+            async_to_sync(run)()
+        # only the lookup on connect
+        self.assertEqual(len([q for q in queries if 'FROM "chat_room"' in q["sql"]]), 1)
+        self.assertEqual(Message.objects.filter(room__name="cached-room").count(), 3)
+
+    def test_deleted_room_is_recreated_on_next_message(self):
+        async def run():
+            ws = await self.connect("gone")
+            await ws.send_json_to({"type": "chat", "message": "before"})
+            await ws.receive_json_from()
+            await database_sync_to_async(Room.objects.filter(name="gone").delete)()
+            await ws.send_json_to({"type": "chat", "message": "after"})
+            await ws.receive_json_from()
+            await ws.disconnect()
+
+        async_to_sync(run)()
+        self.assertEqual(Message.objects.filter(room__name="gone").count(), 1)
+        self.assertEqual(get_room_cache().get("gone").id, Room.objects.get(name="gone").pk)
+
+
+class EncryptionTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username="carol", password="pw")
+        self.room = Room.objects.create(name="secret")
+
+    def test_content_is_encrypted_at_rest_and_history_is_plain(self):
+        Message.objects.create(user=self.user, room=self.room, content="xin chào")
+        stored = Message.objects.values_list("content", flat=True).get()
+        self.assertNotEqual(stored, "xin chào")
+        page, _ = history.fetch_page("secret")
+        self.assertEqual(page[0]["message"], "xin chào")
+
+    def test_new_text_on_a_loaded_message_is_encrypted(self):
+        Message.objects.create(user=self.user, room=self.room, content="cũ")
+        msg = Message.objects.get()
+        msg.content = "đã sửa"
+        msg.save()
+        stored = Message.objects.values_list("content", flat=True).get()
+        self.assertNotEqual(stored, "đã sửa")
+        self.assertEqual(crypto.decrypt(stored), "đã sửa")
+        msg.refresh_from_db()
+        self.assertEqual(msg.decrypted(), "đã sửa")
+
+    def test_rotate_message_keys(self):
+        old_key = Fernet.generate_key().decode()
+        new_key = Fernet.generate_key().decode()
+        with override_settings(CHAT_ENCRYPTION_KEYS=[old_key]):
+            for i in range(150):
+                Message.objects.create(user=self.user, room=self.room, content=f"m{i}")
+
+        with override_settings(CHAT_ENCRYPTION_KEYS=[new_key, old_key]):
+            call_command("rotate_message_keys", chunk_size=40, stdout=StringIO())
+            self.assertFalse(any(crypto.needs_rotation(t) for t in Message.objects.values_list("content", flat=True)))
+
+        with override_settings(CHAT_ENCRYPTION_KEYS=[new_key]):
+            page, _ = history.fetch_page("secret", limit=150)
+        self.assertEqual([m["message"] for m in page], [f"m{i}" for i in range(150)])
+
+
+class SearchTests(ChatConsumerTestCase):
+    def test_search_is_indexed_on_write_and_scoped_to_accessible_rooms(self):
+        bob = User.objects.create_user(username="bob", password="pw")
+        private = Room.objects.create(name="private", is_private=True)
+        private.set_password("pw")
+        private.save()
+
+        async def run():
+            ws = await self.connect("public")
+            for text in ("Xin chào cả nhà", "deploy xong rồi", "chào buổi sáng"):
+                await ws.send_json_to({"type": "chat", "message": text})
+                await ws.receive_json_from()
+            await ws.send_json_to({"type": "search", "q": "chao"})
+            reply = await ws.receive_json_from()
+            await ws.disconnect()
+
+            ws = await self.connect("private")
+            await ws.send_json_to({"type": "chat", "message": "chào bí mật"})
+            await ws.receive_json_from()
+            await ws.disconnect()
+            return reply
+
+        reply = async_to_sync(run)()
+        self.assertEqual([r["message"] for r in reply["results"]], ["chào buổi sáng", "Xin chào cả nhà"])
+
+        self.client.force_login(bob)
+        data = self.client.get("/chat/search/", {"q": "chào", "limit": 1}).json()
+        self.assertEqual([r["message"] for r in data["results"]], ["chào buổi sáng"])
+        data = self.client.get("/chat/search/", {"q": "chào", "before": data["next_before"]}).json()
+        self.assertEqual([r["message"] for r in data["results"]], ["Xin chào cả nhà"])
+        self.assertIsNone(data["next_before"])
+
+
+class BenchTests(ChatConsumerTestCase):
+    def test_ws_benchmark_runs_all_flows_and_records_results(self):
+        from chat_project.asgi import application
+
+        results = async_to_sync(bench.run_benchmark)(
+            application, rooms=2, clients_per_room=3, messages=2, senders=2,
+            typing_rounds=1, images=1, timeout=20, log=lambda line: None,
+        )
+        self.assertTrue(results["chat"]["complete"])
+        self.assertEqual(results["chat"]["count"], 2 * 3 * 4)
+        self.assertTrue(results["image"]["complete"])
+        self.assertGreater(results["typing"]["typing_state_frames"], 0)
+
+        path = f"{self.upload_dir}/bench.jsonl"
+        self.assertIsNone(bench.save_result(path, results))
+        self.assertEqual(bench.save_result(path, results)["params"], results["params"])
+
+
+class MetricsTests(ChatConsumerTestCase):
+    def test_consumer_activity_is_exported_on_metrics_route(self):
+        metrics.reset()
+
+        async def run():
+            ws = await self.connect("lobby")
+            await ws.send_json_to({"type": "chat", "message": "xin chào"})
+            await ws.receive_json_from()
+            await ws.send_json_to({"type": "bogus"})
+            self.assertEqual(metrics.CONNECTIONS.value("lobby"), 1)
+            await ws.disconnect()
+
+        async_to_sync(run)()
+        self.assertEqual(metrics.CONNECTIONS.value("lobby"), 0)
+        self.assertEqual(metrics.RECEIVED.value("chat"), 1)
+        self.assertEqual(metrics.HANDLER_SECONDS.count("create_text_message"), 1)
+        self.assertEqual(metrics.HANDLER_SECONDS.count("broadcast_frame"), 1)
+
+        # no token: not public outside DEBUG, staff only
+        self.assertEqual(self.client.get("/metrics").status_code, 403)
+        self.user.is_staff = True
+        self.user.save()
+        self.client.force_login(self.user)
+        body = self.client.get("/metrics").content.decode()
+        self.client.logout()
+        self.assertIn('chat_received_events_total{type="other"} 1', body)
+        self.assertIn('chat_handler_seconds_count{handler="get_recent_history"} 1', body)
+        self.assertIn('chat_handler_seconds_bucket{handler="create_text_message",le="+Inf"} 1', body)
+        self.assertIn('chat_executor_queue_depth{pool="database_sync_to_async"}', body)
+        self.assertIn("chat_outbound_bytes_total ", body)
+
+        with override_settings(CHAT_METRICS_TOKEN="s3cret"):
+            self.assertEqual(self.client.get("/metrics").status_code, 403)
+            self.assertEqual(self.client.get("/metrics", HTTP_AUTHORIZATION="Bearer s3cret").status_code, 200)
+
+
+class DirectoryTests(ChatConsumerTestCase):
+    def test_directory_page_is_one_query_cached_and_invalidated(self):
+        self.client.force_login(self.user)
+        for i in range(3):
+            room = Room.objects.create(name=f"r{i}", created_by=self.user)
+            room.members.add(self.user)
+        locked = Room.objects.get(name="r1")
+        locked.set_password("pw")
+        locked.save()
+
+        async def send(room, text):
+            ws = await self.connect(room)
+            await ws.send_json_to({"type": "chat", "message": text})
+            await ws.receive_json_from()
+            await ws.disconnect()
+
+        async_to_sync(send)("r0", "xin chào phòng r0")
+
+        with CaptureQueriesContext(connection) as ctx:
+            data = self.client.get("/chat/rooms/", {"page": 1}).json()
+        # COUNT + the annotated page, plus the per-user unread counts
+        self.assertEqual(len([q for q in ctx.captured_queries if "chat_room" in q["sql"]]), 3)
+        self.assertEqual([r["name"] for r in data["rooms"]], ["r0", "r1", "r2"])
+        self.assertEqual(data["rooms"][0]["preview"], "xin chào phòng r0")
+        self.assertEqual(data["rooms"][0]["member_count"], 1)
+        self.assertEqual([r["locked"] for r in data["rooms"]], [False, True, False])
+
+        with CaptureQueriesContext(connection) as ctx:
+            self.assertContains(self.client.get("/chat/home/"), "xin chào phòng r0")
+        self.assertEqual(len([q for q in ctx.captured_queries if "chat_room" in q["sql"]]), 1)
+
+        # room changes drop every page at once
+        Room.objects.create(name="r3")
+        self.assertEqual(self.client.get("/chat/rooms/").json()["count"], 4)
+
+        # new messages refresh a page once it is older than the staleness window
+        async_to_sync(send)("r2", "mới nhất")
+        self.assertIsNone(self.client.get("/chat/rooms/").json()["rooms"][2]["preview"])
+        get_directory_cache().message_staleness = 0
+        self.assertEqual(self.client.get("/chat/rooms/").json()["rooms"][2]["preview"], "mới nhất")
+
+    def test_locked_room_preview_only_for_users_who_can_open_it(self):
+        room = Room.objects.create(name="secret", created_by=self.user)
+        room.set_password("pw")
+        room.save()
+        room.members.add(self.user)
+        Message.objects.create(user=self.user, room=room, content="kế hoạch bí mật")
+        bob = User.objects.create_user(username="bob", password="pw")
+
+        self.client.force_login(bob)
+        row = self.client.get("/chat/rooms/").json()["rooms"][0]
+        self.assertEqual((row["last_username"], row["preview"]), (None, None))
+        self.assertIsNotNone(row["last_message_time"])
+        self.assertNotContains(self.client.get("/chat/home/"), "kế hoạch bí mật")
+
+        # unlocked in bob's session, then the member's own view
+        self.client.post("/chat/room/secret/", {"password": "pw"})
+        self.assertEqual(self.client.get("/chat/rooms/").json()["rooms"][0]["preview"], "kế hoạch bí mật")
+        other = Client()
+        other.force_login(self.user)
+        row = other.get("/chat/rooms/").json()["rooms"][0]
+        self.assertEqual((row["last_username"], row["preview"]), ("alice", "kế hoạch bí mật"))
+
+
+class ReadStateTests(ChatConsumerTestCase):
+    def test_unread_counts_follow_debounced_read_pointer(self):
+        bob = User.objects.create_user(username="bob", password="pw")
+        for name in ("a", "b"):
+            Room.objects.create(name=name)
+
+        async def run():
+            alice = await self.connect("a")
+            for text in ("1", "2", "3"):
+                await alice.send_json_to({"type": "chat", "message": text})
+                await alice.receive_json_from()
+            ids = [m.pk for m in await database_sync_to_async(list)(Message.objects.order_by("pk"))]
+
+            ws = await self.connect("a", user=bob)
+            await ws.send_json_to({"type": "read", "id": ids[1]})
+            await ws.send_json_to({"type": "read", "id": ids[0]})  # older report is ignored
+            await ws.disconnect()
+            await alice.disconnect()
+            await asyncio.sleep(0.2)  # let the debounced flush run
+
+        with override_settings(CHAT_READ_DEBOUNCE=0.05):
+            reset_read_marker()
+            async_to_sync(run)()
+            self.assertEqual(get_read_marker().flush(), 0)
+
+        self.assertEqual(list(Message.objects.order_by("pk").values_list("seq", flat=True)), [1, 2, 3])
+        self.assertEqual(ReadState.objects.get(user=bob).last_read_seq, 2)
+        self.assertEqual(unread_counts(bob, ["a", "b"]), {"a": 1, "b": 0})
+        # senders have read their own messages
+        self.assertEqual(unread_counts(self.user, ["a"]), {"a": 0})
+
+
+class CompactProtocolTests(ChatConsumerTestCase):
+    def test_compact_clients_get_msgpack_frames_json_clients_unchanged(self):
+        import msgpack
+
+        async def run():
+            plain = await self.connect("lobby")
+            communicator = WebsocketCommunicator(
+                URLRouter(websocket_urlpatterns), "/ws/chat/lobby/", subprotocols=[wire.SUBPROTOCOL],
+            )
+            communicator.scope["user"] = self.user
+            connected, subprotocol = await communicator.connect()
+            self.assertEqual(subprotocol, wire.SUBPROTOCOL)
+            history = msgpack.unpackb((await communicator.receive_output())["bytes"], strict_map_key=False)
+
+            await communicator.send_to(bytes_data=msgpack.packb({0: wire.TYPES["chat"], 3: "xin chào"}))
+            packed = (await communicator.receive_output())["bytes"]
+            text = await plain.receive_json_from()
+
+            await communicator.send_json_to({"type": "search", "q": "chào"})
+            page = msgpack.unpackb((await communicator.receive_output())["bytes"], strict_map_key=False)
+            await communicator.disconnect()
+            await plain.disconnect()
+            return history, packed, text, page
+
+        history, packed, text, page = async_to_sync(run)()
+        self.assertEqual(history, {0: wire.TYPES["history"], 10: [], 11: False})
+
+        chat = msgpack.unpackb(packed, strict_map_key=False)
+        self.assertEqual(chat[0], wire.TYPES["chat"])
+        self.assertEqual(chat[3], "xin chào")
+        self.assertEqual(chat[4], text["ts"])
+        self.assertNotIn("timestamp", chat)
+        self.assertLess(len(packed), len(json.dumps(text).encode()) * 0.7)
+
+        self.assertEqual(text["message"], "xin chào")
+        self.assertIn("timestamp", text)
+
+        # message lists are positional rows: id, username, message, type, ts, ..., room
+        self.assertEqual(page[0], wire.TYPES["search_results"])
+        self.assertEqual(page[13], [[text["id"], "alice", "xin chào", wire.TYPES["chat"], text["ts"],
+                                     None, None, None, None, "lobby"]])
+
+    def test_broadcasts_carry_json_only_and_are_packed_once_per_process(self):
+        event = frame_event({"type": "chat", "id": 1, "username": "bob", "message": "hi"})
+        self.assertNotIn("packed", event)
+        with mock.patch.object(wire, "pack", wraps=wire.pack) as pack:
+            first = packed_frame(event["frame"])
+            self.assertIs(packed_frame(event["frame"]), first)
+        self.assertEqual(pack.call_count, 1)
+
+
+class ResyncTests(ChatConsumerTestCase):
+    def test_reconnect_gets_only_missed_messages_in_pages_or_a_gap_marker(self):
+        room = Room.objects.create(name="resync")
+        ids = [Message.objects.create(user=self.user, room=room, content=f"m{i}").pk for i in range(8)]
+
+        async def reconnect(since):
+            communicator = WebsocketCommunicator(URLRouter(websocket_urlpatterns), f"/ws/chat/resync/?since={since}")
+            communicator.scope["user"] = self.user
+            connected, _ = await communicator.connect()
+            self.assertTrue(connected)
+            frames = [await communicator.receive_json_from()]
+            while frames[-1]["type"] == "history_delta" and frames[-1]["has_more"] or frames[-1]["type"] == "resync_gap":
+                frames.append(await communicator.receive_json_from())
+            await communicator.disconnect()
+            return frames
+
+        with override_settings(CHAT_HISTORY_CACHE_SIZE=3, CHAT_RESYNC_MAX_MESSAGES=5), \
+                mock.patch.object(history, "PAGE_SIZE", 2):
+            reset_history_cache()
+            async_to_sync(reconnect)(ids[-1])  # warm the ring with the newest 3
+
+            # covered by the recent-history ring: no message query
+            with CaptureQueriesContext(connection) as queries:
+                frames = async_to_sync(reconnect)(ids[6])
+            self.assertFalse([q for q in queries if "chat_message" in q["sql"]])
+            self.assertEqual([[m["id"] for m in f["messages"]] for f in frames], [[ids[7]]])
+
+            # older than the ring: bounded pages from the database
+            frames = async_to_sync(reconnect)(ids[2])
+            self.assertEqual({f["type"] for f in frames}, {"history_delta"})
+            self.assertEqual([[m["id"] for m in f["messages"]] for f in frames], [ids[3:5], ids[5:7], ids[7:]])
+
+            # too far behind: marker, then the normal history frame
+            frames = async_to_sync(reconnect)(ids[1])
+            self.assertEqual([f["type"] for f in frames], ["resync_gap", "history"])
+            self.assertEqual([m["id"] for m in frames[1]["messages"]], ids[-3:])
+
+    def test_resync_follows_send_order_across_write_behind_id_blocks(self):
+        room = Room.objects.create(name="blocks")
+        # two processes reserved ids 1-100 and 101-200 and send alternately
+        sent = [1, 101, 2, 102, 3]
+        start = datetime(2026, 1, 1, tzinfo=dt_timezone.utc)
+        for n, pk in enumerate(sent):
+            Message.objects.create(
+                id=pk, user=self.user, room=room, content=f"m{n}", timestamp=start + timedelta(seconds=n),
+            )
+
+        # the client got 101 last; 2 came after it despite the lower id
+        messages, more = history.fetch_since("blocks", 101)
+        self.assertEqual(([m["id"] for m in messages], more), ([2, 102, 3], False))
+        self.assertFalse(history.missed_more_than("blocks", 101, 3))
+        self.assertTrue(history.missed_more_than("blocks", 101, 2))
+        entries = [json.dumps({"id": pk}) for pk in sent]
+        self.assertEqual([json.loads(e)["id"] for e in history.entries_after(entries, 101)], [2, 102, 3])
+        # a cursor that is not stored (still queued elsewhere) falls back to a full reload
+        self.assertIsNone(history.entries_after(entries, 150))
+        self.assertTrue(history.missed_more_than("blocks", 150, 3))
+
+        async def reconnect():
+            communicator = WebsocketCommunicator(URLRouter(websocket_urlpatterns), "/ws/chat/blocks/?since=101")
+            communicator.scope["user"] = self.user
+            await communicator.connect()
+            frame = await communicator.receive_json_from()
+            await communicator.disconnect()
+            return frame
+
+        with override_settings(CHAT_HISTORY_CACHE_SIZE=2):
+            reset_history_cache()
+            frame = async_to_sync(reconnect)()
+        self.assertEqual((frame["type"], [m["id"] for m in frame["messages"]]), ("history_delta", [2, 102, 3]))
+
+
+class AttachmentTests(ChatConsumerTestCase):
+    @classmethod
+    def tearDownClass(cls):
+        images.shutdown_pool()
+        super().tearDownClass()
+
+    def test_same_content_is_stored_once_and_freed_with_its_last_message(self):
+        pdf = b"%PDF-1.4 the same report " * 50
+        file_url = "data:application/pdf;base64," + base64.b64encode(pdf).decode()
+        buf = BytesIO()
+        Image.new("RGB", (600, 400), "blue").save(buf, "PNG")
+        image_url = "data:image/png;base64," + base64.b64encode(buf.getvalue()).decode()
+        processed = []
+        real_process = images.process
+
+        async def counting_process(**kwargs):
+            processed.append(kwargs)
+            return await real_process(**kwargs)
+
+        async def run():
+            events = []
+            for room in ("forward-a", "forward-b"):
+                ws = await self.connect(room)
+                await ws.send_json_to({"type": "file", "file": file_url, "filename": "report.pdf"})
+                events.append(await ws.receive_json_from())
+                await ws.send_json_to({"type": "image", "image": image_url})
+                events.append(await ws.receive_json_from(timeout=30))
+                await ws.disconnect()
+            return events
+
+        with mock.patch.object(images, "process", counting_process):
+            file_a, image_a, file_b, image_b = async_to_sync(run)()
+
+        # the second room reuses both blobs: one re-encode, same immutable URLs
+        self.assertEqual(len(processed), 1)
+        self.assertEqual(file_a["file_url"], file_b["file_url"])
+        self.assertEqual((image_a["image"], image_a["thumbnails"]), (image_b["image"], image_b["thumbnails"]))
+        self.assertEqual(file_b["filename"], "report.pdf")
+        self.assertEqual(sorted(Attachment.objects.values_list("kind", "refcount")), [("file", 2), ("image", 2)])
+
+        response = self.client.get(file_a["file_url"])
+        self.assertEqual(response["Cache-Control"], attachments.CACHE_CONTROL)
+        self.assertEqual(streamed(response), pdf)
+
+        blob = Attachment.objects.get(kind="file").name
+        Room.objects.get(name="forward-a").delete()
+        self.assertEqual(set(Attachment.objects.values_list("refcount", flat=True)), {1})
+        Room.objects.get(name="forward-b").delete()
+        self.assertFalse(Attachment.objects.exists())
+        self.assertFalse(attachments.default_storage.exists(blob))
+
+    def test_new_row_does_not_take_over_a_file_being_collected(self):
+        sha256 = attachments.digest_bytes(b"report")
+        stale = attachments.blob_name(sha256, "pdf")
+        # the files of a row another process is collecting: its delete comes later
+        attachments.default_storage.save(stale, attachments.ContentFile(b"report"))
+
+        create = functools.partial(Message.objects.create, user=self.user, room=Room.objects.create(name="race"), content="")
+        attachments.attach_file(create, sha256, b"report", "report.pdf")
+        attachments.default_storage.delete(stale)
+
+        attachment = Attachment.objects.get()
+        self.assertNotEqual(attachment.name, stale)
+        with attachments.default_storage.open(attachment.name) as fh:
+            self.assertEqual(fh.read(), b"report")
+
+    def test_room_and_user_deletes_release_each_reference_once_without_loading_messages(self):
+        bob = User.objects.create_user(username="bob", password="pw")
+        bobs_room = Room.objects.create(name="bobs", created_by=bob)
+        other = Room.objects.create(name="other")
+        sha256 = attachments.digest_bytes(b"shared")
+        for user, room in [(bob, bobs_room), (self.user, bobs_room), (bob, other), (bob, other), (self.user, other)]:
+            create = functools.partial(Message.objects.create, user=user, room=room, content="")
+            attachments.attach_file(create, sha256, b"shared", "shared.txt")
+        self.assertEqual(Attachment.objects.get().refcount, 5)
+
+        # bob's room goes with him: his messages there are released once, not twice
+        bob.delete()
+        self.assertEqual(Attachment.objects.get().refcount, 1)
+
+        with CaptureQueriesContext(connection) as ctx:
+            other.delete()
+        self.assertFalse(Attachment.objects.exists())
+        deletes = [q["sql"] for q in ctx.captured_queries if q["sql"].startswith('DELETE FROM "chat_message"')]
+        self.assertEqual(len(deletes), 1)
+        self.assertIn('"room_id" IN', deletes[0])
+
+
+class ArchiveTests(ChatConsumerTestCase):
+    def test_archiving_needs_an_explicit_archive_root(self):
+        room = Room.objects.create(name="keep")
+        msg = Message.objects.create(user=self.user, room=room, content="old")
+        Message.objects.filter(pk=msg.pk).update(timestamp=datetime(2024, 1, 1, tzinfo=dt_timezone.utc))
+        with override_settings(CHAT_ARCHIVE_ROOT=None):
+            with self.assertRaisesMessage(CommandError, "CHAT_ARCHIVE_ROOT"):
+                call_command("archive_messages", days=30, stdout=StringIO())
+        self.assertTrue(Message.objects.filter(pk=msg.pk).exists())
+
+    def test_old_messages_move_to_segments_and_history_pages_read_through(self):
+        archive_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, archive_root, ignore_errors=True)
+        room = Room.objects.create(name="arch")
+        ids = []
+        for i in range(12):
+            create = functools.partial(Message.objects.create, user=self.user, room=room, content=f"m{i}")
+            if i == 2:
+                ids.append(attachments.attach_file(create, attachments.digest_bytes(b"old pdf"), b"old pdf", "old.pdf").pk)
+            else:
+                ids.append(create().pk)
+        for i, pk in enumerate(ids[:8]):
+            Message.objects.filter(pk=pk).update(timestamp=datetime(2025, 1 + i // 4, 10 + i, tzinfo=dt_timezone.utc))
+
+        with override_settings(CHAT_ARCHIVE_ROOT=archive_root):
+            call_command("archive_messages", days=30, stdout=StringIO())
+            self.assertEqual(list(Message.objects.order_by("pk").values_list("pk", flat=True)), ids[8:])
+            self.assertEqual(
+                list(room.archive_segments.order_by("first_id").values_list("month", "first_id", "last_id")),
+                [("2025-01", ids[0], ids[3]), ("2025-02", ids[4], ids[7])],
+            )
+
+            # keyset pages continue from the hot table into the archive
+            page, has_more = history.fetch_page("arch", limit=5)
+            self.assertEqual([m["id"] for m in page], ids[7:])
+            self.assertTrue(has_more)
+            page, has_more = history.fetch_page("arch", before=page[0]["id"], limit=5)
+            self.assertEqual([m["id"] for m in page], ids[2:7])
+            self.assertEqual(page[0]["filename"], "old.pdf")
+            self.assertEqual([m["message"] for m in page[1:]], ["m3", "m4", "m5", "m6"])
+            page, has_more = history.fetch_page("arch", before=page[0]["id"], limit=5)
+            self.assertEqual([m["id"] for m in page], ids[:2])
+            self.assertFalse(has_more)
+
+            # archived messages keep their attachment until the room goes
+            self.assertEqual(Attachment.objects.get().refcount, 1)
+            room_dir = os.path.join(archive_root, str(room.pk))
+            room.delete()
+            self.assertFalse(Attachment.objects.exists())
+            self.assertEqual(os.listdir(room_dir), [])
+
+
+class TransferTests(ChatConsumerTestCase):
+    def test_export_and_import_round_trip_with_bundled_media(self):
+        work = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, work, ignore_errors=True)
+        dump = os.path.join(work, "room.ndjson.gz")
+        bob = User.objects.create_user(username="bob", password="pw")
+        room = Room.objects.create(name="move-me", is_private=True, created_by=self.user)
+        room.set_password("secret")
+        room.save()
+        room.members.add(self.user, bob)
+        for i in range(7):
+            create = functools.partial(Message.objects.create, user=bob if i % 2 else self.user, room=room, content=f"m{i}")
+            if i == 2:
+                attachments.attach_file(create, attachments.digest_bytes(b"pdf"), b"pdf", "a.pdf")
+            else:
+                create()
+        first = Message.objects.filter(room=room).order_by("pk").first()
+        Message.objects.filter(pk=first.pk).update(timestamp=datetime(2025, 1, 5, tzinfo=dt_timezone.utc))
+
+        with override_settings(CHAT_ARCHIVE_ROOT=os.path.join(work, "archive")):
+            call_command("archive_messages", days=30, stdout=StringIO())
+            out = StringIO()
+            call_command("export_room", "move-me", dump, bundle=True, chunk_size=3, stdout=out)
+        self.assertIn("rows/s", out.getvalue())
+        self.assertIn("Done: 7 messages", out.getvalue())
+
+        # a fresh deployment: no users, no media
+        blob = Attachment.objects.get().name
+        Room.objects.all().delete()
+        User.objects.exclude(username="alice").delete()
+        self.assertFalse(attachments.default_storage.exists(blob))
+
+        with self.assertRaisesMessage(CommandError, "Unknown users: bob"):
+            call_command("import_room", dump, room="moved", stdout=StringIO())
+        call_command("import_room", dump, room="moved", append=True, create_users=True, batch_size=3, stdout=out)
+
+        moved = Room.objects.get(name="moved")
+        self.assertTrue(moved.is_private and moved.check_password("secret"))
+        self.assertEqual(set(moved.members.values_list("username", flat=True)), {"alice", "bob"})
+        rows = list(Message.objects.filter(room=moved).order_by("seq"))
+        self.assertEqual([(m.seq, m.user.username, m.decrypted()) for m in rows],
+                         [(i + 1, "bob" if i % 2 else "alice", f"m{i}") for i in range(7)])
+        self.assertEqual(rows[0].timestamp, datetime(2025, 1, 5, tzinfo=dt_timezone.utc))
+        self.assertEqual(Room.objects.get(pk=moved.pk).message_seq, 7)
+
+        attachment = Attachment.objects.get()
+        self.assertEqual((attachment.refcount, rows[2].attachment_id, rows[2].filename), (1, attachment.pk, "a.pdf"))
+        with attachments.default_storage.open(attachment.name) as fh:
+            self.assertEqual(fh.read(), b"pdf")
+
+
+class RateLimitTests(ChatConsumerTestCase):
+    def test_floods_are_dropped_big_frames_and_slow_members_disconnected(self):
+        metrics.reset()
+        limits = {"chat": (0.001, 2), "default": (100, 100)}
+
+        async def run():
+            ws = await self.connect("limits")
+            for i in range(4):
+                await ws.send_json_to({"type": "chat", "message": f"spam {i}"})
+            frames = [await ws.receive_json_from() for _ in range(3)]
+            self.assertTrue(await ws.receive_nothing(timeout=0.2))
+
+            # a broadcast that waited past CHAT_OUTBOUND_MAX_LAG: the member is too slow
+            from channels.layers import get_channel_layer
+            stale = frame_event({"type": "chat", "id": 1, "username": "bob", "message": "late"})
+            stale["sent_at"] -= 60
+            await get_channel_layer().group_send("chat_limits", stale)
+            slow_close = await ws.receive_output()
+
+            big = await self.connect("limits")
+            await big.send_to(text_data="x" * 300)
+            big_close = await big.receive_output()
+            return frames, slow_close, big_close
+
+        with override_settings(CHAT_RATE_LIMITS=limits, CHAT_MAX_FRAME_BYTES=200):
+            frames, slow_close, big_close = async_to_sync(run)()
+
+        self.assertEqual([f["type"] for f in frames], ["chat", "chat", "rate_limited"])
+        self.assertEqual(frames[2]["event"], "chat")
+        self.assertGreater(frames[2]["retry_after"], 0)
+        self.assertEqual(Message.objects.count(), 2)
+        self.assertEqual(metrics.THROTTLED.value("chat", "connection"), 2)
+
+        self.assertEqual(slow_close, {"type": "websocket.close", "code": 1013})
+        self.assertEqual(metrics.SLOW_CONSUMERS.value("disconnect"), 1)
+        self.assertEqual(big_close["code"], 1009)
+        self.assertEqual(metrics.THROTTLED.value("frame", "too_large"), 1)
+
+    def test_throttled_chunks_resume_and_dropping_members_are_told_to_resync(self):
+        limits = {"upload_bytes": (1000, 1000), "default": (100, 100)}
+        upload_id = b"\x05" * 16
+        body = b"z" * 1500
+        meta = json.dumps({"kind": "file", "filename": "z.bin", "size": len(body)}).encode()
+
+        def frame(op, payload=b""):
+            return uploads.HEADER.pack(op, upload_id) + payload
+
+        async def run():
+            from channels.layers import get_channel_layer
+            ws = await self.connect("slow")
+            await ws.send_to(bytes_data=frame(uploads.OP_START, meta))
+            await ws.receive_json_from()
+            await ws.send_to(bytes_data=frame(uploads.OP_CHUNK, uploads.OFFSET.pack(0) + body[:900]))
+            await ws.receive_json_from()
+            await ws.send_to(bytes_data=frame(uploads.OP_CHUNK, uploads.OFFSET.pack(900) + body[900:]))
+            throttled = await ws.receive_json_from()
+
+            # another host 30s ahead: only delay beyond its usual skew counts
+            layer = get_channel_layer()
+            for text, skew in (("a", 30), ("b", 30), ("late", 90), ("c", 30)):
+                event = frame_event({"type": "chat", "id": 1, "username": "bob", "message": text})
+                event.update(origin="other-host", sent_at=event["sent_at"] - skew)
+                await layer.group_send("chat_slow", event)
+            frames = [await ws.receive_json_from() for _ in range(4)]
+            self.assertTrue(await ws.receive_nothing(timeout=0.2))
+            await ws.disconnect()
+            return throttled, frames
+
+        with override_settings(CHAT_RATE_LIMITS=limits, CHAT_OUTBOUND_POLICY="drop"):
+            throttled, frames = async_to_sync(run)()
+
+        self.assertEqual((throttled["type"], throttled["upload_id"]), ("rate_limited", upload_id.hex()))
+        self.assertGreater(throttled["retry_after"], 0)
+        self.assertEqual([f.get("message") for f in frames], ["a", "b", None, "c"])
+        self.assertEqual(frames[2], {"type": "resync_gap", "reconnect": True})
+
+
+class HandshakeAuthTests(ChatConsumerTestCase):
+    def handshake(self, session_key):
+        seen = []
+
+        async def app(scope, receive, send):
+            user = scope["user"]
+            seen.append(user.pk if user.is_authenticated else None)
+            await send({"type": "websocket.close"})
+
+        async def run():
+            communicator = WebsocketCommunicator(
+                CachedAuthMiddlewareStack(app), "/ws/chat/lobby/",
+                headers=[(b"cookie", f"{settings.SESSION_COOKIE_NAME}={session_key}".encode())],
+            )
+            await communicator.connect()
+
+        async_to_sync(run)()
+        return seen[0]
+
+    def test_warm_handshake_runs_no_queries_and_logout_is_respected(self):
+        metrics.reset()
+        client = Client()
+        client.force_login(self.user)
+        session_key = client.cookies[settings.SESSION_COOKIE_NAME].value
+
+        self.assertEqual(self.handshake(session_key), self.user.pk)  # fills the user cache
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(self.handshake(session_key), self.user.pk)
+        self.assertEqual(len(queries), 0)
+        self.assertEqual(metrics.HANDSHAKE_USERS.value("miss"), 1)
+        self.assertEqual(metrics.HANDSHAKE_USERS.value("hit"), 1)
+
+        client.logout()
+        self.assertIsNone(self.handshake(session_key))
+
+    def test_logout_in_another_process_is_respected(self):
+        client = Client()
+        client.force_login(self.user)
+        session_key = client.cookies[settings.SESSION_COOKIE_NAME].value
+        self.assertEqual(self.handshake(session_key), self.user.pk)
+
+        # the session goes away without this process's user cache hearing of it
+        with mock.patch.object(get_user_cache(), "discard"):
+            client.logout()
+        self.assertIsNone(self.handshake(session_key))
+
+    def test_cache_outage_falls_back_to_the_database(self):
+        client = Client()
+        client.force_login(self.user)
+        session_key = client.cookies[settings.SESSION_COOKIE_NAME].value
+        caches["sessions"].clear()
+        self.assertEqual(self.handshake(session_key), self.user.pk)
+
+        with mock.patch.object(caches["sessions"], "get", side_effect=ConnectionError), \
+                mock.patch.object(caches["sessions"], "set", side_effect=ConnectionError):
+            reset_user_cache()
+            self.assertEqual(self.handshake(session_key), self.user.pk)
+
+
+class ShardedLayerTests(TestCase):
+    def test_ring_moves_only_keys_that_land_on_a_new_shard(self):
+        keys = [f"chat_room{i}" for i in range(4000)]
+        three = HashRing(["redis://a", "redis://b", "redis://c"])
+        four = HashRing(["redis://a", "redis://b", "redis://c", "redis://d"])
+        before = [three.node(k) for k in keys]
+        after = [four.node(k) for k in keys]
+
+        self.assertTrue(all(800 < before.count(i) < 1900 for i in range(3)))
+        moved = [new for old, new in zip(before, after) if old != new]
+        self.assertTrue(all(new == 3 for new in moved))
+        self.assertLess(abs(len(moved) / len(keys) - 0.25), 0.1)
+
+    def test_specific_channels_hash_by_their_process_part(self):
+        layer = ShardedChannelLayer(hosts=["redis://a:6379", "redis://b:6379", {"address": "redis://c:6379", "name": "c"}])
+        self.assertEqual(layer.shard_names, ["redis://a:6379", "redis://b:6379", "c"])
+        self.assertNotIn("name", layer.hosts[2])
+        owners = {layer.consistent_hash(f"specific.{layer.client_prefix}!{i}") for i in range(50)}
+        self.assertEqual(owners, {layer.consistent_hash(f"specific.{layer.client_prefix}!")})
+
+    @skipUnless(fakeredis, "fakeredis and lupa are needed for the in-memory Redis shards")
+    def test_group_send_across_shards(self):
+        servers = [fakeredis.FakeServer() for _ in range(3)]
+
+        class FakeShardedLayer(ShardedChannelLayer):
+            def create_pool(self, index):
+                return fakeredis.aioredis.FakeRedis(server=servers[index]).connection_pool
+
+        async def run():
+            sender = FakeShardedLayer(hosts=["redis://a", "redis://b", "redis://c"])
+            receiver = FakeShardedLayer(hosts=["redis://a", "redis://b", "redis://c"])
+            channels = {}
+            for i in range(12):
+                channels[i] = await receiver.new_channel()
+                await receiver.group_add(f"chat_room{i}", channels[i])
+            for i in range(12):
+                await sender.group_send(f"chat_room{i}", {"type": "broadcast_frame", "n": i})
+            got = {}
+            for i in range(12):
+                message = await asyncio.wait_for(receiver.receive(channels[i]), 2)
+                got[i] = message["n"]
+            group_shards = {sender.consistent_hash(f"chat_room{i}") for i in range(12)}
+            await sender.close_pools()
+            await receiver.close_pools()
+            return got, group_shards
+
+        got, group_shards = async_to_sync(run)()
+        self.assertEqual(got, {i: i for i in range(12)})
+        self.assertGreater(len(group_shards), 1)
+
+    def test_command_reports_moves(self):
+        for i in range(50):
+            Room.objects.create(name=f"room{i}")
+        out = StringIO()
+        with override_settings(CHANNEL_LAYERS={"default": {
+            "BACKEND": "chat.layers.ShardedChannelLayer", "CONFIG": {"hosts": ["redis://a", "redis://b"]},
+        }}):
+            call_command("channel_shards", hosts="redis://a,redis://b,redis://c", stdout=out)
+        self.assertIn("redis://b -> redis://c", out.getvalue())
+        self.assertNotIn("-> redis://a", out.getvalue())
+
+
+@skipUnless(fakeredis, "fakeredis and lupa are needed for the in-memory Redis shards")
+class HybridLayerTests(TestCase):
+    def layers(self, count=2):
+        servers = [fakeredis.FakeServer(), fakeredis.FakeServer()]
+
+        class FakeHybridLayer(HybridChannelLayer):
+            def create_pool(self, index):
+                return fakeredis.aioredis.FakeRedis(server=servers[index]).connection_pool
+
+        self.inspect = [fakeredis.FakeStrictRedis(server=server) for server in servers]
+        return [FakeHybridLayer(hosts=["redis://a", "redis://b"]) for _ in range(count)]
+
+    def test_local_members_skip_redis_and_order_is_kept(self):
+        here, there = self.layers()
+
+        async def run():
+            mine = [await here.new_channel() for _ in range(3)]
+            theirs = [await there.new_channel() for _ in range(2)]
+            for channel in mine:
+                await here.group_add("chat_lobby", channel)
+            for channel in theirs:
+                await there.group_add("chat_lobby", channel)
+
+            # a room only this process serves never touches its own inbox
+            await here.group_add("chat_solo", mine[0])
+            await here.group_send("chat_solo", {"type": "broadcast_frame", "n": -1})
+            inbox = f"asgi{here.non_local_name(mine[0])}".encode()
+            touched = any(r.exists(inbox) for r in self.inspect)
+            self.assertEqual((await asyncio.wait_for(here.receive(mine[0]), 2))["n"], -1)
+
+            for n in range(20):
+                await here.group_send("chat_lobby", {"type": "broadcast_frame", "n": n})
+
+            received = {}
+            for layer, channels in ((here, mine), (there, theirs)):
+                for channel in channels:
+                    received[channel] = [(await asyncio.wait_for(layer.receive(channel), 2))["n"] for _ in range(20)]
+            await here.close_pools()
+            await there.close_pools()
+            return touched, received
+
+        touched, received = async_to_sync(run)()
+        self.assertFalse(touched)
+        self.assertEqual(len(received), 5)
+        for numbers in received.values():
+            self.assertEqual(numbers, list(range(20)))
+
+    def test_send_to_own_channel_is_delivered_in_memory(self):
+        (layer,) = self.layers(1)
+
+        async def run():
+            channel = await layer.new_channel()
+            await layer.send(channel, {"type": "ping"})
+            message = await asyncio.wait_for(layer.receive(channel), 2)
+            await layer.group_add("chat_lobby", channel)
+            await layer.group_discard("chat_lobby", channel)
+            await layer.close_pools()
+            return message
+
+        self.assertEqual(async_to_sync(run)(), {"type": "ping"})
+        self.assertEqual(dict(layer.local_groups), {})
+
+    def test_local_message_waits_for_earlier_messages_in_the_inbox(self):
+        here, there = self.layers()
+
+        async def run():
+            mine = await here.new_channel()
+            theirs = await there.new_channel()
+            await here.group_add("chat_lobby", mine)
+            await there.group_add("chat_lobby", theirs)
+            # the other process's message waits in our Redis inbox: no receive() has
+            # started the pump yet
+            await there.group_send("chat_lobby", {"type": "broadcast_frame", "n": 1})
+            await here.group_send("chat_lobby", {"type": "broadcast_frame", "n": 2})
+            await here.send(mine, {"type": "direct", "n": 3})
+            held = here.receive_buffer[mine].qsize()
+            got = [(await asyncio.wait_for(here.receive(mine), 2))["n"] for _ in range(3)]
+            theirs_got = [(await asyncio.wait_for(there.receive(theirs), 2))["n"] for _ in range(2)]
+            await here.close_pools()
+            await there.close_pools()
+            return held, got, theirs_got
+
+        held, got, theirs_got = async_to_sync(run)()
+        self.assertEqual(held, 0)
+        self.assertEqual(got, [1, 2, 3])
+        self.assertEqual(theirs_got, [1, 2])
+
+
+class MediaTests(TestCase):
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        self.settings_override = override_settings(MEDIA_ROOT=self.media_root)
+        self.settings_override.enable()
+        self.body = bytes(range(256)) * 4
+        for name in ("chat_files/clip.bin", "chat_files/page.html", "blobs/ab/abcd.webp"):
+            os.makedirs(os.path.join(self.media_root, os.path.dirname(name)), exist_ok=True)
+            with open(os.path.join(self.media_root, name), "wb") as fh:
+                fh.write(self.body)
+
+    def tearDown(self):
+        self.settings_override.disable()
+        shutil.rmtree(self.media_root, ignore_errors=True)
+
+    def test_full_and_range_responses(self):
+        full = self.client.get("/media/chat_files/clip.bin")
+        self.assertEqual(full.status_code, 200)
+        self.assertEqual(streamed(full), self.body)
+        self.assertEqual(full["Content-Length"], "1024")
+        self.assertEqual(full["Accept-Ranges"], "bytes")
+        self.assertEqual(full["Cache-Control"], "public, max-age=2592000")
+
+        part = self.client.get("/media/chat_files/clip.bin", HTTP_RANGE="bytes=10-19")
+        self.assertEqual(part.status_code, 206)
+        self.assertEqual(part["Content-Range"], "bytes 10-19/1024")
+        self.assertEqual(streamed(part), self.body[10:20])
+
+        tail = self.client.get("/media/chat_files/clip.bin", HTTP_RANGE="bytes=-4")
+        self.assertEqual(streamed(tail), self.body[-4:])
+        self.assertEqual(self.client.get("/media/chat_files/clip.bin", HTTP_RANGE="bytes=2000-").status_code, 416)
+
+        # a stale If-Range gets the whole file
+        stale = self.client.get("/media/chat_files/clip.bin", HTTP_RANGE="bytes=0-1", HTTP_IF_RANGE='"old"')
+        self.assertEqual(stale.status_code, 200)
+        fresh = self.client.get("/media/chat_files/clip.bin", HTTP_RANGE="bytes=0-1", HTTP_IF_RANGE=full["ETag"])
+        self.assertEqual(fresh.status_code, 206)
+
+    def test_validators_and_headers(self):
+        first = self.client.get("/media/blobs/ab/abcd.webp")
+        self.assertEqual(first["Cache-Control"], attachments.CACHE_CONTROL)
+        self.assertNotIn("Content-Disposition", first)
+        again = self.client.get("/media/blobs/ab/abcd.webp", HTTP_IF_NONE_MATCH=first["ETag"])
+        self.assertEqual(again.status_code, 304)
+        since = self.client.get("/media/blobs/ab/abcd.webp", HTTP_IF_MODIFIED_SINCE=first["Last-Modified"])
+        self.assertEqual(since.status_code, 304)
+
+        page = self.client.get("/media/chat_files/page.html")
+        self.assertTrue(page["Content-Disposition"].startswith("attachment"))
+        self.assertEqual(self.client.get("/media/../manage.py").status_code, 404)
+        self.assertEqual(self.client.get("/media/chat_files/missing.bin").status_code, 404)
+
+    def test_offload_to_front_server(self):
+        with override_settings(CHAT_MEDIA_ACCEL="nginx", CHAT_MEDIA_ACCEL_PREFIX="/protected-media/"):
+            response = self.client.get("/media/chat_files/clip.bin")
+        self.assertEqual(response["X-Accel-Redirect"], "/protected-media/chat_files/clip.bin")
+        self.assertEqual(response.content, b"")
+        with override_settings(CHAT_MEDIA_ACCEL="sendfile"):
+            response = self.client.get("/media/chat_files/clip.bin")
+        self.assertEqual(response["X-Sendfile"], os.path.join(self.media_root, "chat_files/clip.bin"))
@@ -0,0 +1,328 @@
+# chat/transfer.py
+"""
+Streaming export/import of one room's history (``manage.py export_room`` /
+``import_room``).
+
+A dump is gzip-compressed NDJSON, one record per line, tagged by ``type``:
+
+    room        name, privacy, password hash, creator (first line)
+    member      one per room member
+    blob        base64 piece of a media file, only with ``bundle``; the pieces
+                of a file are consecutive and come before anything using it
+    attachment  a content-addressed Attachment, before its first message
+    message     oldest first, archived messages (chat/archive.py) included
+
+Rows are read with ``.iterator(chunk_size=...)`` (a server-side cursor on
+PostgreSQL) and written line by line, so memory stays flat however long the
+room is. ``content`` stays the encrypted token: the importing side needs the
+exporting side's keys in CHAT_ENCRYPTION_KEYS. Without ``bundle`` media is
+referenced by storage name only, which is enough when both sides share
+MEDIA_ROOT (or its bucket).
+
+Import inserts messages with ``bulk_create`` in batches, each in its own
+transaction, numbering them with ``Room.allocate_seqs`` and taking attachment
+references as it goes. Message ids are new; users are matched by username.
+"""
+import base64
+import gzip
+import json
+import os
+import sys
+import tempfile
+
+from django.contrib.auth.models import User
+from django.core.files import File
+from django.core.files.storage import default_storage
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from . import archive, crypto
+from .attachments import PREFIX
+from .models import Attachment, Message, Room
+from .search import index_messages, search_available
+
+FORMAT = 1
+BATCH_SIZE = 2000
+BLOB_PIECE = 512 * 1024
+
+
+class TransferError(Exception):
+    """The dump cannot be imported as asked (room exists, unknown users...)."""
+
+
+def open_dump(path, mode):
+    """A text handle on a .ndjson.gz dump; ``-`` is stdin/stdout."""
+    if path == "-":
+        stream = sys.stdout.buffer if "w" in mode else sys.stdin.buffer
+        return gzip.open(stream, mode + "t", encoding="utf-8")
+    return gzip.open(path, mode + "t", encoding="utf-8")
+
+
+# ---------------- export -----------------
+def _message(m, sha256):
+    return {
+        "type": "message",
+        "seq": m["seq"],
+        "username": m["username"],
+        "content": m["content"],  # encrypted token, as stored
+        "timestamp": m["timestamp"],
+        "image": m["image"] or None,
+        "thumbnails": m["thumbnails"] or {},
+        "file": m["file"] or None,
+        "filename": m["filename"] or None,
+        "attachment": sha256,
+    }
+
+
+def _hot_records(room, chunk_size):
+    rows = (
+        Message.objects.filter(room=room).order_by("pk")
+        .select_related("user", "attachment").iterator(chunk_size=chunk_size)
+    )
+    for m in rows:
+        yield {
+            "seq": m.seq, "user_id": m.user_id, "username": m.user.username, "content": m.content,
+            "timestamp": m.timestamp.isoformat(), "image": m.image.name, "thumbnails": m.thumbnails,
+            "file": m.file.name, "filename": m.filename, "attachment_id": m.attachment_id,
+        }, m.attachment
+
+
+def _archived_records(room):
+    for segment in room.archive_segments.order_by("first_id").iterator():
+        for r in sorted(archive.read_segment(segment), key=lambda r: r["id"]):
+            yield r, None
+
+
+def _blob_records(name):
+    with default_storage.open(name, "rb") as fh:
+        for piece in iter(lambda: fh.read(BLOB_PIECE), b""):
+            yield {"type": "blob", "name": name, "data": base64.b64encode(piece).decode("ascii")}
+
+
+def export_room(room, out, bundle=False, chunk_size=BATCH_SIZE, include_archive=True):
+    """
+    Write ``room`` to the text handle ``out`` (sync). Yields the running
+    message count after every ``chunk_size`` messages, and once at the end.
+    """
+    def write(record):
+        out.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+    write({
+        "type": "room", "format": FORMAT, "name": room.name, "is_private": room.is_private,
+        "password": room.password, "created_by": room.created_by.username if room.created_by else None,
+        "exported_at": timezone.now().isoformat(),
+    })
+    for username in room.members.order_by("pk").values_list("username", flat=True).iterator(chunk_size=chunk_size):
+        write({"type": "member", "username": username})
+
+    attachments = {}  # attachment id -> sha256, for everything written so far
+    blobs = set()  # bundled names outside blobs/ (older uploads)
+    sources = [_hot_records(room, chunk_size)]
+    if include_archive:
+        sources.insert(0, _archived_records(room))
+
+    count = 0
+    for source in sources:
+        for r, attachment in source:
+            pk = r.get("attachment_id")
+            if pk and pk not in attachments:
+                attachment = attachment or Attachment.objects.filter(pk=pk).first()
+                attachments[pk] = attachment.sha256 if attachment else None
+                if attachment is not None:
+                    if bundle:
+                        for name in [attachment.name, *attachment.thumbnails.values()]:
+                            for piece in _blob_records(name):
+                                write(piece)
+                    write({
+                        "type": "attachment", "sha256": attachment.sha256, "kind": attachment.kind,
+                        "name": attachment.name, "thumbnails": attachment.thumbnails, "size": attachment.size,
+                    })
+            elif not pk and bundle:
+                for name in [r.get("image"), r.get("file"), *(r.get("thumbnails") or {}).values()]:
+                    if name and name not in blobs and default_storage.exists(name):
+                        blobs.add(name)
+                        for piece in _blob_records(name):
+                            write(piece)
+
+            write(_message(r, attachments.get(pk)))
+            count += 1
+            if count % chunk_size == 0:
+                yield count
+    yield count
+
+
+# ---------------- import -----------------
+class _Users:
+    """Username -> user id, looked up in batches; unknown names are created or refused."""
+
+    def __init__(self, create):
+        self.create = create
+        self.ids = {}
+
+    def resolve(self, usernames):
+        missing = {u for u in usernames if u and u not in self.ids}
+        if missing:
+            self.ids.update(User.objects.filter(username__in=missing).values_list("username", "pk"))
+            unknown = sorted(missing - self.ids.keys())
+            if unknown and not self.create:
+                raise TransferError(f"Unknown users: {', '.join(unknown[:10])} (use --create-users)")
+            for username in unknown:
+                user = User(username=username)
+                user.set_unusable_password()
+                user.save()
+                self.ids[username] = user.pk
+        return self.ids
+
+
+class _Blobs:
+    """Reassembles bundled blob pieces in a temp file and saves each one to storage."""
+
+    def __init__(self):
+        self.renamed = {}
+        self.written = 0
+        self._name = None
+        self._fh = None
+
+    def add(self, record):
+        if record["name"] != self._name:
+            self.finish()
+            self._name = record["name"]
+            self._fh = tempfile.TemporaryFile()
+        self._fh.write(base64.b64decode(record["data"]))
+
+    def finish(self):
+        if self._fh is None:
+            return
+        name, fh = self._name, self._fh
+        self._name = self._fh = None
+        with fh:
+            # blobs/ names are content hashes: an existing one already holds these bytes
+            if not (name.startswith(PREFIX + "/") and default_storage.exists(name)):
+                fh.seek(0)
+                saved = default_storage.save(name, File(fh, name=os.path.basename(name)))
+                if saved != name:
+                    self.renamed[name] = saved
+                self.written += 1
+
+
+def _room(record, name, append):
+    name = name or record["name"]
+    room = Room.objects.filter(name=name).first()
+    if room is not None:
+        if not append:
+            raise TransferError(f"Room {name!r} already exists (use --append)")
+        return room
+    return Room.objects.create(
+        name=name, is_private=record.get("is_private", False), password=record.get("password"),
+        created_by=User.objects.filter(username=record.get("created_by") or "").first(),
+    )
+
+
+def _attachment(record):
+    """The local Attachment for an exported one, or None when its blob is not here."""
+    attachment = Attachment.objects.filter(sha256=record["sha256"]).first()
+    if attachment is not None:
+        return attachment.pk
+    if not default_storage.exists(record["name"]):
+        return None
+    return Attachment.objects.get_or_create(sha256=record["sha256"], defaults={
+        "kind": record["kind"], "name": record["name"],
+        "thumbnails": record.get("thumbnails") or {}, "size": record.get("size") or 0, "refcount": 0,
+    })[0].pk
+
+
+def _write_batch(room, records, users, attachments, blobs):
+    ids = users.resolve({r["username"] for r in records})
+    rename = blobs.renamed.get
+    rows = []
+    refs = {}
+    for r in records:
+        attachment_id = attachments.get(r.get("attachment"))
+        if attachment_id:
+            refs[attachment_id] = refs.get(attachment_id, 0) + 1
+        rows.append(Message(
+            room_id=room.pk, user_id=ids[r["username"]], content=r.get("content"),
+            timestamp=parse_datetime(r["timestamp"]), image=rename(r.get("image"), r.get("image")) or None,
+            thumbnails={k: rename(v, v) for k, v in (r.get("thumbnails") or {}).items()},
+            file=rename(r.get("file"), r.get("file")) or None, filename=r.get("filename") or "",
+            attachment_id=attachment_id,
+        ))
+
+    with transaction.atomic():
+        # bulk_create skips Message.save(), which is where seqs are assigned
+        first = Room.allocate_seqs(room.pk, len(rows))
+        for offset, row in enumerate(rows):
+            row.seq = first + offset
+        Message.objects.bulk_create(rows)
+        for pk, n in refs.items():
+            Attachment.objects.filter(pk=pk).update(refcount=F("refcount") + n)
+        if search_available():
+            tokens = [row for row in rows if row.content]
+            texts = crypto.decrypt_many(row.content for row in tokens)
+            index_messages(
+                (row.pk, text) for row, text in zip(tokens, texts) if text != crypto.DECRYPT_ERROR
+            )
+
+
+def import_room(lines, name=None, append=False, create_users=False, batch_size=BATCH_SIZE):
+    """
+    Read a dump from the text lines ``lines`` (sync). Yields
+    ``(room, messages imported so far)`` after every batch, and once at the end.
+    """
+    users = _Users(create_users)
+    blobs = _Blobs()
+    attachments = {}  # sha256 -> local attachment id (None when the blob is missing)
+    members = []
+    batch = []
+    room = None
+    count = 0
+
+    def flush_members():
+        ids = users.resolve(members)
+        room.members.add(*[ids[u] for u in members])
+        members.clear()
+
+    for line in lines:
+        if not line.strip():
+            continue
+        record = json.loads(line)
+        kind = record.get("type")
+        if kind != "blob":
+            blobs.finish()
+
+        if kind == "room":
+            if record.get("format") != FORMAT:
+                raise TransferError(f"Unsupported dump format {record.get('format')!r}")
+            room = _room(record, name, append)
+            continue
+        if room is None:
+            raise TransferError("Dump does not start with a room record")
+        if kind == "member":
+            members.append(record["username"])
+            if len(members) >= batch_size:
+                flush_members()
+        elif kind == "blob":
+            blobs.add(record)
+        elif kind == "attachment":
+            attachments[record["sha256"]] = _attachment(record)
+        elif kind == "message":
+            if members:
+                flush_members()
+            batch.append(record)
+            if len(batch) >= batch_size:
+                _write_batch(room, batch, users, attachments, blobs)
+                count += len(batch)
+                batch.clear()
+                yield room, count
+
+    blobs.finish()
+    if room is None:
+        raise TransferError("Empty dump")
+    if members:
+        flush_members()
+    if batch:
+        _write_batch(room, batch, users, attachments, blobs)
+        count += len(batch)
+    yield room, count
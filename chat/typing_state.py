@@ -0,0 +1,57 @@
+# chat/typing_state.py
+"""
+Server-side typing indicator coalescing.
+
+Consumers report keystrokes with ``touch``; repeats within the window only
+update a dict. Once per ``interval`` each room with fresh activity gets a
+single ``typing_state`` group_send listing who typed during that window, so
+channel-layer traffic scales with rooms rather than keystrokes. With several
+processes each one reports its own typers; clients keep a name visible for a
+couple of seconds after it was last listed, which merges the reports.
+"""
+import asyncio
+import logging
+
+from django.conf import settings
+
+from .frames import frame_event
+
+logger = logging.getLogger(__name__)
+
+
+class TypingAggregator:
+    def __init__(self, interval=0.5):
+        self.interval = interval
+        self._typing = {}  # group name -> set of usernames seen this window
+        self._tasks = {}
+
+    def touch(self, channel_layer, group, username):
+        users = self._typing.setdefault(group, set())
+        users.add(username)
+        task = self._tasks.get(group)
+        if task is None or task.done():
+            self._tasks[group] = asyncio.get_running_loop().create_task(self._flush_later(channel_layer, group))
+
+    async def _flush_later(self, channel_layer, group):
+        await asyncio.sleep(self.interval)
+        users = self._typing.pop(group, None)
+        self._tasks.pop(group, None)
+        if not users:
+            return
+        try:
+            await channel_layer.group_send(group, frame_event({
+                "type": "typing_state",
+                "usernames": sorted(users),
+            }))
+        except Exception:
+            logger.exception("Failed to send typing state")
+
+
+_aggregator = None
+
+
+def get_typing_aggregator():
+    global _aggregator
+    if _aggregator is None:
+        _aggregator = TypingAggregator(interval=getattr(settings, "CHAT_TYPING_INTERVAL", 0.5))
+    return _aggregator
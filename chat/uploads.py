@@ -0,0 +1,202 @@
+# chat/uploads.py
+"""
+Binary chunked uploads for ChatConsumer.
+
+Every upload frame is sent over ``bytes_data`` and starts with a fixed header:
+
+    1 byte  opcode (START / CHUNK / FINISH / ABORT)
+    16 bytes upload id (client generated, random)
+
+followed by an opcode specific payload:
+
+    START   UTF-8 JSON: {"kind": "image"|"file", "filename": "...", "size": 1234}
+    CHUNK   8 byte big-endian offset + raw bytes
+    FINISH  (empty)
+    ABORT   (empty)
+
+Chunks are appended to a staging file on disk, so an upload never has to fit
+in memory. The server acknowledges every frame with the offset it holds, which
+is also how a client resumes an interrupted upload: send START again with the
+same upload id and continue from the returned offset.
+"""
+import json
+import os
+import struct
+import tempfile
+import time
+
+from django.conf import settings
+from django.core.files import File
+
+OP_START = 1
+OP_CHUNK = 2
+OP_FINISH = 3
+OP_ABORT = 4
+
+HEADER = struct.Struct(">B16s")
+OFFSET = struct.Struct(">Q")
+
+KINDS = ("image", "file")
+
+
+class UploadError(Exception):
+    pass
+
+
+def max_upload_size():
+    return getattr(settings, "CHAT_UPLOAD_MAX_BYTES", 20 * 1024 * 1024)
+
+
+def staging_dir():
+    path = getattr(settings, "CHAT_UPLOAD_TEMP_DIR", None) or os.path.join(tempfile.gettempdir(), "chat_uploads")
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def parse_frame(bytes_data):
+    """Split a binary frame into (opcode, upload_id, payload)."""
+    if len(bytes_data) < HEADER.size:
+        raise UploadError("Frame too short")
+    op, raw_id = HEADER.unpack_from(bytes_data)
+    return op, raw_id.hex(), memoryview(bytes_data)[HEADER.size:]
+
+
+def parse_chunk(payload):
+    if len(payload) < OFFSET.size:
+        raise UploadError("Chunk without offset")
+    (offset,) = OFFSET.unpack_from(payload)
+    return offset, payload[OFFSET.size:]
+
+
+class StagedFile(File):
+    """
+    File wrapper exposing ``temporary_file_path`` so FileSystemStorage moves the
+    staged upload into MEDIA_ROOT instead of copying it; other storages read it
+    back in chunks.
+    """
+
+    def __init__(self, path, name):
+        super().__init__(open(path, "rb"), name=name)
+        self._path = path
+
+    def temporary_file_path(self):
+        return self._path
+
+
+class ChunkedUpload:
+    def __init__(self, upload_id, meta):
+        self.upload_id = upload_id
+        self.meta = meta
+        base = os.path.join(staging_dir(), upload_id)
+        self.data_path = base + ".part"
+        self.meta_path = base + ".json"
+
+    @property
+    def kind(self):
+        return self.meta["kind"]
+
+    @property
+    def filename(self):
+        return self.meta["filename"]
+
+    @property
+    def size(self):
+        return self.meta["size"]
+
+    @property
+    def offset(self):
+        try:
+            return os.path.getsize(self.data_path)
+        except OSError:
+            return 0
+
+    @property
+    def complete(self):
+        return self.offset == self.size
+
+    @classmethod
+    def start(cls, upload_id, user_id, room_name, kind, filename, size):
+        """Create a new staged upload, or resume an existing one with the same id."""
+        if kind not in KINDS:
+            raise UploadError("Unknown upload kind")
+        if not isinstance(size, int) or size <= 0:
+            raise UploadError("Invalid upload size")
+        if size > max_upload_size():
+            raise UploadError("File too large")
+
+        filename = os.path.basename(str(filename or "file"))[:200] or "file"
+        meta = {
+            "user_id": user_id,
+            "room": room_name,
+            "kind": kind,
+            "filename": filename,
+            "size": size,
+        }
+
+        upload = cls(upload_id, meta)
+        existing = upload._read_meta()
+        if existing is not None:
+            if existing != meta:
+                raise UploadError("Upload id already in use")
+            return upload
+
+        purge_stale_uploads()
+        with open(upload.meta_path, "w") as fh:
+            json.dump(meta, fh)
+        open(upload.data_path, "wb").close()
+        return upload
+
+    @classmethod
+    def load(cls, upload_id, user_id):
+        upload = cls(upload_id, None)
+        meta = upload._read_meta()
+        if meta is None or meta["user_id"] != user_id:
+            raise UploadError("Unknown upload")
+        upload.meta = meta
+        return upload
+
+    def _read_meta(self):
+        try:
+            with open(self.meta_path) as fh:
+                return json.load(fh)
+        except (OSError, ValueError):
+            return None
+
+    def write(self, offset, data):
+        """
+        Append ``data`` at ``offset``. Returns the new offset; a mismatching
+        offset is ignored so the client can resync from the returned value.
+        """
+        current = self.offset
+        if offset != current:
+            return current
+        if current + len(data) > self.size:
+            raise UploadError("Chunk exceeds declared size")
+        with open(self.data_path, "ab") as fh:
+            fh.write(data)
+        return current + len(data)
+
+    def open(self):
+        return StagedFile(self.data_path, self.filename)
+
+    def discard(self):
+        for path in (self.data_path, self.meta_path):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+
+def purge_stale_uploads(max_age=None):
+    """Remove staged uploads that have not been touched for ``max_age`` seconds."""
+    if max_age is None:
+        max_age = getattr(settings, "CHAT_UPLOAD_STALE_SECONDS", 24 * 3600)
+    cutoff = time.time() - max_age
+    directory = staging_dir()
+    for name in os.listdir(directory):
+        path = os.path.join(directory, name)
+        try:
+            if os.path.getmtime(path) < cutoff:
+                os.remove(path)
+        except OSError:
+            pass
@@ -3,8 +3,12 @@ from . import views
 
 urlpatterns = [
     path("home/", views.home, name="home"),
+    path("rooms/", views.room_directory, name="room_directory"),
     path("create/", views.create_room, name="create_room"),
     path("room/<str:room_name>/", views.room, name="room"),
     path("room/<str:room_name>/delete/", views.delete_room, name="delete_room"),  # ✅ Thêm dòng này
+    path("room/<str:room_name>/online/", views.room_online, name="room_online"),
+    path("users/", views.user_list, name="user_list"),
+    path("search/", views.search_messages, name="search_messages"),
     path("register/", views.register, name="register"),
 ]
@@ -1,14 +1,48 @@
+import json
+
 from django.shortcuts import render, redirect, get_object_or_404
 from django.contrib import messages
 from django.contrib.auth.decorators import login_required
+from django.core.paginator import Paginator
+from django.http import JsonResponse
+from django.conf import settings
 from .models import Room
+from .cache import get_history_cache
+from .directory import fill_locked_previews, get_directory_cache
+from .presence import get_presence
+from .readstate import unread_counts
+from .rooms import get_room_cache
+from .search import accessible_room_ids, search, search_available
 from django.contrib.auth.models import User
 from django.contrib.auth import login
 
+def _directory_page(request):
+    try:
+        page = int(request.GET.get("page", 1))
+    except ValueError:
+        page = 1
+    size = getattr(settings, "CHAT_DIRECTORY_PAGE_SIZE", 30)
+    return get_directory_cache().get_page(page, size)
+
+def _directory_with_unread(request):
+    directory = json.loads(_directory_page(request))
+    fill_locked_previews(directory["rooms"], request.user, request.session)
+    # the page is shared between users; unread counts are per user (one query)
+    unread = unread_counts(request.user, [r["name"] for r in directory["rooms"]])
+    for room in directory["rooms"]:
+        room["unread"] = unread.get(room["name"], 0)
+    return directory
+
 @login_required
 def home(request):
-    rooms = Room.objects.all()
-    return render(request, "chat/home.html", {"rooms": rooms})
+    """Danh sách phòng, phân trang và cache (chat/directory.py)"""
+    directory = _directory_with_unread(request)
+    return render(request, "chat/home.html", {"directory": directory, "rooms": directory["rooms"]})
+
+@login_required
+def room_directory(request):
+    """Một trang danh sách phòng (JSON, cho cuộn vô hạn)"""
+    return JsonResponse(_directory_with_unread(request))
 
 @login_required
 def create_room(request):
@@ -31,6 +65,7 @@ def create_room(request):
             room.is_private = True
         room.save()
         room.members.add(request.user)
+        get_room_cache().invalidate(room.name)
 
         messages.success(request, f"✅ Đã tạo phòng '{room.name}' thành công.")
         return redirect("home")
@@ -44,6 +79,7 @@ def delete_room(request, room_name):
 
     if request.user == room.created_by or request.user.is_superuser:
         room.delete()
+        get_history_cache().invalidate(room_name)
         messages.success(request, f"🗑️ Đã xóa phòng '{room_name}'.")
     else:
         messages.error(request, "❌ Bạn không có quyền xóa phòng này.")
@@ -68,6 +104,36 @@ def room(request, room_name):
 
     return render(request, "chat/room.html", {"room_name": room_name})
 
+@login_required
+def user_list(request):
+    """Danh sách người dùng kèm trạng thái online (đọc từ presence, không qua UserStatus)"""
+    users = User.objects.order_by("username").only("id", "username")
+    page = Paginator(users, 100).get_page(request.GET.get("page"))
+    online_ids = get_presence().online_user_ids([u.pk for u in page])
+    return render(request, "chat/user_list.html", {"users": page, "online_ids": online_ids})
+
+@login_required
+def room_online(request, room_name):
+    """Ai đang online trong phòng (JSON)"""
+    return JsonResponse({"usernames": get_presence().room_usernames(room_name)})
+
+@login_required
+def search_messages(request):
+    """Tìm tin nhắn trong các phòng được phép xem (JSON, phân trang theo id)"""
+    query = request.GET.get("q", "").strip()
+    room_name = request.GET.get("room") or None
+    try:
+        before = int(request.GET["before"]) if request.GET.get("before") else None
+        limit = int(request.GET.get("limit", 20))
+    except ValueError:
+        return JsonResponse({"error": "Tham số không hợp lệ."}, status=400)
+    if not search_available():
+        return JsonResponse({"error": "Tìm kiếm chưa được hỗ trợ trên CSDL này."}, status=501)
+
+    room_ids = accessible_room_ids(request.user, request.session, room_name)
+    results, next_before = search(query, room_ids, before=before, limit=limit)
+    return JsonResponse({"results": results, "next_before": next_before})
+
 def register(request):
     """Đăng ký tài khoản"""
     if request.method == "POST":
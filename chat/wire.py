@@ -0,0 +1,111 @@
+# chat/wire.py
+"""
+Compact wire protocol, negotiated per connection.
+
+A client that lists ``SUBPROTOCOL`` in ``Sec-WebSocket-Protocol`` gets every
+server frame as a binary MessagePack map instead of JSON text:
+
+  * keys are small integers (``KEYS``), event types too (``TYPES``);
+  * the "%H:%M %d/%m/%Y" display string is dropped, ``ts`` carries the
+    integer epoch seconds;
+  * history, history pages, resync deltas and search results are batched as positional
+    rows (``ROW``) instead of one map per message, trailing nulls trimmed.
+
+Such clients may send their events as MessagePack maps in binary frames too
+(plain JSON text keeps working). Upload frames are not ambiguous: they start
+with opcode 1-4, a MessagePack map starts with 0x80 or above.
+
+Broadcasts travel as JSON and are packed once per receiving process for its
+compact members (``chat/frames.py``), not once per socket. JSON stays the
+default.
+"""
+import json
+
+from django.conf import settings
+
+try:
+    import msgpack
+except ImportError:  # optional, the subprotocol is simply not offered
+    msgpack = None
+
+SUBPROTOCOL = "sayhi.msgpack.v1"
+
+TYPES = {
+    "chat": 1, "image": 2, "file": 3, "typing_state": 4,
+    "history": 5, "history_page": 6, "presence": 7, "search_results": 8,
+    "upload_ack": 9, "upload_done": 10, "upload_error": 11,
+    "history_delta": 12, "resync_gap": 13, "rate_limited": 14,
+    # client -> server
+    "typing": 20, "read": 21, "load_older": 22, "search": 23,
+}
+KEYS = {
+    "type": 0, "id": 1, "username": 2, "message": 3, "ts": 4,
+    "image": 5, "thumbnails": 6, "file": 7, "filename": 8,
+    "usernames": 9, "messages": 10, "has_more": 11, "before": 12,
+    "results": 13, "next_before": 14, "q": 15, "upload_id": 16,
+    "offset": 17, "error": 18, "limit": 19, "room": 20, "since": 21,
+    "event": 22, "retry_after": 23,
+}
+ALIASES = {"file_url": "file"}  # broadcasts say file_url, history rows say file
+DROPPED = {"timestamp"}  # display string, replaced by ts
+ROW = ("id", "username", "message", "type", "ts", "image", "thumbnails", "file", "filename", "room")
+ROW_LISTS = {"messages", "results"}
+
+_TYPE_NAMES = {code: name for name, code in TYPES.items()}
+_KEY_NAMES = {code: name for name, code in KEYS.items()}
+_ROW_TYPES = {"text": TYPES["chat"], "image": TYPES["image"], "file": TYPES["file"]}
+
+
+def available():
+    return msgpack is not None and getattr(settings, "CHAT_COMPACT_PROTOCOL", True)
+
+
+def negotiate(subprotocols):
+    """The subprotocol to accept for a client offering ``subprotocols``, or None."""
+    return SUBPROTOCOL if available() and SUBPROTOCOL in (subprotocols or ()) else None
+
+
+def _row(entry):
+    row = [entry.get(name) or None for name in ROW]  # "" and {} become nil
+    row[3] = _ROW_TYPES.get(row[3], row[3])
+    while row and row[-1] is None:
+        row.pop()
+    return row
+
+
+def compact(payload):
+    """Translate a JSON payload dict to its compact (integer keyed) form."""
+    out = {}
+    for name, value in payload.items():
+        if name in DROPPED:
+            continue
+        name = ALIASES.get(name, name)
+        if name == "type":
+            value = TYPES.get(value, value)
+        elif name in ROW_LISTS:
+            value = [_row(entry if isinstance(entry, dict) else json.loads(entry)) for entry in value]
+        out[KEYS.get(name, name)] = value
+    return out
+
+
+def pack(payload):
+    return msgpack.packb(compact(payload), use_bin_type=True)
+
+
+def is_packed(data):
+    """True for a MessagePack map frame (as opposed to an upload frame)."""
+    return bool(data) and (0x80 <= data[0] <= 0x8f or data[0] in (0xde, 0xdf))
+
+
+def unpack(data):
+    """Decode a client event to the same dict a JSON text frame would give."""
+    raw = msgpack.unpackb(data, raw=False, strict_map_key=False)
+    if not isinstance(raw, dict):
+        raise ValueError("Compact frames must be maps")
+    out = {}
+    for key, value in raw.items():
+        name = _KEY_NAMES.get(key, key)
+        if name == "type":
+            value = _TYPE_NAMES.get(value, value)
+        out[name] = value
+    return out
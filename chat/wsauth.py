@@ -0,0 +1,133 @@
+# chat/wsauth.py
+"""
+WebSocket handshake authentication without per-connect queries.
+
+channels' ``AuthMiddlewareStack`` reads the session row and then the user row
+on every connect, so a reconnect storm is two queries per socket. Here the
+session comes from SESSION_ENGINE (chat/sessions.py: the cache first, the
+database on a miss) and the user from a short-lived per-process cache keyed
+by session key (CHAT_WS_USER_CACHE_TTL), so a warm handshake runs no query.
+
+The session is still read on every handshake, before the user cache is
+consulted, and a cached user is only used while the session names the same
+user with the same auth hash. Logging out deletes the session, so it takes
+effect on the next connect in every process. Saving a user drops its
+entries in this process; changes made by other processes (deactivation, a
+password change elsewhere) show up within the TTL.
+"""
+import threading
+import time
+from types import SimpleNamespace
+
+from channels.auth import AuthMiddleware
+from channels.db import database_sync_to_async
+from channels.sessions import CookieMiddleware, SessionMiddleware
+from django.conf import settings
+from django.contrib.auth import HASH_SESSION_KEY, SESSION_KEY, get_user, user_logged_out
+from django.contrib.auth.models import AnonymousUser
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from .metrics import HANDSHAKE_USERS
+
+MAX_ENTRIES = 10000
+
+
+class SessionUserCache:
+    def __init__(self, ttl=30.0):
+        self.ttl = ttl
+        self._users = {}  # session key -> (user, session auth hash, expires)
+        self._lock = threading.Lock()
+
+    def get(self, session_key, user_id, session_hash):
+        with self._lock:
+            item = self._users.get(session_key)
+        if item is None:
+            return None
+        user, auth_hash, expires = item
+        if expires > time.monotonic() and str(user.pk) == str(user_id) and auth_hash == session_hash:
+            return user
+        self.discard(session_key)
+        return None
+
+    def put(self, session_key, user, session_hash):
+        with self._lock:
+            if len(self._users) >= MAX_ENTRIES:
+                now = time.monotonic()
+                self._users = {k: v for k, v in self._users.items() if v[2] > now}
+                if len(self._users) >= MAX_ENTRIES:
+                    self._users.clear()
+            self._users[session_key] = (user, session_hash, time.monotonic() + self.ttl)
+
+    def discard(self, session_key):
+        with self._lock:
+            self._users.pop(session_key, None)
+
+    def invalidate_user(self, user_id):
+        with self._lock:
+            for key in [k for k, v in self._users.items() if v[0].pk == user_id]:
+                del self._users[key]
+
+
+_cache = None
+
+
+def get_user_cache():
+    global _cache
+    if _cache is None:
+        _cache = SessionUserCache(ttl=getattr(settings, "CHAT_WS_USER_CACHE_TTL", 30.0))
+    return _cache
+
+
+def reset_user_cache():
+    global _cache
+    _cache = None
+
+
+# ---------------- resolution -----------------
+def session_user(session):
+    """The user of ``session`` (sync, DB thread), from the cache when it still matches."""
+    user_id = session.get(SESSION_KEY)
+    if user_id is None:
+        HANDSHAKE_USERS.inc("anonymous")
+        return AnonymousUser()
+
+    cache = get_user_cache()
+    user = cache.get(session.session_key, user_id, session.get(HASH_SESSION_KEY))
+    if user is not None:
+        HANDSHAKE_USERS.inc("hit")
+        return user
+
+    # same checks as a request: backend, auth hash (flushing a stale session)
+    user = get_user(SimpleNamespace(session=session))
+    HANDSHAKE_USERS.inc("miss")
+    if user.is_authenticated:
+        cache.put(session.session_key, user, session.get(HASH_SESSION_KEY))
+    return user
+
+
+class CachedAuthMiddleware(AuthMiddleware):
+    """``AuthMiddleware`` that resolves ``scope["user"]`` through ``session_user``."""
+
+    async def resolve_scope(self, scope):
+        scope["user"]._wrapped = await database_sync_to_async(session_user)(scope["session"])
+
+
+def CachedAuthMiddlewareStack(inner):
+    return CookieMiddleware(SessionMiddleware(CachedAuthMiddleware(inner)))
+
+
+# ---------------- invalidation -----------------
+@receiver(user_logged_out)
+def forget_logged_out(sender, request, **kwargs):
+    # sent before the session is flushed, so the key is still there
+    session_key = getattr(getattr(request, "session", None), "session_key", None)
+    if session_key:
+        get_user_cache().discard(session_key)
+
+
+@receiver(post_save, sender=settings.AUTH_USER_MODEL)
+@receiver(post_delete, sender=settings.AUTH_USER_MODEL)
+def forget_changed_user(sender, instance, **kwargs):
+    if _cache is not None:
+        _cache.invalidate_user(instance.pk)
@@ -2,7 +2,6 @@
 import os
 from django.core.asgi import get_asgi_application
 from channels.routing import ProtocolTypeRouter, URLRouter
-from channels.auth import AuthMiddlewareStack
 
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "chat_project.settings")
 
@@ -10,10 +9,14 @@ os.environ.setdefault("DJANGO_SETTINGS_MODULE", "chat_project.settings")
 django_asgi_app = get_asgi_application()
 
 import chat.routing  # Import sau khi Django apps đã load
+from chat.wsauth import CachedAuthMiddlewareStack  # session + user từ cache, không query khi kết nối lại
+
+from chat.persistence import lifespan  # ghi nốt tin nhắn write-behind khi server dừng
 
 application = ProtocolTypeRouter({
     "http": django_asgi_app,
-    "websocket": AuthMiddlewareStack(
+    "lifespan": lifespan,
+    "websocket": CachedAuthMiddlewareStack(
         URLRouter(
             chat.routing.websocket_urlpatterns
         )
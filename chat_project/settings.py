@@ -4,6 +4,7 @@
 from pathlib import Path
 import os
 import dj_database_url
+from django.core.exceptions import ImproperlyConfigured
 
 BASE_DIR = Path(__file__).resolve().parent.parent
 
@@ -106,6 +107,13 @@ STATICFILES_STORAGE = 'whitenoise.storage.CompressedManifestStaticFilesStorage'
 
 MEDIA_URL = '/media/'
 MEDIA_ROOT = BASE_DIR / 'media'
+# MEDIA is served by chat/media.py in every environment. Files other than
+# content-addressed blobs are cached for MAX_AGE seconds. ACCEL = "nginx"
+# (X-Accel-Redirect to ACCEL_PREFIX, an internal location aliased to
+# MEDIA_ROOT) or "sendfile" (X-Sendfile) lets the front server send the bytes.
+CHAT_MEDIA_MAX_AGE = int(env('CHAT_MEDIA_MAX_AGE', str(30 * 24 * 3600)))
+CHAT_MEDIA_ACCEL = env('CHAT_MEDIA_ACCEL', '')
+CHAT_MEDIA_ACCEL_PREFIX = env('CHAT_MEDIA_ACCEL_PREFIX', '/protected-media/')
 
 # ------------------ Auth ------------------
 LOGIN_REDIRECT_URL = '/chat/home/'
@@ -116,19 +124,129 @@ DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
 # ------------------ Channels / Redis ------------------
 REDIS_URL = env('REDIS_URL', 'redis://127.0.0.1:6379/0')
+# Channel layer shards, comma separated; room groups and process inboxes are
+# spread over them by consistent hashing (chat/layers.py, `manage.py channel_shards`).
+# LOCAL_DELIVERY hands group members in the sending process their messages in
+# memory and only forwards the rest through Redis; rooms shared with other
+# processes keep the plain layer's order (chat/layers.py).
+CHAT_CHANNEL_SHARDS = [url.strip() for url in env('CHAT_CHANNEL_SHARDS', REDIS_URL).split(',') if url.strip()]
+CHAT_LOCAL_DELIVERY = env('CHAT_LOCAL_DELIVERY', 'True') == 'True'
 CHANNEL_LAYERS = {
     'default': {
-        'BACKEND': 'channels_redis.core.RedisChannelLayer',
-        'CONFIG': {'hosts': [REDIS_URL]},
+        'BACKEND': 'chat.layers.HybridChannelLayer' if CHAT_LOCAL_DELIVERY else 'chat.layers.ShardedChannelLayer',
+        # capacity bounds each socket's inbox of pending broadcasts (chat/ratelimit.py)
+        'CONFIG': {'hosts': CHAT_CHANNEL_SHARDS, 'capacity': int(env('CHAT_CHANNEL_CAPACITY', '100'))},
     },
 }
 
+# Recent-history ring per room (chat/cache.py); None = process-local only
+CHAT_HISTORY_CACHE_URL = REDIS_URL
+CHAT_HISTORY_CACHE_SIZE = 50
+CHAT_HISTORY_LOCAL_TTL = float(env('CHAT_HISTORY_LOCAL_TTL', '2'))
+
+# Write-behind persistence of text messages (chat/persistence.py)
+CHAT_WRITE_BEHIND = env('CHAT_WRITE_BEHIND', 'False') == 'True'
+CHAT_WRITE_BEHIND_BATCH = int(env('CHAT_WRITE_BEHIND_BATCH', '500'))
+CHAT_WRITE_BEHIND_DELAY = float(env('CHAT_WRITE_BEHIND_DELAY', '0.05'))
+# Past this many queued rows the sender writes the queue out before broadcasting
+CHAT_WRITE_BEHIND_MAX_PENDING = int(env('CHAT_WRITE_BEHIND_MAX_PENDING', '10000'))
+
+# Typing indicators are batched into one typing_state event per room per interval
+CHAT_TYPING_INTERVAL = float(env('CHAT_TYPING_INTERVAL', '0.5'))
+
+# Presence (chat/presence.py); None = process-local only
+CHAT_PRESENCE_URL = REDIS_URL
+CHAT_PRESENCE_HEARTBEAT = float(env('CHAT_PRESENCE_HEARTBEAT', '30'))
+
+# Home page room directory (chat/directory.py); None = process-local only.
+# New messages refresh a cached page at most every STALENESS seconds.
+CHAT_DIRECTORY_CACHE_URL = REDIS_URL
+CHAT_DIRECTORY_PAGE_SIZE = int(env('CHAT_DIRECTORY_PAGE_SIZE', '30'))
+CHAT_DIRECTORY_CACHE_TTL = float(env('CHAT_DIRECTORY_CACHE_TTL', '300'))
+CHAT_DIRECTORY_MESSAGE_STALENESS = float(env('CHAT_DIRECTORY_MESSAGE_STALENESS', '5'))
+
+# Read pointers from "read" events are written once per this many seconds (chat/readstate.py)
+CHAT_READ_DEBOUNCE = float(env('CHAT_READ_DEBOUNCE', '2'))
+
+# Reconnects with ?since=<message id> get only the missed messages, in history
+# pages; past this many the client is told to reload instead (chat/history.py)
+CHAT_RESYNC_MAX_MESSAGES = int(env('CHAT_RESYNC_MAX_MESSAGES', '500'))
+
+# Messages older than this move to compressed per-room/month segments under
+# CHAT_ARCHIVE_ROOT (`manage.py archive_messages`, chat/archive.py). The
+# segments are the only copy afterwards: set it to a persistent disk mounted
+# by every web process; archiving is off while it is unset.
+CHAT_ARCHIVE_ROOT = env('CHAT_ARCHIVE_ROOT')
+CHAT_ARCHIVE_AFTER_DAYS = int(env('CHAT_ARCHIVE_AFTER_DAYS', '180'))
+
+# Inbound limits per connection and per user, {event: (per second, burst)}
+# ("upload_bytes" in bytes); members whose broadcasts wait longer than
+# MAX_LAG seconds are dropped from or disconnected per POLICY (chat/ratelimit.py)
+CHAT_MAX_FRAME_BYTES = int(env('CHAT_MAX_FRAME_BYTES', str(1024 * 1024)))
+CHAT_RATE_LIMIT_MAX_STRIKES = int(env('CHAT_RATE_LIMIT_MAX_STRIKES', '50'))
+CHAT_OUTBOUND_MAX_LAG = float(env('CHAT_OUTBOUND_MAX_LAG', '5'))
+CHAT_OUTBOUND_POLICY = env('CHAT_OUTBOUND_POLICY', 'disconnect')  # or "drop"
+
+# Sessions are cached here and written through to the DB (chat/sessions.py);
+# None = DB only. Handshakes cache the user per session for USER_CACHE_TTL
+# seconds (chat/wsauth.py)
+CHAT_SESSION_CACHE_URL = REDIS_URL
+CHAT_WS_USER_CACHE_TTL = float(env('CHAT_WS_USER_CACHE_TTL', '30'))
+
+# Offer the compact MessagePack subprotocol "sayhi.msgpack.v1" (chat/wire.py)
+CHAT_COMPACT_PROTOCOL = env('CHAT_COMPACT_PROTOCOL', 'True') == 'True'
+
+# /metrics (chat/metrics.py); when set, scrapers must send "Authorization: Bearer <token>".
+# Unset, the page is only served with DEBUG, to staff users and to INTERNAL_IPS.
+CHAT_METRICS_TOKEN = env('CHAT_METRICS_TOKEN', '')
+
 if env('CHANNEL_LAYERS_OVERRIDE', 'False') == 'True':
     CHANNEL_LAYERS = {'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}}
+    CHAT_HISTORY_CACHE_URL = None
+    CHAT_PRESENCE_URL = None
+    CHAT_DIRECTORY_CACHE_URL = None
+    CHAT_SESSION_CACHE_URL = None
+
+# ------------------ Chat ------------------
+# Fernet keys for Message.content, comma separated, newest first. Only the
+# first key encrypts; the rest still decrypt until `manage.py rotate_message_keys`
+# has re-encrypted old rows. Generate one with:
+#   python -c "from cryptography.fernet import Fernet; print(Fernet.generate_key().decode())"
+# Required outside DEBUG: a key committed here would encrypt every message
+# with a public key.
+CHAT_ENCRYPTION_KEYS = [k for k in env('CHAT_ENCRYPTION_KEYS', '').split(',') if k.strip()]
+if not CHAT_ENCRYPTION_KEYS:
+    if not DEBUG:
+        raise ImproperlyConfigured('CHAT_ENCRYPTION_KEYS must be set when DEBUG is off')
+    CHAT_ENCRYPTION_KEYS = ['n5QergO_eFsagxO-wIon6QCJhxKYNodnRWVX9s6ueMw=']  # development only
+CHAT_DECRYPT_WORKERS = int(env('CHAT_DECRYPT_WORKERS', '4'))
+
+CHAT_UPLOAD_MAX_BYTES = int(env('CHAT_UPLOAD_MAX_BYTES', str(20 * 1024 * 1024)))
+CHAT_UPLOAD_TEMP_DIR = env('CHAT_UPLOAD_TEMP_DIR')
+CHAT_UPLOAD_STALE_SECONDS = int(env('CHAT_UPLOAD_STALE_SECONDS', str(24 * 3600)))
+CHAT_IMAGE_WORKERS = int(env('CHAT_IMAGE_WORKERS', '0'))  # 0 = min(2, cpu_count)
+CHAT_IMAGE_MAX_PIXELS = int(env('CHAT_IMAGE_MAX_PIXELS', '40000000'))
+CHAT_IMAGE_MAX_DIMENSION = int(env('CHAT_IMAGE_MAX_DIMENSION', '2048'))
+CHAT_IMAGE_THUMBNAIL_SIZES = (160, 480)
 
 # ------------------ Sessions ------------------
-SESSION_ENGINE = 'django.contrib.sessions.backends.db'
 SESSION_COOKIE_AGE = 1209600
+if CHAT_SESSION_CACHE_URL:
+    SESSION_ENGINE = 'chat.sessions'
+    SESSION_CACHE_ALIAS = 'sessions'
+    CACHES = {
+        'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'},
+        'sessions': {
+            'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+            'LOCATION': CHAT_SESSION_CACHE_URL,
+            'TIMEOUT': SESSION_COOKIE_AGE,
+            # fail fast to the DB fallback when Redis is unreachable
+            'OPTIONS': {'socket_connect_timeout': 0.5, 'socket_timeout': 0.5},
+        },
+    }
+else:
+    # a process-local cache would miss other workers' logouts
+    SESSION_ENGINE = 'django.contrib.sessions.backends.db'
 SESSION_COOKIE_HTTPONLY = True
 SESSION_COOKIE_SECURE = env('SESSION_COOKIE_SECURE', 'False') == 'True'
 CSRF_COOKIE_SECURE = env('CSRF_COOKIE_SECURE', 'False') == 'True'
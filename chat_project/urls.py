@@ -3,7 +3,9 @@ from django.urls import path, include
 from django.contrib.auth import views as auth_views
 from django.shortcuts import redirect
 from django.conf import settings
-from django.conf.urls.static import static
+
+from chat.media import serve_media
+from chat.metrics import metrics_view
 
 urlpatterns = [
     # Trang quản trị
@@ -12,14 +14,17 @@ urlpatterns = [
     # Ứng dụng Chat
     path('chat/', include('chat.urls')),
 
+    # Prometheus metrics (CHAT_METRICS_TOKEN để yêu cầu Bearer token; không đặt thì chỉ DEBUG, staff, INTERNAL_IPS)
+    path('metrics', metrics_view, name='metrics'),
+
     # Đăng nhập / đăng xuất
     path('login/', auth_views.LoginView.as_view(template_name='chat/login.html'), name='login'),
     path('logout/', auth_views.LogoutView.as_view(next_page='/chat/login/'), name='logout'),
 
+    # Ảnh / tệp trong MEDIA: stream theo khối, hỗ trợ Range, ETag và cache dài
+    # (blobs/ theo SHA-256 cache vĩnh viễn; CHAT_MEDIA_ACCEL để nginx/Apache gửi tệp)
+    path(f"{settings.MEDIA_URL.strip('/')}/<path:path>", serve_media, name='media'),
+
     # Trang mặc định → chuyển đến trang login
     path('', lambda request: redirect('login')),
 ]
-
-# Cho phép hiển thị ảnh trong MEDIA (nếu DEBUG=True)
-if settings.DEBUG:
-    urlpatterns += static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT)